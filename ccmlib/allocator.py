@@ -0,0 +1,255 @@
+# host-wide address and port allocation
+#
+# Clusters of a user running on the same host (whatever their ccm
+# directory) lease the addresses and the JMX and remote debugging ports of
+# their nodes from a single lease file, so they never collide. The lease
+# file is private to the user, as anyone able to write it could take over
+# the leases of others; users sharing a host can point 'lease_file' in
+# ~/.ccm/config to a file they all trust. Cassandra binds thrift,
+# storage and the binary protocol on the node address, so a unique address
+# is enough for those ports, but JMX and remote debugging bind on all the
+# interfaces and need ports unique to the host.
+from __future__ import with_statement
+
+import os, errno, fcntl, socket, struct, tempfile, contextlib, yaml
+import common
+
+# Addresses handed out to nodes, unless 'address_range' is set (to another
+# CIDR block) in ~/.ccm/config. The addresses ending in .0 or .255 are
+# skipped.
+ADDRESS_RANGE = '127.0.0.0/8'
+# Ports handed out for JMX and remote debugging (inclusive), away from the
+# ports cassandra uses on the node addresses and from the ephemeral ports
+PORT_RANGE = (10000, 19999)
+
+def lease(owner, keepalive, addresses=0, ports=0, reserve_addresses=[], reserve_ports=[], pid=None):
+    """
+    Lease addresses consecutive addresses and ports ports (preferably
+    consecutive) to owner, on top of what it already leases, and returns
+    them as a (list of addresses, list of ports) pair. The addresses and
+    ports of reserve_addresses and reserve_ports (that were chosen by the
+    caller) are leased to owner too (except for host names), and an
+    ArgumentError is raised if another owner leases them. The lease of owner lasts as long as the
+    keepalive path exists and, if pid is given, that process runs.
+    """
+    # host names can't be leased
+    reserve_addresses = [ a for a in reserve_addresses if __is_address(a) ]
+    with _LeaseFile() as leases:
+        taken_addresses, taken_ports = set(), set()
+        for other, l in leases.items():
+            if other != owner:
+                taken_addresses.update(__decode(l['addresses'], __to_int))
+                taken_ports.update(__decode(l['ports'], int))
+
+        for address in reserve_addresses:
+            if __to_int(address) in taken_addresses:
+                raise common.ArgumentError("Address %s is already used by another cluster (see %s)" % (address, lease_file()))
+        for port in reserve_ports:
+            if int(port) in taken_ports:
+                raise common.ArgumentError("Port %s is already used by another cluster (see %s)" % (port, lease_file()))
+
+        l = leases.setdefault(owner, { 'addresses' : [], 'ports' : [] })
+        l['keepalive'] = os.path.abspath(keepalive)
+        l['pid'] = pid
+        owned_addresses = set(__decode(l['addresses'], __to_int)) | set(__to_int(a) for a in reserve_addresses)
+        owned_ports = set(__decode(l['ports'], int)) | set(int(p) for p in reserve_ports)
+
+        first, last = address_range()
+        candidates = ( a for a in xrange(first, last + 1) if a & 0xff not in (0, 0xff) )
+        new_addresses = __allocate(addresses, candidates, taken_addresses | owned_addresses, lambda a: True, contiguous=True)
+        if new_addresses is None:
+            raise common.ArgumentError("No %d consecutive free addresses left in %s (see %s)" % (addresses, __range_name(), lease_file()))
+        first, last = port_range()
+        new_ports = __allocate(ports, xrange(first, last + 1), taken_ports | owned_ports, __port_available)
+        if new_ports is None:
+            raise common.ArgumentError("No %d free ports left between %d and %d (see %s)" % (ports, first, last, lease_file()))
+
+        l['addresses'] = __encode(owned_addresses | set(new_addresses), __to_address)
+        l['ports'] = __encode(owned_ports | set(new_ports), str)
+        return ([ __to_address(a) for a in new_addresses ], new_ports)
+
+def register(owner, keepalive, addresses, ports):
+    """
+    Lease the addresses and ports an existing owner (e.g. a cluster created
+    before leases existed) already uses, unless it has a lease already. What
+    other owners lease is skipped: owners predating leases may well share
+    addresses, this just keeps new owners away from them.
+    """
+    with _LeaseFile() as leases:
+        if owner in leases:
+            return
+        taken_addresses, taken_ports = set(), set()
+        for l in leases.values():
+            taken_addresses.update(__decode(l['addresses'], __to_int))
+            taken_ports.update(__decode(l['ports'], int))
+        addresses = set(__to_int(a) for a in addresses if __is_address(a)) - taken_addresses
+        ports = set(int(p) for p in ports) - taken_ports
+        leases[owner] = {
+            'keepalive' : os.path.abspath(keepalive),
+            'pid' : None,
+            'addresses' : __encode(addresses, __to_address),
+            'ports' : __encode(ports, str),
+        }
+
+def release(owner, addresses=None, ports=None):
+    """
+    Give back addresses and ports (all of them if both are None) leased to
+    owner.
+    """
+    with _LeaseFile() as leases:
+        if owner not in leases:
+            return
+        if addresses is None and ports is None:
+            del leases[owner]
+            return
+        l = leases[owner]
+        l['addresses'] = __encode(set(__decode(l['addresses'], __to_int)) - set(__to_int(a) for a in addresses or []), __to_address)
+        l['ports'] = __encode(set(__decode(l['ports'], int)) - set(int(p) for p in ports or []), str)
+
+def lease_file():
+    return common.get_config().get('lease_file', os.path.join(tempfile.gettempdir(), 'ccm-%d' % os.getuid(), 'leases.yaml'))
+
+@contextlib.contextmanager
+def host_lock(name):
+    """
+    An exclusive lock on name shared by the ccm processes using the same
+    lease file, held while in the with block.
+    """
+    fd = os.open(os.path.join(_lease_directory(), '%s.lock' % name), os.O_RDWR | os.O_CREAT, 0600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+def _lease_directory():
+    directory = os.path.dirname(lease_file())
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+    elif 'lease_file' not in common.get_config() and os.stat(directory).st_uid != os.getuid():
+        # a world-writable temp dir: anyone could have created it
+        raise common.CCMError("%s is not owned by the current user, cannot use the lease file in it (set 'lease_file' in ~/.ccm/config)" % directory)
+    return directory
+
+def address_range():
+    # the (first, last) addresses (as integers) of the address range
+    network, bits = __range_name().split('/')
+    mask = (0xffffffff << (32 - int(bits))) & 0xffffffff
+    first = __to_int(network) & mask
+    return (first, first | (~mask & 0xffffffff))
+
+def __range_name():
+    return common.get_config().get('address_range', ADDRESS_RANGE)
+
+def port_range():
+    r = common.get_config().get('port_range')
+    if r is None:
+        return PORT_RANGE
+    first, last = str(r).split('-')
+    return (int(first), int(last))
+
+class _LeaseFile():
+    """
+    The leases of the lease file as a dictionary of owner to lease, locked
+    (across processes) and without the stale leases while in the with block,
+    and saved at the end of it unless it raised.
+    """
+    def __enter__(self):
+        _lease_directory()
+        fd = os.open(lease_file(), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0600)
+        self.file = os.fdopen(fd, 'a+')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        self.file.seek(0)
+        try:
+            self.leases = yaml.safe_load(self.file) or {}
+        except yaml.YAMLError:
+            self.leases = {}
+        for owner, l in self.leases.items():
+            if not _alive(l):
+                del self.leases[owner]
+        return self.leases
+
+    def __exit__(self, type, value, traceback):
+        try:
+            if type is None:
+                # rewritten in place, as other users can't replace the file
+                self.file.seek(0)
+                self.file.truncate()
+                yaml.safe_dump(self.leases, self.file)
+                self.file.flush()
+        finally:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+        return False
+
+def _alive(l):
+    # Whether the owner of lease l is still around
+    try:
+        os.stat(l['keepalive'])
+    except OSError as e:
+        # another user's directory may just not be visible
+        if e.errno != errno.EACCES:
+            return False
+    if l.get('pid') is not None:
+        try:
+            os.kill(l['pid'], 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                return False
+    return True
+
+def __allocate(count, candidates, taken, available, contiguous=False):
+    # Returns count of the candidates that are not taken and are available,
+    # the first ones first (and following each other in candidates if
+    # contiguous), or None if there aren't enough
+    allocated = []
+    for value in candidates:
+        if len(allocated) == count:
+            break
+        if value in taken or not available(value):
+            if contiguous:
+                allocated = []
+            continue
+        allocated.append(value)
+    return allocated if len(allocated) == count else None
+
+def __port_available(port):
+    # leases don't know about the ports used outside of ccm
+    s = socket.socket()
+    try:
+        s.bind(('', port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+def __encode(values, to_string):
+    # sorted values as a compact list of 'first-last' runs
+    runs = []
+    for v in sorted(values):
+        if runs and runs[-1][1] == v - 1:
+            runs[-1][1] = v
+        else:
+            runs.append([ v, v ])
+    return [ to_string(a) if a == b else "%s-%s" % (to_string(a), to_string(b)) for a, b in runs ]
+
+def __decode(runs, to_value):
+    values = []
+    for run in runs:
+        bounds = str(run).split('-')
+        values.extend(xrange(to_value(bounds[0]), to_value(bounds[-1]) + 1))
+    return values
+
+def __is_address(address):
+    try:
+        socket.inet_aton(address)
+        return True
+    except socket.error:
+        return False
+
+def __to_int(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+def __to_address(n):
+    return socket.inet_ntoa(struct.pack('!I', n))
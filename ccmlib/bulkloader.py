@@ -1,6 +1,6 @@
 # ccm node
 from __future__ import with_statement
-import tempfile, os, common, subprocess
+import tempfile, os, common, allocator, subprocess
 from node import Node
 
 # We reuse Node because the bulkloader basically needs all the same files,
@@ -8,20 +8,19 @@ from node import Node
 # so be careful when using this object. This will need some cleanup someday
 class BulkLoader(Node):
     def __init__(self, cluster):
-        # A lot of things are wrong in that method. It assumes that the ip
-        # 127.0.0.<nbnode> is free and use standard ports without asking.
-        # It should problably be fixed, but will be good enough for now.
-        addr = '127.0.0.%d' % (len(cluster.nodes) + 1)
+        # The address is leased for as long as this process (which execs
+        # sstableloader, see load) runs. The ports are the standard ones, as
+        # only the storage port gets bound, on that address.
         self.path = tempfile.mkdtemp(prefix='bulkloader-')
+        addresses, _ = allocator.lease(self.path, self.path, addresses=1, pid=os.getpid())
+        addr = addresses[0]
         Node.__init__(self, 'bulkloader', cluster, False, (addr, 9160), (addr, 7000), str(9042), 2000, None)
 
     def get_path(self):
         return os.path.join(self.path, self.name)
 
     def load(self, options):
-        for itf in self.network_interfaces.values():
-            if itf:
-                common.check_socket_available(itf)
+        common.check_sockets_available([ itf for itf in self.network_interfaces.values() if itf ])
 
         cdir = self.get_cassandra_dir()
         loader_bin = os.path.join(cdir, 'bin', 'sstableloader')
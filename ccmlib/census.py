@@ -0,0 +1,192 @@
+# partition key census
+#
+# Enumerates the partition keys of the sstables of a cluster (through
+# sstable2json -e) and feeds them to memory-bounded estimators to report
+# distinct partition counts and how keys are duplicated across sstables.
+from __future__ import with_statement
+
+import os, math, hashlib, struct, subprocess, threading
+import common, sstable
+
+_MASK64 = (1 << 64) - 1
+
+def _hash(key):
+    # two independent 64 bits hashes: one for HyperLogLog, one for sampling
+    return struct.unpack('>QQ', hashlib.md5(key).digest())
+
+class HyperLogLog():
+    """
+    Estimates the number of distinct elements added, using 2^precision bytes.
+    """
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add_hash(self, h):
+        index = h >> (64 - self.precision)
+        remaining = h & (_MASK64 >> self.precision)
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        for i in xrange(0, len(self.registers)):
+            if other.registers[i] > self.registers[i]:
+                self.registers[i] = other.registers[i]
+        return self
+
+    def cardinality(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = sum(1 for r in self.registers if r == 0)
+        if estimate <= 2.5 * m and zeros > 0:
+            # small range correction (linear counting)
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+class KeySample():
+    """
+    Counts the occurrences of a hash-based sample of the keys added. The
+    sampling rate is halved each time more than capacity keys are sampled, so
+    the sample stays unbiased whatever the number of distinct keys.
+    """
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.level = 0
+        self.counts = {}
+
+    def add_hash(self, key, h):
+        if h & ((1 << self.level) - 1):
+            return
+        self.counts[key] = self.counts.get(key, 0) + 1
+        while len(self.counts) > self.capacity:
+            self.level += 1
+            mask = (1 << self.level) - 1
+            self.counts = dict((k, c) for k, c in self.counts.iteritems() if not _hash(k)[1] & mask)
+
+    def distribution(self):
+        """
+        Returns a sorted list of (occurrences, fraction of keys) pairs.
+        """
+        histogram = {}
+        for c in self.counts.itervalues():
+            histogram[c] = histogram.get(c, 0) + 1
+        total = float(len(self.counts))
+        return [ (c, n / total) for c, n in sorted(histogram.items()) ]
+
+class TopKeys():
+    """
+    Tracks the most frequent keys with a bounded number of counters (a
+    Space-Saving variant evicting the least frequent half when full).
+    """
+    def __init__(self, k=10):
+        self.k = k
+        self.capacity = max(64, 8 * k)
+        self.counts = {}  # key -> [ count, overestimation ]
+        self.floor = 0
+
+    def add(self, key, count=1):
+        if key in self.counts:
+            self.counts[key][0] += count
+            return
+        if len(self.counts) >= self.capacity:
+            kept = sorted(self.counts.iteritems(), key=lambda kv: kv[1][0], reverse=True)
+            self.floor = kept[self.capacity // 2][1][0]
+            self.counts = dict(kept[:self.capacity // 2])
+        self.counts[key] = [ self.floor + count, self.floor ]
+
+    def merge(self, other):
+        for key, (count, error) in other.counts.iteritems():
+            self.add(key, count - error)
+        return self
+
+    def top(self):
+        """
+        Returns the (up to) k most frequent keys with a lower bound of their
+        number of occurrences. Keys that can't be guaranteed to have been seen
+        more than once are ignored.
+        """
+        guaranteed = [ (key, count - error) for key, (count, error) in self.counts.iteritems() if count - error > 1 ]
+        return sorted(guaranteed, key=lambda kv: kv[1], reverse=True)[:self.k]
+
+class TableCensus():
+    """
+    Key statistics for one table on one node (or on the whole cluster).
+    """
+    def __init__(self):
+        self.hll = HyperLogLog()
+        self.sample = KeySample()
+        self.top = TopKeys()
+        self.sstables = 0
+        self.keys = 0
+        self.lock = threading.Lock()
+
+    def add(self, key):
+        h1, h2 = _hash(key)
+        with self.lock:
+            self.keys += 1
+            self.hll.add_hash(h1)
+            self.sample.add_hash(key, h2)
+            self.top.add(key)
+
+    def distinct(self):
+        return self.hll.cardinality()
+
+    def sstables_per_key(self):
+        distinct = self.distinct()
+        return float(self.keys) / distinct if distinct > 0 else 0.0
+
+def enumerate_keys(cassandra_dir, env, datafile):
+    """
+    Yields the partition keys (as printed by sstable2json -e) of datafile.
+    """
+    sstable2json = os.path.join(cassandra_dir, 'bin', 'sstable2json')
+    with open(os.devnull, 'w') as devnull:
+        p = subprocess.Popen([ sstable2json, datafile, '-e' ], env=env, stdout=subprocess.PIPE, stderr=devnull)
+        for line in iter(p.stdout.readline, ''):
+            key = line.strip()
+            if key:
+                yield key
+    if p.wait() != 0:
+        raise common.CCMError("sstable2json -e failed on %s (exit code %d)" % (datafile, p.returncode))
+
+def run(cluster, keyspace=None, column_families=None, max_workers=None):
+    """
+    Enumerates the keys of all the sstables of all the nodes of cluster in
+    parallel. Returns a dictionary of table name ('ks.cf') to a pair of the
+    cluster-wide TableCensus and a dictionary of node name to the node TableCensus.
+    """
+    jobs = []
+    per_node = {}
+    for node in cluster.nodelist():
+        cdir = node.get_cassandra_dir()
+        env = common.make_cassandra_env(cdir, node.get_path())
+        datafiles = []
+        for ks in ([ keyspace ] if keyspace is not None else node.list_keyspaces()):
+            for cf in (column_families or [ "" ]):
+                datafiles += node.get_sstables(ks, cf)
+        for datafile in datafiles:
+            descriptor = sstable.parse_descriptor(datafile)
+            table = "%s.%s" % (descriptor['keyspace'], descriptor['table'])
+            census = per_node.setdefault(table, {}).setdefault(node.name, TableCensus())
+            census.sstables += 1
+            jobs.append((cdir, env, datafile, census))
+
+    def census_job(job):
+        cdir, env, datafile, census = job
+        for key in enumerate_keys(cdir, env, datafile):
+            census.add(key)
+
+    common.parallel_map(census_job, jobs, max_workers=max_workers)
+
+    report = {}
+    for table, nodes in per_node.iteritems():
+        total = TableCensus()
+        for census in nodes.itervalues():
+            total.hll.merge(census.hll)
+            total.sstables += census.sstables
+            total.keys += census.keys
+            total.top.merge(census.top)
+        report[table] = (total, nodes)
+    return report
@@ -1,9 +1,12 @@
 # ccm clusters
 
-import common, yaml, os, subprocess, shutil, repository, time, re, sys
+import common, yaml, os, subprocess, shutil, repository, allocator, profiles, tokens, time, re, sys, census, divergence, multiprocessing
 from node import Node, NodeError
 from bulkloader import BulkLoader
 
+# The ring delay (in ms) of the nodes started with fast_boot
+FAST_BOOT_RING_DELAY = 1000
+
 class Cluster():
     def __init__(self, path, name, partitioner=None, cassandra_dir=None, create_directory=True, cassandra_version=None, verbose=False):
         self.name = name
@@ -11,6 +14,10 @@ class Cluster():
         self.seeds = []
         self.partitioner = partitioner
         self._config_options = {}
+        self.storage = 'disk'
+        self.storage_size = None
+        self.config_profile = None
+        self.fast_boot = False
         self.__log_level = "INFO"
         self.__path = path
         self.__version = None
@@ -26,7 +33,7 @@ class Cluster():
                     self.__cassandra_dir = os.path.abspath(cassandra_dir)
                     self.__version = self.__get_version_from_build()
             else:
-                dir, v = repository.setup(cassandra_version, verbose)
+                dir, v = repository.setup(cassandra_version, verbose, config_dir=path)
                 self.__cassandra_dir = dir
                 self.__version = v if v is not None else self.__get_version_from_build()
 
@@ -49,7 +56,7 @@ class Cluster():
             common.validate_cassandra_dir(cassandra_dir)
             self.__version = self.__get_version_from_build()
         else:
-            dir, v = repository.setup(cassandra_version, verbose)
+            dir, v = repository.setup(cassandra_version, verbose, config_dir=self.__path)
             self.__cassandra_dir = dir
             self.__version = v if v is not None else self.__get_version_from_build()
         self.__update_config()
@@ -57,6 +64,58 @@ class Cluster():
             node.import_config_files()
         return self
 
+    def set_storage(self, storage='disk', size=None):
+        """
+        Set where the nodes data, commitlogs and saved_caches are stored (see
+        Node.set_storage). This applies to the existing nodes and is the
+        default for the nodes added later.
+        """
+        for node in self.nodes.values():
+            node.set_storage(storage, size)
+        self.storage = storage
+        self.storage_size = size
+        self.__update_config()
+        return self
+
+    def set_config_profile(self, name):
+        """
+        Apply the configuration profile name (see profiles.py) to the nodes
+        of this cluster, and those added later: its cassandra.yaml options
+        for the cluster version are set like with set_configuration_options
+        (so options set afterwards override them), and its JVM settings go
+        to the nodes cassandra-env.sh at their next start.
+        """
+        options = profiles.configuration_options(name, self.version())
+        self.config_profile = name
+        self.set_configuration_options(options)
+        return self
+
+    def set_fast_boot(self, fast_boot=True):
+        """
+        Start the nodes with fast_boot (see fast_boot_jvm_args) unless told
+        otherwise.
+        """
+        self.fast_boot = fast_boot
+        self.__update_config()
+        return self
+
+    def fast_boot_jvm_args(self):
+        """
+        Returns the system properties, supported by the cluster version, that
+        cut the time a node spends waiting during its startup: for gossip to
+        settle, for the ring delay (down to FAST_BOOT_RING_DELAY), and for the
+        other nodes to be done moving (so that nodes can bootstrap at the
+        same time). Those waits protect production clusters, test clusters
+        can do without.
+        """
+        version = common.parse_version(self.version())
+        args = [ '-Dcassandra.ring_delay_ms=%d' % FAST_BOOT_RING_DELAY ]
+        if version >= (2, 0):
+            args.append('-Dcassandra.skip_wait_for_gossip_to_settle=0')
+        if version >= (2, 1):
+            args.append('-Dcassandra.consistent.rangemovement=false')
+        return args
+
     def get_cassandra_dir(self):
         common.validate_cassandra_dir(self.__cassandra_dir)
         return self.__cassandra_dir
@@ -77,7 +136,7 @@ class Cluster():
             cassandra_dir = None
             if 'cassandra_dir' in data:
                 cassandra_dir = data['cassandra_dir']
-                repository.validate(cassandra_dir)
+                repository.validate(cassandra_dir, config_dir=path)
 
             cluster = Cluster(path, data['name'], cassandra_dir=cassandra_dir, create_directory=False)
             node_list = data['nodes']
@@ -88,6 +147,13 @@ class Cluster():
                 cluster._config_options = data['config_options']
             if 'log_level' in data:
                 cluster.__log_level = data['log_level']
+            if 'storage' in data:
+                cluster.storage = data['storage']['type']
+                cluster.storage_size = data['storage'].get('size')
+            if 'config_profile' in data:
+                cluster.config_profile = data['config_profile']
+            if 'fast_boot' in data:
+                cluster.fast_boot = data['fast_boot']
         except KeyError as k:
             raise common.LoadError("Error Loading " + filename + ", missing property:" + k)
 
@@ -96,11 +162,22 @@ class Cluster():
         for seed_name in seed_list:
             cluster.seeds.append(cluster.nodes[seed_name])
 
+        # clusters created before the allocator existed have no lease yet
+        addresses, ports = set(), []
+        for node in cluster.nodelist():
+            node_addresses, node_ports = cluster.__node_leases(node)
+            addresses.update(node_addresses)
+            ports.extend(node_ports)
+        allocator.register(cluster.get_path(), cluster.get_path(), addresses, ports)
+
         return cluster
 
     def add(self, node, is_seed, data_center=None):
         if node.name in self.nodes:
             raise common.ArgumentError('Cannot create existing node %s' % node.name)
+        # so that no other cluster gets them from the allocator
+        addresses, ports = self.__node_leases(node)
+        allocator.lease(self.get_path(), self.get_path(), reserve_addresses=addresses, reserve_ports=ports)
         self.nodes[node.name] = node
         if is_seed:
             self.seeds.append(node)
@@ -108,11 +185,30 @@ class Cluster():
         node.data_center = data_center
         node.set_log_level(self.__log_level)
         node._save()
+        if self.storage != 'disk' and node.storage_dir is None:
+            node.set_storage(self.storage, self.storage_size)
         if data_center is not None:
             self.__update_topology_files()
         return self
 
-    def populate(self, nodes, debug=False, tokens=None, use_vnodes=False, ipprefix='127.0.0.'):
+    def populate(self, nodes, debug=False, tokens=None, use_vnodes=False, balanced_vnodes=False, ipprefix=None, data_mounts=None, data_dirs_per_node=None, data_map=None, commitlog_mounts=None, cgroup_limits=None):
+        """
+        Add nodes (a node count, or a list of node counts per data center) to
+        this cluster. Unless tokens are provided, the nodes of each data
+        center get evenly spread tokens (see balanced_tokens), or with
+        use_vnodes, random ones, or evenly spread ones too if balanced_vnodes
+        (num_tokens per node, 256 by default). The nodes addresses are ipprefix followed by the node
+        number if ipprefix is provided, or else leased from the host-wide
+        allocator (see allocate_interfaces), and so are their JMX and remote
+        debugging ports. The nodes data directories can be spread across
+        data_mounts (see Node.set_data_directories): each node gets
+        data_dirs_per_node of them (all by default), assigned round-robin,
+        unless data_map (a dictionary of node name to list of mounts) maps it
+        explicitly. Similarly, the nodes commitlogs are assigned round-robin
+        across commitlog_mounts. If cgroup_limits is provided, each node gets
+        these limits (a dictionary of Node.set_cgroup_limits arguments), and
+        a cpuset of 'auto' splits the CPUs of the host between the nodes.
+        """
         node_count = nodes
         dcs = []
         if isinstance(nodes, list):
@@ -132,8 +228,24 @@ class Cluster():
             if 'node%s' % i in self.nodes.values():
                 raise common.ArgumentError('Cannot create existing node node%s' % i)
 
-        if tokens is None and not use_vnodes:
-            tokens = self.balanced_tokens(node_count)
+        if tokens is None:
+            if not use_vnodes:
+                tokens = self.balanced_tokens(nodes)
+            elif balanced_vnodes:
+                if common.parse_version(self.version()) < (1, 2):
+                    raise common.ArgumentError('Vnodes require cassandra 1.2 or later')
+                num_tokens = self._config_options.get('num_tokens')
+                if num_tokens is None:
+                    num_tokens = 256
+                    self.set_configuration_options({ 'num_tokens' : num_tokens })
+                tokens = self.balanced_tokens(nodes, num_tokens)
+
+        addresses = None
+        if ipprefix is not None:
+            if node_count > 254:
+                raise common.ArgumentError('Cannot create more than 254 nodes with an ipprefix (let the addresses be allocated instead)')
+            addresses = [ '%s%s' % (ipprefix, i) for i in xrange(1, node_count + 1) ]
+        interfaces = self.allocate_interfaces(node_count, debug, addresses)
 
         for i in xrange(1, node_count + 1):
             tk = None
@@ -141,27 +253,63 @@ class Cluster():
                 tk = tokens[i-1]
             dc = dcs[i-1] if i-1 < len(dcs) else None
 
+            address, jmx_port, remote_debug_port = interfaces[i-1]
             binary = None
             if self.version() >= '1.2':
-                binary = ('%s%s' % (ipprefix, i), 9042)
+                binary = (address, 9042)
             node = Node('node%s' % i,
                         self,
                         False,
-                        ('%s%s' % (ipprefix, i), 9160),
-                        ('%s%s' % (ipprefix, i), 7000),
-                        str(7000 + i * 100),
-                        (str(0),  str(2000 + i * 100))[debug == True],
+                        (address, 9160),
+                        (address, 7000),
+                        jmx_port,
+                        remote_debug_port,
                         tk,
                         binary_interface=binary)
+            mounts = self.__assign_mounts(node.name, i - 1, data_mounts, data_dirs_per_node, data_map)
+            if mounts or commitlog_mounts:
+                node.set_data_directories(mounts, commitlog_mounts[(i - 1) % len(commitlog_mounts)] if commitlog_mounts else None)
+            if cgroup_limits:
+                limits = dict(cgroup_limits)
+                if limits.get('cpuset') == 'auto':
+                    limits['cpuset'] = self.__split_cpus(i - 1, node_count)
+                node.set_cgroup_limits(**limits)
             self.add(node, True, dc)
-            self.__update_config()
         return self
 
-    def balanced_tokens(self, node_count):
-        if self.version() >= '1.2' and not self.partitioner:
-            ptokens = [(i*(2**64/node_count)) for i in xrange(0, node_count)]
-            return [t - 2**63 for t in ptokens]
-        return [ (i*(2**127/node_count)) for i in range(0, node_count) ]
+    def allocate_interfaces(self, count=1, debug=False, addresses=None):
+        """
+        Lease count consecutive addresses (unless addresses are provided),
+        and a JMX port and if debug a remote debugging port for each, for new
+        nodes of this cluster from the host-wide allocator (see allocator.py).
+        Returns a list of (address, JMX port, remote debugging port) per node,
+        the remote debugging port being '0' if not debug.
+        """
+        ports = count * 2 if debug else count
+        if addresses is None:
+            addresses, ports = allocator.lease(self.get_path(), self.get_path(), addresses=count, ports=ports)
+        else:
+            _, ports = allocator.lease(self.get_path(), self.get_path(), ports=ports, reserve_addresses=addresses)
+        return [ (addresses[i], str(ports[i]), str(ports[count + i]) if debug else '0') for i in xrange(0, count) ]
+
+    def balanced_tokens(self, node_count, num_tokens=1):
+        """
+        Returns evenly spread tokens for node_count nodes, or for the nodes of
+        several data centers, each balanced on its own, if node_count is a
+        list of node counts (see tokens.balanced_tokens). With num_tokens > 1,
+        a node gets a comma-separated list of tokens (for initial_token with
+        vnodes). Returns None if ccm doesn't know the tokens of the cluster
+        partitioner.
+        """
+        counts = node_count if isinstance(node_count, list) else [ node_count ]
+        partitioner = self.partitioner or tokens.default_partitioner(self.version())
+        try:
+            node_tokens = tokens.balanced_tokens(partitioner, counts, num_tokens)
+        except ValueError:
+            return None
+        if num_tokens == 1:
+            return [ t[0] for t in node_tokens ]
+        return [ ','.join(str(t) for t in ts) for ts in node_tokens ]
 
     def remove(self, node=None):
         if node is not None:
@@ -173,10 +321,18 @@ class Cluster():
                 self.seeds.remove(node)
             self.__update_config()
             node.stop(gently=False)
+            node.release_storage()
+            node.release_cgroup()
             shutil.rmtree(node.get_path())
+            addresses, ports = self.__node_leases(node)
+            allocator.release(self.get_path(), addresses, ports)
         else:
             self.stop(gently=False)
+            for node in self.nodes.values():
+                node.release_storage()
+                node.release_cgroup()
             shutil.rmtree(self.get_path())
+            allocator.release(self.get_path())
 
     def clear(self):
         self.stop()
@@ -200,15 +356,28 @@ class Cluster():
             else:
                 node.show(only_status=True)
 
-    def start(self, no_wait=False, verbose=False, wait_for_binary_proto=False, jvm_args=[], profile_options=None):
+    def start(self, no_wait=False, verbose=False, wait_for_binary_proto=False, jvm_args=[], profile_options=None, fast_boot=None):
+        """
+        Start all the nodes that are not running, at the same time. With
+        fast_boot (by default, the cluster setting of set_fast_boot), they
+        skip most of the waiting of their startup (see fast_boot_jvm_args).
+        """
+        return self.__start_nodes(self.nodes.values(), no_wait, verbose, wait_for_binary_proto, jvm_args, profile_options, fast_boot)
+
+    def __start_nodes(self, nodes, no_wait=False, verbose=False, wait_for_binary_proto=False, jvm_args=[], profile_options=None, fast_boot=None):
+        # all the conflicts are reported at once, before anything is started
+        to_start = [ node for node in nodes if not node.is_running() ]
+        common.check_sockets_available([ itf for node in to_start for itf in node.listening_interfaces() ])
+        # the nodes of a cluster get the same heap, unless their cgroup memory limits cap it
+        heaps = [ heap for heap in (node.heap_budget() for node in to_start) if heap is not None ]
         started = []
-        for node in self.nodes.values():
-            if not node.is_running():
+        with common.heap_admission(sum(heap[0] for heap in heaps) * 1024 * 1024):
+            for node in to_start:
                 mark = 0
                 if os.path.exists(node.logfilename()):
                     mark = node.mark_log()
 
-                p = node.start(update_pid=False, jvm_args=jvm_args, profile_options=profile_options)
+                p = node.start(update_pid=False, jvm_args=jvm_args, profile_options=profile_options, check_sockets=False, check_memory=False, fast_boot=fast_boot)
                 started.append((node, p, mark))
 
         if no_wait and not verbose:
@@ -330,9 +499,112 @@ class Cluster():
         loader = BulkLoader(self)
         loader.load(options)
 
-    def scrub(self, options):
-        for node in self.nodes.values():
-            node.scrub(options)
+    def scrub(self, options, max_down=None, verbose=False):
+        return self.run_offline_tool('sstablescrub', options, max_down=max_down, verbose=verbose)
+
+    def upgradesstables(self, options, max_down=None, verbose=False):
+        return self.run_offline_tool('sstableupgrade', options, max_down=max_down, verbose=verbose)
+
+    def sstablesplit(self, keyspace=None, column_families=None, size=None, max_down=None, max_workers=None, verbose=False):
+        """
+        Run sstablesplit on the nodes (see run_offline_tool and
+        Node.run_sstablesplit). The nodes of a batch split in parallel, so
+        they share max_workers splits at a time (default to half the number
+        of cores).
+        """
+        nodes = len(self.nodes)
+        batch = min(max_down, nodes) if max_down is not None and max_down >= 1 else nodes
+        per_node = max(1, (max_workers or common.default_parallelism()) // max(1, batch))
+        def split(node):
+            results = node.run_sstablesplit(keyspace=keyspace, column_families=column_families, size=size, max_workers=per_node, verbose=verbose)
+            failed = [ os.path.basename(f) for f, rc in results if rc != 0 ]
+            return (1 if failed else 0, "Failed to split: %s" % ", ".join(failed) if failed else "")
+        return self.run_offline_tool(split, max_down=max_down, verbose=verbose)
+
+    def run_offline_tool(self, tool, options=[], nodes=None, max_down=None, verbose=False):
+        """
+        Run an offline tool on the provided nodes (all nodes by default).
+        tool is either the name of a Cassandra tool (sstablescrub,
+        sstableupgrade, ...), which is then run with the provided options, or
+        a function taking a node and returning a (exit code, output) pair.
+
+        Offline tools require the node to be stopped, so nodes are processed
+        by batches of at most max_down nodes (all nodes at once by default):
+        the running nodes of the batch are stopped, the tool is run on all the
+        nodes of the batch in parallel and the nodes that were running are
+        restarted before moving on to the next batch. A per-node summary is
+        printed at the end and the list of (node, exit code, elapsed time)
+        is returned.
+        """
+        if nodes is None:
+            nodes = self.nodelist()
+        if max_down is None or max_down < 1:
+            max_down = len(nodes)
+
+        if isinstance(tool, basestring):
+            run = lambda node: node.run_offline_tool(tool, options, capture_output=True)
+        else:
+            run = tool
+
+        def run_timed(node):
+            start = time.time()
+            try:
+                rc, output = run(node)
+            except Exception as e:
+                rc, output = None, str(e)
+            return (rc, output, time.time() - start)
+
+        summary = []
+        for i in xrange(0, len(nodes), max_down):
+            batch = nodes[i:i + max_down]
+            to_restart = [ node for node in batch if node.is_running() ]
+            for node in to_restart:
+                node.stop()
+            try:
+                results = common.parallel_map(run_timed, batch, max_workers=len(batch))
+            finally:
+                if to_restart and self.__start_nodes(to_restart, verbose=verbose) is None:
+                    raise NodeError("Error restarting nodes %s" % ", ".join(n.name for n in to_restart))
+            for node, (rc, output, elapsed) in zip(batch, results):
+                if verbose or rc != 0:
+                    for line in output.splitlines():
+                        print "[%s] %s" % (node.name, line)
+                summary.append((node, rc, elapsed))
+
+        for node, rc, elapsed in summary:
+            status = "OK" if rc == 0 else "FAILED (exit code %s)" % rc
+            print "%s: %s in %.1fs" % (node.name, status, elapsed)
+        return summary
+
+    def key_census(self, keyspace=None, column_families=None, max_workers=None):
+        """
+        Enumerate the partition keys of the sstables of all nodes in parallel
+        and estimate, per table and per node, the number of distinct
+        partitions and how many sstables each key is found in. See
+        census.run for the format of the result.
+        """
+        return census.run(self, keyspace, column_families, max_workers)
+
+    def check_replicas(self, keyspace, column_families=None, replication_factor=None, depth=10, flush=True, max_workers=None):
+        """
+        Compare the data of the replicas of each token range (without going
+        through repair) and return the divergent ranges. See divergence.check.
+        """
+        return divergence.check(self, keyspace, column_families, replication_factor, depth, flush, max_workers)
+
+    def warmup(self, keyspace=None, column_families=None, budget=None, max_workers=None):
+        """
+        Read the sstables of all nodes into the OS page cache (see
+        Node.warmup), budget bytes (if provided) being split evenly between
+        the nodes. Returns the number of bytes read.
+        """
+        nodes = self.nodelist()
+        node_budget = budget // len(nodes) if budget is not None and nodes else None
+        return sum(node.warmup(keyspace, column_families, node_budget, max_workers) for node in nodes)
+
+    def drop_page_cache(self, keyspace=None, column_families=None, max_workers=None):
+        for node in self.nodelist():
+            node.drop_page_cache(keyspace, column_families, max_workers)
 
     def update_log4j(self, new_log4j_config):
         # iterate over all nodes
@@ -344,9 +616,36 @@ class Cluster():
         for node in self.nodelist():
             node.update_logback(new_logback_config)
 
+    def __assign_mounts(self, node_name, index, data_mounts, per_node, data_map):
+        if data_map and node_name in data_map:
+            return data_map[node_name]
+        if not data_mounts:
+            return None
+        per_node = min(per_node or len(data_mounts), len(data_mounts))
+        return [ data_mounts[(index * per_node + j) % len(data_mounts)] for j in xrange(0, per_node) ]
+
+    def __split_cpus(self, index, count):
+        # The cpuset of the index-th of count nodes sharing the CPUs of the
+        # host: an equal run of CPUs each, or a single CPU if there are more
+        # nodes than CPUs (then shared round-robin)
+        cpus = multiprocessing.cpu_count()
+        per_node = max(1, cpus // count)
+        first = (index * per_node) % cpus
+        if per_node == 1:
+            return str(first)
+        return "%d-%d" % (first, first + per_node - 1)
+
     def __get_version_from_build(self):
         cassandra_dir = self.get_cassandra_dir()
         build = os.path.join(cassandra_dir, 'build.xml')
+        if not os.path.exists(build):
+            # binary distributions have no build.xml, but their jar is versioned
+            lib = os.path.join(cassandra_dir, 'lib')
+            for jar in sorted(os.listdir(lib)) if os.path.isdir(lib) else []:
+                match = re.match('apache-cassandra-([0-9.]+)[^/]*\.jar$', jar)
+                if match:
+                    return match.group(1).rstrip('.')
+            raise common.CCMError("Cannot find version")
         with open(build) as f:
             for line in f:
                 match = re.search('name="base\.version" value="([0-9.]+)[^"]*"', line)
@@ -366,9 +665,18 @@ class Cluster():
                 'partitioner' : self.partitioner,
                 'cassandra_dir' : self.__cassandra_dir,
                 'config_options' : self._config_options,
-                'log_level' : self.__log_level
+                'log_level' : self.__log_level,
+                'storage' : { 'type' : self.storage, 'size' : self.storage_size },
+                'config_profile' : self.config_profile,
+                'fast_boot' : self.fast_boot,
             }, f)
 
+    def __node_leases(self, node):
+        # the addresses and ports of node that are leased from the allocator
+        addresses = set(itf[0] for itf in node.network_interfaces.values() if itf is not None)
+        ports = [ p for p in (node.jmx_port, node.remote_debug_port) if p is not None and str(p) != '0' ]
+        return (list(addresses), ports)
+
     def __update_pids(self, started):
         for node, p, _ in started:
             node._update_pid(p)
@@ -1,7 +1,7 @@
-import os, sys, shutil
+import os, sys, shutil, time
 from command import Cmd
 
-from ccmlib import common, repository
+from ccmlib import common, repository, allocator, profiles
 from ccmlib.node import Node, NodeError
 from ccmlib.cluster import Cluster
 
@@ -28,6 +28,15 @@ def cluster_cmds():
         "bulkload",
         "setlog",
         "scrub",
+        "upgradesstables",
+        "sstablesplit",
+        "census",
+        "checkreplicas",
+        "warmup",
+        "dropcache",
+        "residency",
+        "repo",
+        "prefetch",
     ]
 
 def parse_populate_count(v):
@@ -39,6 +48,61 @@ def parse_populate_count(v):
     else:
         return [ int(t) for t in tmp ]
 
+def _add_storage_options(parser):
+    parser.add_option('--storage', type="choice", choices=[ 'disk', 'tmpfs' ], dest="storage", default=None,
+        help="Where to store the nodes data, commitlogs and saved caches: 'disk' (in the node directory) or 'tmpfs' (in RAM, see 'tmpfs_dir' in ~/.ccm/config)")
+    parser.add_option('--storage-size', type="int", dest="storage_size", default=None,
+        help="With --storage tmpfs, space (in MB) to require for each node when starting it")
+
+def _add_data_directories_options(parser):
+    parser.add_option('--data-dirs', type="string", dest="data_dirs", default=None,
+        help="Comma-separated list of directories (e.g. the mount points of several disks) to spread the nodes data directories across")
+    parser.add_option('--data-dirs-per-node', type="int", dest="data_dirs_per_node", default=None,
+        help="Number of the --data-dirs each node uses, assigned round-robin (all of them by default)")
+    parser.add_option('--data-map', action="append", dest="data_map", default=[],
+        help="Explicit data directories for a node (format: node_name=dir1,dir2,...), can be repeated")
+    parser.add_option('--commitlog-dirs', type="string", dest="commitlog_dirs", default=None,
+        help="Comma-separated list of directories to put the nodes commitlogs in, assigned round-robin")
+
+def _parse_data_directories_options(options):
+    data_map = {}
+    for mapping in options.data_map:
+        if '=' not in mapping:
+            raise common.ArgumentError("Invalid data directories mapping %s (format: node_name=dir1,dir2,...)" % mapping)
+        name, dirs = mapping.split('=', 1)
+        data_map[name] = dirs.split(',')
+    return {
+        'data_mounts' : options.data_dirs.split(',') if options.data_dirs else None,
+        'data_dirs_per_node' : options.data_dirs_per_node,
+        'data_map' : data_map or None,
+        'commitlog_mounts' : options.commitlog_dirs.split(',') if options.commitlog_dirs else None,
+    }
+
+def _add_cgroup_options(parser, several_nodes=True):
+    nodes = "each node" if several_nodes else "the node"
+    parser.add_option('--cgroup-cpus', type="float", dest="cgroup_cpus", default=None,
+        help="Limit %s to that many CPUs worth of CPU time (in a cgroup v2, see 'cgroup_root' in ~/.ccm/config)" % nodes)
+    parser.add_option('--cgroup-cpuset', type="string", dest="cgroup_cpuset", default=None,
+        help="Run %s on these CPUs only (e.g. 0-3,8)%s" % (nodes, ", or 'auto' to split the CPUs of the host between the nodes" if several_nodes else ""))
+    parser.add_option('--cgroup-memory', type="string", dest="cgroup_memory", default=None,
+        help="Limit the memory of %s (e.g. 4G)" % nodes)
+    parser.add_option('--cgroup-io', type="string", dest="cgroup_io", default=None,
+        help="Limit the I/O of %s on the disks of its data and commitlog directories (e.g. 'rbps=50M wbps=50M riops=1000 wiops=1000')" % nodes)
+
+def _add_config_profile_option(parser):
+    parser.add_option('--config-profile', type="choice", choices=profiles.names(), dest="config_profile", default=None,
+        help="Apply a configuration profile to the nodes: 'dense' shrinks their thread pools, memtables, caches and heap to fit more nodes on the host")
+
+def _parse_cgroup_options(options):
+    limits = {
+        'cpus' : options.cgroup_cpus,
+        'cpuset' : options.cgroup_cpuset,
+        'memory' : options.cgroup_memory,
+        'io' : options.cgroup_io,
+    }
+    limits = dict((k, v) for k, v in limits.items() if v is not None)
+    return limits or None
+
 class ClusterCreateCmd(Cmd):
     def description(self):
         return "Create a new cluster"
@@ -51,13 +115,13 @@ class ClusterCreateCmd(Cmd):
         parser.add_option('-p', '--partitioner', type="string", dest="partitioner",
             help="Set the cluster partitioner class")
         parser.add_option('-v', "--cassandra-version", type="string", dest="cassandra_version",
-            help="Download and use provided cassandra version. If version is of the form 'git:<branch name>', then the specified branch will be downloaded from the git repo and compiled. (takes precedence over --cassandra-dir)", default=None)
+            help="Download and use provided cassandra version. If version is of the form 'git:<branch name>', then the specified branch will be downloaded from the git repo and compiled. If it is of the form 'binary:<version>', the binary distribution of that version is used (no compilation needed), and 'binary:<path>' uses a local prebuilt tree. (takes precedence over --cassandra-dir)", default=None)
         parser.add_option("--cassandra-dir", type="string", dest="cassandra_dir",
             help="Path to the cassandra directory to use [default %default]", default="./")
         parser.add_option('-n', '--nodes', type="string", dest="nodes",
             help="Populate the new cluster with that number of nodes (a single int or a colon-separate list of ints for multi-dc setups)")
-        parser.add_option('-i', '--ipprefix', type="string", dest="ipprefix", default="127.0.0.",
-            help="Ipprefix to use to create the ip of a node while populating")
+        parser.add_option('-i', '--ipprefix', type="string", dest="ipprefix", default=None,
+            help="Ipprefix to use to create the ip of a node while populating (by default, the ips are leased from the host-wide allocator)")
         parser.add_option('-s', "--start", action="store_true", dest="start_nodes",
             help="Start nodes added through -s", default=False)
         parser.add_option('-d', "--debug", action="store_true", dest="debug",
@@ -70,12 +134,20 @@ class ClusterCreateCmd(Cmd):
             help="With -n, sets trace logging on the new nodes", default=False)
         parser.add_option("--vnodes", action="store_true", dest="vnodes",
             help="Use vnodes (256 tokens)", default=False)
+        parser.add_option("--balanced-vnodes", action="store_true", dest="balanced_vnodes",
+            help="With --vnodes, give the nodes evenly spread tokens instead of random ones", default=False)
         parser.add_option('--jvm_arg', action="append", dest="jvm_args",
             help="Specify a JVM argument", default=[])
         parser.add_option('--profile', action="store_true", dest="profile",
             help="Start the nodes with yourkit agent (only valid with -s)", default=False)
         parser.add_option('--profile-opts', type="string", action="store", dest="profile_options",
             help="Yourkit options when profiling", default=None)
+        _add_storage_options(parser)
+        _add_data_directories_options(parser)
+        _add_cgroup_options(parser)
+        _add_config_profile_option(parser)
+        parser.add_option('--fast-boot', action="store_true", dest="fast_boot", default=False,
+            help="Start the nodes skipping most of the waiting of their startup (gossip settling, ring delay, consistent range movements), unless 'ccm start --no-fast-boot'")
         return parser
 
     def validate(self, parser, options, args):
@@ -102,6 +174,15 @@ class ClusterCreateCmd(Cmd):
         if cluster.version() >= "1.2" and self.options.vnodes:
             cluster.set_configuration_options({ 'num_tokens' : 256 })
 
+        if self.options.storage is not None:
+            cluster.set_storage(self.options.storage, self.options.storage_size)
+
+        if self.options.config_profile is not None:
+            cluster.set_config_profile(self.options.config_profile)
+
+        if self.options.fast_boot:
+            cluster.set_fast_boot()
+
         if not self.options.no_switch:
             common.switch_cluster(self.path, self.name)
             print 'Current cluster is now: %s' % self.name
@@ -112,7 +193,7 @@ class ClusterCreateCmd(Cmd):
                     cluster.set_log_level("DEBUG")
                 if self.options.trace_log:
                     cluster.set_log_level("TRACE")
-                cluster.populate(self.nodes, use_vnodes=self.options.vnodes, ipprefix=self.options.ipprefix)
+                cluster.populate(self.nodes, use_vnodes=self.options.vnodes, balanced_vnodes=self.options.balanced_vnodes, ipprefix=self.options.ipprefix, cgroup_limits=_parse_cgroup_options(self.options), **_parse_data_directories_options(self.options))
                 if self.options.start_nodes:
                     profile_options = None
                     if self.options.profile:
@@ -140,7 +221,7 @@ class ClusterAddCmd(Cmd):
         parser.add_option('-s', '--seeds', action="store_true", dest="is_seed",
             help="Configure this node as a seed", default=False)
         parser.add_option('-i', '--itf', type="string", dest="itfs",
-            help="Set host and port for thrift, the binary protocol and storage (format: host[:port])")
+            help="Set host and port for thrift, the binary protocol and storage (format: host[:port]). The host is leased from the host-wide allocator if no interface is set")
         parser.add_option('-t', '--thrift-itf', type="string", dest="thrift_itf",
             help="Set the thrift host and port for the node (format: host[:port])")
         parser.add_option('-l', '--storage-itf', type="string", dest="storage_itf",
@@ -148,37 +229,46 @@ class ClusterAddCmd(Cmd):
         parser.add_option('--binary-itf', type="string", dest="binary_itf",
             help="Set the binary protocol host and port for the node (format: host[:port]).")
         parser.add_option('-j', '--jmx-port', type="string", dest="jmx_port",
-            help="JMX port for the node", default="7199")
+            help="JMX port for the node (leased from the host-wide allocator by default)", default=None)
         parser.add_option('-r', '--remote-debug-port', type="string", dest="remote_debug_port",
-            help="Remote Debugging Port for the node", default="2000")
+            help="Remote Debugging Port for the node (leased from the host-wide allocator by default)", default=None)
         parser.add_option('-n', '--token', type="string", dest="initial_token",
             help="Initial token for the node", default=None)
         parser.add_option('-d', '--data-center', type="string", dest="data_center",
             help="Datacenter name this node is part of", default=None)
+        parser.add_option('--data-dirs', type="string", dest="data_dirs", default=None,
+            help="Comma-separated list of directories (e.g. the mount points of several disks) to spread the node data directories across")
+        parser.add_option('--commitlog-dir', type="string", dest="commitlog_dir", default=None,
+            help="Directory to put the node commitlog in")
+        _add_cgroup_options(parser, several_nodes=False)
         return parser
 
     def validate(self, parser, options, args):
         Cmd.validate(self, parser, options, args, node_name=True, load_cluster=True, load_node=False)
 
-        if options.itfs is None and (options.thrift_itf is None or options.storage_itf is None or options.binary_itf is None):
+        self.thrift = self.storage = self.binary = None
+        if options.itfs is None and options.thrift_itf is None and options.storage_itf is None and options.binary_itf is None:
+            # leased in run
+            pass
+        elif options.itfs is None and (options.thrift_itf is None or options.storage_itf is None or options.binary_itf is None):
             print >> sys.stderr, 'Missing thrift and/or storage and/or binary protocol interfaces or jmx port'
             parser.print_help()
             exit(1)
-
-        if options.thrift_itf is None:
-            options.thrift_itf = options.itfs
-        if options.storage_itf is None:
-            options.storage_itf = options.itfs
-        if options.binary_itf is None:
-            options.binary_itf = options.itfs
-
-        self.thrift = common.parse_interface(options.thrift_itf, 9160)
-        self.storage = common.parse_interface(options.storage_itf, 7000)
-        self.binary = common.parse_interface(options.binary_itf, 9042)
-
-        if self.binary[0] != self.thrift[0]:
-            print >> sys.stderr, 'Cannot set a binary address different from the thrift one'
-            exit(1)
+        else:
+            if options.thrift_itf is None:
+                options.thrift_itf = options.itfs
+            if options.storage_itf is None:
+                options.storage_itf = options.itfs
+            if options.binary_itf is None:
+                options.binary_itf = options.itfs
+
+            self.thrift = common.parse_interface(options.thrift_itf, 9160)
+            self.storage = common.parse_interface(options.storage_itf, 7000)
+            self.binary = common.parse_interface(options.binary_itf, 9042)
+
+            if self.binary[0] != self.thrift[0]:
+                print >> sys.stderr, 'Cannot set a binary address different from the thrift one'
+                exit(1)
 
 
         self.jmx_port = options.jmx_port
@@ -188,7 +278,21 @@ class ClusterAddCmd(Cmd):
 
     def run(self):
         try:
+            # lease whatever wasn't set from the host-wide allocator
+            missing_ports = [ p for p in ('jmx_port', 'remote_debug_port') if getattr(self, p) is None ]
+            if self.thrift is None or missing_ports:
+                path = self.cluster.get_path()
+                addresses, ports = allocator.lease(path, path, addresses=1 if self.thrift is None else 0, ports=len(missing_ports))
+                if self.thrift is None:
+                    self.thrift, self.storage, self.binary = (addresses[0], 9160), (addresses[0], 7000), (addresses[0], 9042)
+                for p, port in zip(missing_ports, ports):
+                    setattr(self, p, str(port))
             node = Node(self.name, self.cluster, self.options.boostrap, self.thrift, self.storage, self.jmx_port, self.remote_debug_port, self.initial_token, binary_interface=self.binary)
+            if self.options.data_dirs or self.options.commitlog_dir:
+                node.set_data_directories(self.options.data_dirs.split(',') if self.options.data_dirs else None, self.options.commitlog_dir)
+            cgroup_limits = _parse_cgroup_options(self.options)
+            if cgroup_limits:
+                node.set_cgroup_limits(**cgroup_limits)
             self.cluster.add(node, self.options.is_seed, self.options.data_center)
         except common.ArgumentError as e:
             print >> sys.stderr, str(e)
@@ -207,8 +311,16 @@ class ClusterPopulateCmd(Cmd):
             help="Enable remote debugging options", default=False)
         parser.add_option('--vnodes', action="store_true", dest="vnodes",
             help="Populate using vnodes", default=False)
-        parser.add_option('-i', '--ipprefix', type="string", dest="ipprefix", default="127.0.0.",
-            help="Ipprefix to use to create the ip of a node")
+        parser.add_option("--balanced-vnodes", action="store_true", dest="balanced_vnodes",
+            help="With --vnodes, give the nodes evenly spread tokens instead of random ones", default=False)
+        parser.add_option('-i', '--ipprefix', type="string", dest="ipprefix", default=None,
+            help="Ipprefix to use to create the ip of a node (by default, the ips are leased from the host-wide allocator)")
+        _add_storage_options(parser)
+        _add_data_directories_options(parser)
+        _add_cgroup_options(parser)
+        _add_config_profile_option(parser)
+        parser.add_option('--fast-boot', action="store_true", dest="fast_boot", default=False,
+            help="Start the nodes skipping most of the waiting of their startup (gossip settling, ring delay, consistent range movements), unless 'ccm start --no-fast-boot'")
         return parser
 
     def validate(self, parser, options, args):
@@ -220,7 +332,16 @@ class ClusterPopulateCmd(Cmd):
             if self.cluster.version() >= "1.2" and self.options.vnodes:
                 self.cluster.set_configuration_options({ 'num_tokens' : 256 })
 
-            self.cluster.populate(self.nodes, self.options.debug, use_vnodes=self.options.vnodes, ipprefix=self.options.ipprefix)
+            if self.options.storage is not None:
+                self.cluster.set_storage(self.options.storage, self.options.storage_size)
+
+            if self.options.config_profile is not None:
+                self.cluster.set_config_profile(self.options.config_profile)
+
+            if self.options.fast_boot:
+                self.cluster.set_fast_boot()
+
+            self.cluster.populate(self.nodes, self.options.debug, use_vnodes=self.options.vnodes, balanced_vnodes=self.options.balanced_vnodes, ipprefix=self.options.ipprefix, cgroup_limits=_parse_cgroup_options(self.options), **_parse_data_directories_options(self.options))
         except common.ArgumentError as e:
             print >> sys.stderr, str(e)
             exit(1)
@@ -358,7 +479,7 @@ class ClusterSetdirCmd(Cmd):
         usage = "usage: ccm setdir [options]"
         parser =  self._get_default_parser(usage, self.description())
         parser.add_option('-v', "--cassandra-version", type="string", dest="cassandra_version",
-            help="Download and use provided cassandra version. If version is of the form 'git:<branch name>', then the specified branch will be downloaded from the git repo and compiled. (takes precedence over --cassandra-dir)", default=None)
+            help="Download and use provided cassandra version. If version is of the form 'git:<branch name>', then the specified branch will be downloaded from the git repo and compiled. If it is of the form 'binary:<version>', the binary distribution of that version is used (no compilation needed), and 'binary:<path>' uses a local prebuilt tree. (takes precedence over --cassandra-dir)", default=None)
         parser.add_option("--cassandra-dir", type="string", dest="cassandra_dir",
             help="Path to the cassandra directory to use [default %default]", default="./")
         return parser
@@ -388,6 +509,74 @@ class ClusterClearrepoCmd(Cmd):
     def run(self):
         repository.clean_all()
 
+class ClusterRepoCmd(Cmd):
+    def description(self):
+        return "List (ls) or evict least recently used (gc) entries of the repository of downloaded and compiled versions"
+
+    def get_parser(self):
+        usage = "usage: ccm repo [options] ls|gc"
+        parser = self._get_default_parser(usage, self.description())
+        parser.add_option('--max-size', type="int", dest="max_size", default=None,
+            help="For gc, the size (in MB) to reduce the repository to (default to 'repository_max_size_mb' in ~/.ccm/config)")
+        return parser
+
+    def validate(self, parser, options, args):
+        Cmd.validate(self, parser, options, args)
+        if len(args) != 1 or args[0] not in ('ls', 'gc'):
+            parser.print_help()
+            exit(1)
+        self.action = args[0]
+        self.max_size = options.max_size
+        if self.action == 'gc' and self.max_size is None:
+            self.max_size = common.get_config().get('repository_max_size_mb')
+            if self.max_size is None:
+                print >> sys.stderr, "No size to reduce the repository to (use --max-size or set 'repository_max_size_mb' in ~/.ccm/config)"
+                exit(1)
+
+    def run(self):
+        config_dirs = [ self.path, common.get_default_path() ]
+        if self.action == 'gc':
+            removed = repository.evict(int(self.max_size) * 1024 * 1024, config_dirs=config_dirs, verbose=True)
+            print "Removed %d entries (%.1fMB)" % (len(removed), float(sum(e['size'] for e in removed)) / (1024 * 1024))
+            return
+        entries = repository.entries(config_dirs)
+        for entry in reversed(entries):
+            print "%-60s %10.1fMB  %s%s" % (entry['name'], float(entry['size']) / (1024 * 1024), time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['last_used'])), '  (in use)' if entry['in_use'] else '')
+        print "Total: %.1fMB" % (float(sum(e['size'] for e in entries)) / (1024 * 1024))
+
+class ClusterPrefetchCmd(Cmd):
+    def description(self):
+        return "Download and compile several cassandra versions concurrently"
+
+    def get_parser(self):
+        usage = "usage: ccm prefetch [options] version [version ...]"
+        parser = self._get_default_parser(usage, self.description())
+        parser.add_option('-d', '--downloads', type="int", dest="downloads", default=repository.PREFETCH_DOWNLOADS,
+            help="Number of versions to download at a time (default %d)" % repository.PREFETCH_DOWNLOADS)
+        parser.add_option('-b', '--builds', type="int", dest="builds", default=repository.PREFETCH_BUILDS,
+            help="Number of versions to compile at a time (default %d)" % repository.PREFETCH_BUILDS)
+        parser.add_option('-q', '--quiet', action="store_true", dest="quiet", default=False,
+            help="Don't display the progress")
+        return parser
+
+    def validate(self, parser, options, args):
+        Cmd.validate(self, parser, options, args)
+        if len(args) == 0:
+            parser.print_help()
+            exit(1)
+        if options.downloads < 1 or options.builds < 1:
+            print >> sys.stderr, "The number of downloads and builds at a time must be positive"
+            exit(1)
+        self.versions = args
+
+    def run(self):
+        failures = repository.prefetch(self.versions, self.options.downloads, self.options.builds, verbose=not self.options.quiet)
+        for version in self.versions:
+            if version in failures:
+                print >> sys.stderr, "Could not set up %s: %s" % (version, failures[version])
+        if failures:
+            exit(1)
+
 class ClusterStartCmd(Cmd):
     def description(self):
         return "Start all the non started nodes of the current cluster"
@@ -405,6 +594,10 @@ class ClusterStartCmd(Cmd):
             help="Start the nodes with yourkit agent (only valid with -s)", default=False)
         parser.add_option('--profile-opts', type="string", action="store", dest="profile_options",
             help="Yourkit options when profiling", default=None)
+        parser.add_option('--fast-boot', action="store_true", dest="fast_boot", default=None,
+            help="Skip most of the waiting of the nodes startup (gossip settling, ring delay, consistent range movements): for test clusters only")
+        parser.add_option('--no-fast-boot', action="store_false", dest="fast_boot",
+            help="Start the nodes normally, even if the cluster was populated with --fast-boot")
         return parser
 
     def validate(self, parser, options, args):
@@ -417,7 +610,7 @@ class ClusterStartCmd(Cmd):
                 profile_options = {}
                 if self.options.profile_options:
                     profile_options['options'] = self.options.profile_options
-            if self.cluster.start(no_wait=self.options.no_wait, verbose=self.options.verbose, jvm_args=self.options.jvm_args, profile_options=profile_options) is None:
+            if self.cluster.start(no_wait=self.options.no_wait, verbose=self.options.verbose, jvm_args=self.options.jvm_args, profile_options=profile_options, fast_boot=self.options.fast_boot) is None:
                 details = ""
                 if not self.options.verbose:
                     details = " (you can use --verbose for more information)"
@@ -618,21 +811,79 @@ class ClusterBulkloadCmd(Cmd):
     def run(self):
         self.cluster.bulkload(self.loader_options)
 
-class ClusterScrubCmd(Cmd):
+def _add_offline_tool_options(parser):
+    parser.add_option('--max-down', type="int", dest="max_down", default=None,
+        help="Maximum number of nodes to stop at the same time (all nodes by default)")
+    parser.add_option('--show-output', action="store_true", dest="show_output", default=False,
+        help="Print the output of the tool for every node (it is always printed on failure)")
+
+class _ClusterOfflineToolCmd(Cmd):
+    def get_parser(self):
+        parser = self._get_default_parser(self.usage, self.description(), ignore_unknown_options=True)
+        _add_offline_tool_options(parser)
+        return parser
+
     def description(self):
-        return "Scrub files"
+        return self.descr_text
+
+    def validate(self, parser, options, args):
+        Cmd.validate(self, parser, options, args, load_cluster=True)
+        self.tool_options = parser.get_ignored() + args
+
+    def run(self):
+        try:
+            summary = self.cluster.run_offline_tool(self.tool, self.tool_options, max_down=self.options.max_down, verbose=self.options.show_output)
+        except NodeError as e:
+            print >> sys.stderr, str(e)
+            exit(1)
+        if [ node for node, rc, _ in summary if rc != 0 ]:
+            exit(1)
+
+class ClusterScrubCmd(_ClusterOfflineToolCmd):
+    usage = "usage: ccm scrub [options] <keyspace> <cf>"
+    tool = 'sstablescrub'
+    descr_text = "Scrub files on all nodes (stopping and restarting them)"
+
+class ClusterUpgradesstablesCmd(_ClusterOfflineToolCmd):
+    usage = "usage: ccm upgradesstables [options] <keyspace> <cf>"
+    tool = 'sstableupgrade'
+    descr_text = "Upgrade sstables on all nodes (stopping and restarting them)"
+
+class ClusterSstablesplitCmd(Cmd):
+    def description(self):
+        return "Run sstablesplit on the sstables of all nodes (stopping and restarting them)"
 
     def get_parser(self):
-        usage = "usage: ccm scrub [options] <keyspace> <cf>"
-        parser = self._get_default_parser(usage, self.description(), ignore_unknown_options=True)
+        usage = "usage: ccm sstablesplit [options]"
+        parser = self._get_default_parser(usage, self.description())
+        parser.add_option('-k', '--keyspace', type="string", dest="keyspace", default=None,
+            help="The keyspace to use [use all keyspaces by default]")
+        parser.add_option('-c', '--column-families', type="string", dest='cfs', default=None,
+            help="Comma separated list of column families to use (requires -k to be set)")
+        parser.add_option('-s', '--size', type='int', dest="size", default=None,
+            help="Maximum size in MB for the output sstables (default: 50 MB)")
+        parser.add_option('-j', '--jobs', type='int', dest="jobs", default=None,
+            help="Number of sstables to split at a time across the nodes being split (default: half the number of cores)")
+        _add_offline_tool_options(parser)
         return parser
 
     def validate(self, parser, options, args):
         Cmd.validate(self, parser, options, args, load_cluster=True)
-        self.scrub_options = parser.get_ignored() + args
+        self.column_families = None
+        if options.cfs is not None:
+            if options.keyspace is None:
+                print >> sys.stderr, "You need a keyspace (option -k) if you specify column families"
+                exit(1)
+            self.column_families = options.cfs.split(',')
 
     def run(self):
-        self.cluster.scrub(self.scrub_options)
+        try:
+            summary = self.cluster.sstablesplit(self.options.keyspace, self.column_families, self.options.size, max_down=self.options.max_down, max_workers=self.options.jobs, verbose=self.options.show_output)
+        except NodeError as e:
+            print >> sys.stderr, str(e)
+            exit(1)
+        if [ node for node, rc, _ in summary if rc != 0 ]:
+            exit(1)
 
 class ClusterSetlogCmd(Cmd):
     def description(self):
@@ -661,3 +912,161 @@ class ClusterSetlogCmd(Cmd):
         except common.ArgumentError as e:
             print >> sys.stderr, str(e)
             exit(1)
+
+class ClusterCensusCmd(Cmd):
+    def description(self):
+        return "Estimate distinct partitions and sstables per key for all nodes (using sstable2json -e)"
+
+    def get_parser(self):
+        usage = "usage: ccm census [options]"
+        parser = self._get_default_parser(usage, self.description())
+        parser.add_option('-k', '--keyspace', type="string", dest="keyspace", default=None,
+            help="The keyspace to use [use all keyspaces by default]")
+        parser.add_option('-c', '--column-families', type="string", dest="cfs", default=None,
+            help="Comma separated list of column families to use (requires -k to be set)")
+        parser.add_option('-j', '--jobs', type="int", dest="jobs", default=None,
+            help="Maximum number of sstables to enumerate concurrently (default: half the number of cores)")
+        return parser
+
+    def validate(self, parser, options, args):
+        Cmd.validate(self, parser, options, args, load_cluster=True)
+        self.column_families = None
+        if options.cfs is not None:
+            if options.keyspace is None:
+                print >> sys.stderr, "You need a keyspace specified (option -k) if you specify column families"
+                exit(1)
+            self.column_families = options.cfs.split(',')
+
+    def run(self):
+        try:
+            report = self.cluster.key_census(self.options.keyspace, self.column_families, self.options.jobs)
+        except common.CCMError as e:
+            print >> sys.stderr, str(e)
+            exit(1)
+        for table in sorted(report.keys()):
+            total, nodes = report[table]
+            distinct = total.distinct()
+            print "%s: ~%d distinct partitions, %d sstables, %d keys read" % (table, distinct, total.sstables, total.keys)
+            for name in sorted(nodes.keys()):
+                node_census = nodes[name]
+                node_distinct = node_census.distinct()
+                share = 100.0 * node_distinct / distinct if distinct > 0 else 0.0
+                print "  %s: ~%d distinct partitions (%.1f%% of the table), %d sstables, %.2f sstables per key" % (name, node_distinct, share, node_census.sstables, node_census.sstables_per_key())
+                distribution = " ".join("%d:%.1f%%" % (c, 100 * f) for c, f in node_census.sample.distribution())
+                if distribution:
+                    print "    sstables per key: %s" % distribution
+            top = total.top.top()
+            if top:
+                print "  most duplicated keys: %s" % ", ".join("%s (%d)" % kv for kv in top)
+
+class ClusterCheckreplicasCmd(Cmd):
+    def description(self):
+        return "Compare the data of the replicas of each token range and print the divergent ranges"
+
+    def get_parser(self):
+        usage = "usage: ccm checkreplicas [options] keyspace"
+        parser = self._get_default_parser(usage, self.description())
+        parser.add_option('-c', '--column-families', type="string", dest="cfs", default=None,
+            help="Comma separated list of column families to check [all by default]")
+        parser.add_option('-r', '--replication-factor', type="int", dest="rf", default=None,
+            help="Replication factor of the keyspace (SimpleStrategy placement is assumed) [default: min(3, number of nodes)]")
+        parser.add_option('--depth', type="int", dest="depth", default=10,
+            help="Depth of the Merkle tree built for each token range [default %default]")
+        parser.add_option('--no-flush', action="store_false", dest="flush", default=True,
+            help="Don't flush the running nodes before reading their sstables")
+        parser.add_option('-j', '--jobs', type="int", dest="jobs", default=None,
+            help="Maximum number of sstables to export concurrently (default: half the number of cores)")
+        return parser
+
+    def validate(self, parser, options, args):
+        Cmd.validate(self, parser, options, args, load_cluster=True)
+        if len(args) == 0:
+            print >> sys.stderr, 'Missing keyspace'
+            parser.print_help()
+            exit(1)
+        self.keyspace = args[0]
+        self.column_families = options.cfs.split(',') if options.cfs is not None else None
+
+    def run(self):
+        try:
+            divergent = self.cluster.check_replicas(self.keyspace, self.column_families, self.options.rf, self.options.depth, self.options.flush, self.options.jobs)
+        except (common.CCMError, ValueError) as e:
+            print >> sys.stderr, str(e)
+            exit(1)
+        if not divergent:
+            print "All replicas are in sync"
+            return
+        for table, first, last, replicas in divergent:
+            print "%s.%s: (%d, %d] differs between %s" % (self.keyspace, table, first, last, ", ".join(replicas))
+        exit(1)
+
+class _ClusterPageCacheCmd(Cmd):
+    def get_parser(self):
+        parser = self._get_default_parser(self.usage, self.description())
+        parser.add_option('-k', '--keyspace', type="string", dest="keyspace", default=None,
+            help="The keyspace to use [use all keyspaces by default]")
+        parser.add_option('-c', '--column-families', type="string", dest="cfs", default=None,
+            help="Comma separated list of column families to use (requires -k to be set)")
+        self.add_options(parser)
+        return parser
+
+    def add_options(self, parser):
+        pass
+
+    def validate(self, parser, options, args):
+        Cmd.validate(self, parser, options, args, load_cluster=True)
+        self.column_families = None
+        if options.cfs is not None:
+            if options.keyspace is None:
+                print >> sys.stderr, "You need a keyspace specified (option -k) if you specify column families"
+                exit(1)
+            self.column_families = options.cfs.split(',')
+
+    def run(self):
+        try:
+            self.run_on_cluster()
+        except (common.CCMError, OSError) as e:
+            print >> sys.stderr, str(e)
+            exit(1)
+
+class ClusterWarmupCmd(_ClusterPageCacheCmd):
+    usage = "usage: ccm warmup [options]"
+
+    def description(self):
+        return "Read the sstables of all nodes into the OS page cache"
+
+    def add_options(self, parser):
+        parser.add_option('-b', '--budget', type="int", dest="budget", default=None,
+            help="Maximum number of MB to read, split evenly between the nodes (no limit by default)")
+        parser.add_option('-j', '--jobs', type="int", dest="jobs", default=None,
+            help="Maximum number of files to read concurrently on each node (default: half the number of cores)")
+
+    def run_on_cluster(self):
+        budget = self.options.budget * 1024 * 1024 if self.options.budget is not None else None
+        start = time.time()
+        read = self.cluster.warmup(self.options.keyspace, self.column_families, budget, self.options.jobs)
+        print "Read %.1fMB in %.1fs" % (float(read) / (1024 * 1024), time.time() - start)
+
+class ClusterDropcacheCmd(_ClusterPageCacheCmd):
+    usage = "usage: ccm dropcache [options]"
+
+    def description(self):
+        return "Evict the sstables of all nodes from the OS page cache (does not require root)"
+
+    def run_on_cluster(self):
+        self.cluster.drop_page_cache(self.options.keyspace, self.column_families)
+
+class ClusterResidencyCmd(_ClusterPageCacheCmd):
+    usage = "usage: ccm residency [options]"
+
+    def description(self):
+        return "Show which fraction of the sstables of each table is in the OS page cache"
+
+    def run_on_cluster(self):
+        for node in self.cluster.nodelist():
+            print "%s:" % node.name
+            report = node.page_cache_residency(self.options.keyspace, self.column_families)
+            for table in sorted(report.keys()):
+                cached, total = report[table]
+                percent = 100.0 * cached / total if total > 0 else 0.0
+                print "  %s: %.1f%% cached (%d/%d pages)" % (table, percent, cached, total)
@@ -1,4 +1,4 @@
-import os, sys
+import os, sys, time
 from command import Cmd
 
 from ccmlib import common
@@ -23,6 +23,10 @@ def node_cmds():
         "sstablesplit",
         "decommission",
         "json",
+        "sstableinfo",
+        "warmup",
+        "dropcache",
+        "residency",
         "updateconf",
         "updatelog4j",
         "stress",
@@ -312,7 +316,7 @@ class NodeScrubCmd(Cmd):
         self.scrub_options = parser.get_ignored() + args[1:]
 
     def run(self):
-        self.node.scrub(self.scrub_options)
+        exit(self.node.scrub(self.scrub_options))
 
 class NodeJsonCmd(Cmd):
     def description(self):
@@ -351,6 +355,47 @@ class NodeJsonCmd(Cmd):
         except common.ArgumentError as e:
             print >> sys.stderr, e
 
+class NodeSstableinfoCmd(Cmd):
+    def description(self):
+        return "Print the metadata of the sstables of this node (without starting a JVM)"
+
+    def get_parser(self):
+        usage = "usage: ccm node_name sstableinfo [options] [file]"
+        parser = self._get_default_parser(usage, self.description())
+        parser.add_option('-k', '--keyspace', type="string", dest="keyspace", default=None,
+            help="The keyspace to use [use all keyspaces by default]")
+        parser.add_option('-c', '--column-families', type="string", dest="cfs", default=None,
+            help="Comma separated list of column families to use (requires -k to be set)")
+        return parser
+
+    def validate(self, parser, options, args):
+        Cmd.validate(self, parser, options, args, node_name=True, load_cluster=True)
+        self.keyspace = options.keyspace
+        self.column_families = None
+        self.datafile = None
+        if len(args) > 1:
+            self.datafile = args[1]
+            if self.keyspace is None:
+                print >> sys.stderr, "You need a keyspace specified (option -k) if you specify a file"
+                exit(1)
+        elif options.cfs is not None:
+            if self.keyspace is None:
+                print >> sys.stderr, "You need a keyspace specified (option -k) if you specify column families"
+                exit(1)
+            self.column_families = options.cfs.split(',')
+
+    def run(self):
+        try:
+            all_metadata = self.node.sstable_metadata(self.keyspace, self.column_families, self.datafile)
+        except (common.ArgumentError, IOError, EOFError) as e:
+            print >> sys.stderr, str(e)
+            exit(1)
+        for metadata in sorted(all_metadata, key=lambda m: m['file']):
+            print "%s:" % os.path.basename(metadata['file'])
+            for k in sorted(metadata.keys()):
+                if k not in ('file', 'keyspace', 'table', 'component'):
+                    print "  %s=%s" % (k, metadata[k])
+
 class NodeSstablesplitCmd(Cmd):
     def description(self):
         return "Run sstablesplit on the sstables of this node"
@@ -364,6 +409,10 @@ class NodeSstablesplitCmd(Cmd):
                           help="Comma seperated list of column families ut use (requires -k to be set)")
         parser.add_option('-s', '--size', type='int', dest="size", default=None,
                           help="Maximum size in MB for the output sstables (default: 50 MB)")
+        parser.add_option('-j', '--jobs', type='int', dest="jobs", default=None,
+                          help="Maximum number of sstablesplit to run concurrently (default: half the number of cores)")
+        parser.add_option('-v', '--verbose', action="store_true", dest="verbose", default=False,
+                          help="Print the output of sstablesplit for every sstable (it is always printed on failure)")
         return parser
 
     def validate(self, parser, options, args):
@@ -380,13 +429,15 @@ class NodeSstablesplitCmd(Cmd):
                 if self.keyspace is None:
                     print >> sys.stderr, "You need a keyspace (option -k) if you specify column families"
                     exit(1)
-                    self.column_families = options.cfs.split(',')
+                self.column_families = options.cfs.split(',')
 
     def run(self):
         if self.datafile is not None:
-            self.node.run_sstablesplit(datafile=self.datafile, size=self.size)
+            results = self.node.run_sstablesplit(datafile=self.datafile, size=self.size, max_workers=self.options.jobs, verbose=self.options.verbose)
         else:
-            self.node.run_sstablesplit(keyspace=self.keyspace, column_families=self.column_families, size=self.size)
+            results = self.node.run_sstablesplit(keyspace=self.keyspace, column_families=self.column_families, size=self.size, max_workers=self.options.jobs, verbose=self.options.verbose)
+        if [ f for f, rc in results if rc != 0 ]:
+            exit(1)
 
 class NodeUpdateconfCmd(Cmd):
     def description(self):
@@ -507,7 +558,7 @@ class NodeSetdirCmd(Cmd):
         usage = "usage: ccm node_name setdir [options]"
         parser =  self._get_default_parser(usage, self.description())
         parser.add_option('-v', "--cassandra-version", type="string", dest="cassandra_version",
-            help="Download and use provided cassandra version. If version is of the form 'git:<branch name>', then the specified branch will be downloaded from the git repo and compiled. (takes precedence over --cassandra-dir)", default=None)
+            help="Download and use provided cassandra version. If version is of the form 'git:<branch name>', then the specified branch will be downloaded from the git repo and compiled. If it is of the form 'binary:<version>', the binary distribution of that version is used (no compilation needed), and 'binary:<path>' uses a local prebuilt tree. (takes precedence over --cassandra-dir)", default=None)
         parser.add_option("--cassandra-dir", type="string", dest="cassandra_dir",
             help="Path to the cassandra directory to use [default %default]", default="./")
         return parser
@@ -521,3 +572,72 @@ class NodeSetdirCmd(Cmd):
         except common.ArgumentError as e:
             print >> sys.stderr, str(e)
             exit(1)
+
+class _NodePageCacheCmd(Cmd):
+    def get_parser(self):
+        parser = self._get_default_parser(self.usage, self.description())
+        parser.add_option('-k', '--keyspace', type="string", dest="keyspace", default=None,
+            help="The keyspace to use [use all keyspaces by default]")
+        parser.add_option('-c', '--column-families', type="string", dest="cfs", default=None,
+            help="Comma separated list of column families to use (requires -k to be set)")
+        self.add_options(parser)
+        return parser
+
+    def add_options(self, parser):
+        pass
+
+    def validate(self, parser, options, args):
+        Cmd.validate(self, parser, options, args, node_name=True, load_cluster=True)
+        self.column_families = None
+        if options.cfs is not None:
+            if options.keyspace is None:
+                print >> sys.stderr, "You need a keyspace specified (option -k) if you specify column families"
+                exit(1)
+            self.column_families = options.cfs.split(',')
+
+    def run(self):
+        try:
+            self.run_on_node()
+        except (common.CCMError, OSError) as e:
+            print >> sys.stderr, str(e)
+            exit(1)
+
+class NodeWarmupCmd(_NodePageCacheCmd):
+    usage = "usage: ccm node_name warmup [options]"
+
+    def description(self):
+        return "Read the sstables of this node into the OS page cache"
+
+    def add_options(self, parser):
+        parser.add_option('-b', '--budget', type="int", dest="budget", default=None,
+            help="Maximum number of MB to read (no limit by default)")
+        parser.add_option('-j', '--jobs', type="int", dest="jobs", default=None,
+            help="Maximum number of files to read concurrently (default: half the number of cores)")
+
+    def run_on_node(self):
+        budget = self.options.budget * 1024 * 1024 if self.options.budget is not None else None
+        start = time.time()
+        read = self.node.warmup(self.options.keyspace, self.column_families, budget, self.options.jobs)
+        print "Read %.1fMB in %.1fs" % (float(read) / (1024 * 1024), time.time() - start)
+
+class NodeDropcacheCmd(_NodePageCacheCmd):
+    usage = "usage: ccm node_name dropcache [options]"
+
+    def description(self):
+        return "Evict the sstables of this node from the OS page cache (does not require root)"
+
+    def run_on_node(self):
+        self.node.drop_page_cache(self.options.keyspace, self.column_families)
+
+class NodeResidencyCmd(_NodePageCacheCmd):
+    usage = "usage: ccm node_name residency [options]"
+
+    def description(self):
+        return "Show which fraction of the sstables of each table is in the OS page cache"
+
+    def run_on_node(self):
+        report = self.node.page_cache_residency(self.options.keyspace, self.column_families)
+        for table in sorted(report.keys()):
+            cached, total = report[table]
+            percent = 100.0 * cached / total if total > 0 else 0.0
+            print "%s: %.1f%% cached (%d/%d pages)" % (table, percent, cached, total)
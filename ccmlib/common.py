@@ -2,7 +2,7 @@
 # Cassandra Cluster Management lib
 #
 
-import os, common, shutil, re, cluster, socket, stat, yaml
+import os, common, shutil, re, cluster, repository, allocator, socket, stat, yaml, sys, time, threading, multiprocessing, contextlib
 
 USER_HOME = os.path.expanduser('~')
 
@@ -18,6 +18,13 @@ CASSANDRA_SH = "cassandra.in.sh"
 
 CONFIG_FILE = "config"
 
+# Default fraction of the host memory the heaps of all the nodes running on
+# the host may use (see 'heap_fraction' in ~/.ccm/config)
+HEAP_FRACTION = 0.5
+# How long (in seconds) the nodes admitted by heap_admission get to show up
+# in /proc before other nodes are admitted
+HEAP_ADMISSION_SETTLE_TIME = 30
+
 class CCMError(Exception):
     pass
 
@@ -30,6 +37,9 @@ class ArgumentError(CCMError):
 class UnavailableSocketError(CCMError):
     pass
 
+class InsufficientMemoryError(CCMError):
+    pass
+
 def get_default_path():
     default_path = os.path.join(USER_HOME, '.ccm')
     if not os.path.exists(default_path):
@@ -54,6 +64,14 @@ def parse_interface(itf, default_port):
     else:
         raise ValueError("Invalid interface definition: " + itf)
 
+def parse_version(version):
+    """
+    Returns version (e.g. '2.1.0-beta1') as a tuple of ints (e.g. (2, 1, 0)),
+    for comparisons that don't order '10.0' before '4.0'.
+    """
+    m = re.match(r'\d+(\.\d+)*', str(version))
+    return tuple(int(n) for n in m.group(0).split('.')) if m else ()
+
 def current_cluster_name(path):
     try:
         with open(os.path.join(path, 'CURRENT'), 'r') as f:
@@ -114,7 +132,7 @@ def replaces_or_add_into_file_tail(file, replacement_list):
 
     shutil.move(file_tmp, file)
 
-def make_cassandra_env(cassandra_dir, node_path):
+def make_cassandra_env(cassandra_dir, node_path, node_jvm=False):
     sh_file = os.path.join(CASSANDRA_BIN_DIR, CASSANDRA_SH)
     orig = os.path.join(cassandra_dir, sh_file)
     dst = os.path.join(node_path, sh_file)
@@ -135,8 +153,31 @@ def make_cassandra_env(cassandra_dir, node_path):
             f.write(append)
             f.write('\n### End Cluster wide config ###\n\n')
 
+    # Class data sharing (see repository.class_data_sharing). The archived
+    # jars must come first in the classpath for the archive to be used.
+    with open(dst, 'a') as f:
+        f.write('\nif [ -n "$CCM_CDS_OPTS" ]; then\n')
+        f.write('    JVM_OPTS="$JVM_OPTS $CCM_CDS_OPTS"\n')
+        f.write('fi\n')
+        f.write('if [ -n "$CCM_CDS_CLASSPATH" ]; then\n')
+        f.write('    CLASSPATH="$CCM_CDS_CLASSPATH:$CLASSPATH"\n')
+        f.write('fi\n')
+
     env = os.environ.copy()
     env['CASSANDRA_INCLUDE'] = os.path.join(dst)
+    # the node JVM records the classes to archive, the tools (nodetool,
+    # sstable2json, ...) only use the archive once there is one
+    cds = repository.class_data_sharing(cassandra_dir, record=node_jvm)
+    if cds is not None:
+        options, classpath = cds
+        if classpath:
+            env['CCM_CDS_CLASSPATH'] = ":".join(classpath)
+        if node_jvm:
+            env['CCM_CDS_OPTS'] = " ".join(options)
+        else:
+            env['CCM_JAVA'] = repository.java_executable()
+            env['CCM_CDS_TOOL_OPTS'] = " ".join(options)
+            env['JAVA_HOME'] = repository.cds_java_home()
     return env
 
 def get_stress_bin(cassandra_dir):
@@ -186,6 +227,20 @@ def check_socket_available(itf):
         addr, port = itf
         raise UnavailableSocketError("Inet address %s:%s is not available: %s" % (addr, port, msg))
 
+def check_sockets_available(itfs):
+    """
+    Checks that all of itfs can be bound, and raises an UnavailableSocketError
+    listing all of those that can't.
+    """
+    errors = []
+    for itf in itfs:
+        try:
+            check_socket_available(itf)
+        except UnavailableSocketError as e:
+            errors.append(str(e))
+    if errors:
+        raise UnavailableSocketError("\n".join(errors))
+
 def parse_settings(args):
     settings = {}
     for s in args:
@@ -215,3 +270,214 @@ def copy_file(src_file, dst_file):
         print >> sys.stderr, str(e)
         exit(1)
 
+
+def default_parallelism():
+    return max(1, multiprocessing.cpu_count() // 2)
+
+def free_space(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+def host_memory():
+    """
+    Returns the total memory of the host, in bytes.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def heap_budget(memory=None):
+    """
+    Returns how much memory (in bytes) the heaps of all the nodes running on
+    the host may use: 'heap_fraction' (in ~/.ccm/config) of its memory, or
+    of memory (in bytes) if provided.
+    """
+    return int(float(get_config().get('heap_fraction', HEAP_FRACTION)) * (memory or host_memory()))
+
+def running_cassandra_heaps():
+    """
+    Returns a (pid, maximum heap size in bytes, pid file) triple for each
+    cassandra node running on the host, whatever its cluster (or user). The
+    pid file is None if the node wasn't started with one.
+    """
+    nodes = []
+    if not os.path.isdir('/proc'):
+        return nodes
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', pid, 'cmdline')) as f:
+                args = f.read().split('\0')
+        except IOError:
+            continue
+        if 'org.apache.cassandra.service.CassandraDaemon' not in args:
+            continue
+        # the JVM default, unless set (the last setting wins)
+        heap = host_memory() // 4
+        pidfile = None
+        for arg in args:
+            if arg.startswith('-Xmx'):
+                heap = __parse_jvm_size(arg[len('-Xmx'):])
+            elif arg.startswith('-Dcassandra-pidfile='):
+                pidfile = arg[len('-Dcassandra-pidfile='):]
+        nodes.append((int(pid), heap, pidfile))
+    return nodes
+
+def __parse_jvm_size(size):
+    units = { 'k' : 1024, 'm' : 1024 ** 2, 'g' : 1024 ** 3, 't' : 1024 ** 4 }
+    if size[-1:].lower() in units:
+        return int(size[:-1]) * units[size[-1].lower()]
+    return int(size)
+
+def check_heap_available(required, timeout=0):
+    """
+    Checks that required more bytes of heap keep the heaps of the nodes
+    running on the host within the heap_budget, waiting up to timeout
+    seconds for some of them to stop if not. Raises InsufficientMemoryError
+    if they don't.
+    """
+    budget = heap_budget()
+    deadline = time.time() + timeout
+    while True:
+        used = sum(heap for _, heap, _ in running_cassandra_heaps())
+        if used + required <= budget:
+            return
+        if time.time() >= deadline:
+            raise InsufficientMemoryError("Not enough memory: the nodes running on this host already use %dMB of heap, %dMB more would exceed the %dMB budget (see 'heap_fraction' in ~/.ccm/config)"
+                    % (used // (1024 * 1024), required // (1024 * 1024), budget // (1024 * 1024)))
+        time.sleep(1)
+
+@contextlib.contextmanager
+def heap_admission(required):
+    """
+    Checks that required more bytes of heap are available (see
+    check_heap_available, waiting up to 'heap_admission_timeout' seconds in
+    ~/.ccm/config), and keeps other ccm processes from admitting nodes until
+    the JVMs started in the with block show up in /proc. Does nothing if
+    required is 0.
+    """
+    if not required:
+        yield
+        return
+    with allocator.host_lock('heap-admission'):
+        before = set(pid for pid, _, _ in running_cassandra_heaps())
+        check_heap_available(required, timeout=float(get_config().get('heap_admission_timeout', 0)))
+        yield
+        if not os.path.isdir('/proc'):
+            return
+        deadline = time.time() + HEAP_ADMISSION_SETTLE_TIME
+        while time.time() < deadline:
+            if sum(heap for pid, heap, _ in running_cassandra_heaps() if pid not in before) >= required:
+                return
+            time.sleep(0.5)
+
+def parallel_map(function, items, max_workers=None):
+    """
+    Return [ function(i) for i in items ], computed from a pool of at most
+    max_workers threads (default to half the number of cores). If function
+    raises, the first exception is re-raised once all items have been processed.
+    """
+    if max_workers is None:
+        max_workers = default_parallelism()
+    items = list(items)
+    results = [ None ] * len(items)
+    errors = []
+    indexes = iter(xrange(0, len(items)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                i = next(indexes, None)
+            if i is None:
+                return
+            try:
+                results[i] = function(items[i])
+            except Exception as e:
+                errors.append(e)
+
+    threads = [ threading.Thread(target=worker) for i in xrange(0, min(max_workers, len(items))) ]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return results
+
+def run_largest_first(function, files, max_workers=None, headroom=None, progress=None):
+    """
+    Call function(file) for all the provided files from a pool of at most
+    max_workers threads, starting with the largest files.
+      - headroom: if not None, a file is only started when the total size of
+        the files being processed (this one included) fits in that many bytes.
+        The largest pending file that fits is picked first, and a file that
+        can never fit is run alone.
+      - progress: if not None, called with (file, size, elapsed, result, done, total)
+        each time a file has been processed.
+    Returns the list of (file, result) pairs in completion order. If function
+    raises for some file, the first such exception is re-raised once all the
+    other files have been processed.
+    """
+    if max_workers is None:
+        max_workers = default_parallelism()
+    pending = sorted(((os.path.getsize(f), f) for f in files), reverse=True)
+    total = len(pending)
+    results = []
+    errors = []
+    state = { 'running' : 0, 'reserved' : 0 }
+    cond = threading.Condition()
+
+    def next_file():
+        # Must be called with cond held. Returns None when nothing can be started yet.
+        if state['running'] >= max_workers:
+            return None
+        for i, (size, f) in enumerate(pending):
+            if headroom is None or state['reserved'] + size <= headroom or state['running'] == 0:
+                del pending[i]
+                state['running'] += 1
+                state['reserved'] += size
+                return (size, f)
+        return None
+
+    def worker():
+        while True:
+            with cond:
+                job = next_file()
+                while job is None:
+                    if not pending:
+                        return
+                    cond.wait()
+                    job = next_file()
+            size, f = job
+            start = time.time()
+            result = None
+            try:
+                result = function(f)
+            except Exception as e:
+                errors.append(e)
+            elapsed = time.time() - start
+            with cond:
+                state['running'] -= 1
+                state['reserved'] -= size
+                results.append((f, result))
+                if progress is not None:
+                    progress(f, size, elapsed, result, len(results), total)
+                cond.notify_all()
+
+    threads = [ threading.Thread(target=worker) for i in xrange(0, min(max_workers, total)) ]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return results
@@ -0,0 +1,192 @@
+# replica divergence checking
+#
+# Exports the partitions of every node (through sstable2json), hashes them
+# into one Merkle tree per token range and replica, and compares the trees of
+# the replicas of each range to find the sub-ranges on which they diverge.
+from __future__ import with_statement
+
+import os, json, hashlib, bisect, subprocess, threading
+import common, sstable, tokens
+
+def export_partitions(cassandra_dir, env, datafile):
+    """
+    Yields the (hex key, row) pairs exported by sstable2json for datafile,
+    where row is a dictionary with a list of 'cells' and, if the partition is
+    deleted, a 'deletion' timestamp.
+    """
+    sstable2json = os.path.join(cassandra_dir, 'bin', 'sstable2json')
+    with open(os.devnull, 'w') as devnull:
+        p = subprocess.Popen([ sstable2json, datafile ], env=env, stdout=subprocess.PIPE, stderr=devnull)
+        for line in iter(p.stdout.readline, ''):
+            line = line.strip().rstrip(',')
+            if line.startswith('{"key"'):
+                # 1.2 onwards: one {"key": ..., "columns"/"cells": [...]} object per line
+                row = json.loads(line)
+                key = row['key']
+            elif line.startswith('"'):
+                # pre-1.2: one "key": [...] or "key": {...} entry per line
+                key, row = json.loads('{%s}' % line).items()[0]
+                if isinstance(row, list):
+                    row = { 'columns' : row }
+            else:
+                continue
+            deletion = None
+            info = row.get('metadata', {}).get('deletionInfo', {})
+            if 'markedForDeleteAt' in info:
+                deletion = info['markedForDeleteAt']
+            elif 'deletedAt' in row:
+                deletion = row['deletedAt']
+            yield key, { 'cells' : row.get('cells', row.get('columns', [])), 'deletion' : deletion }
+    if p.wait() != 0:
+        raise common.CCMError("sstable2json failed on %s (exit code %d)" % (datafile, p.returncode))
+
+class _Partition():
+    """
+    The reconciled content of a partition on one node.
+    """
+    def __init__(self):
+        self.cells = {}
+        self.deletion = None
+
+    def merge(self, row):
+        if row['deletion'] is not None and row['deletion'] > self.deletion:
+            self.deletion = row['deletion']
+        for cell in row['cells']:
+            flag = cell[3] if len(cell) > 3 else None
+            name = (cell[0], cell[1]) if flag == 't' else cell[0]
+            current = self.cells.get(name)
+            # the most recent cell wins, tombstones winning ties
+            if current is None or (cell[2], flag == 'd', cell[1]) > (current[2], (current[3] if len(current) > 3 else None) == 'd', current[1]):
+                self.cells[name] = cell
+
+    def digest(self, key):
+        h = hashlib.md5(key)
+        h.update(repr(self.deletion))
+        for name in sorted(self.cells.keys()):
+            cell = self.cells[name]
+            if self.deletion is None or cell[2] > self.deletion:
+                h.update(json.dumps(cell))
+        return int(h.hexdigest(), 16)
+
+class MerkleTree():
+    """
+    A Merkle tree of depth depth over the token range (start, end] of a ring
+    starting at ring_min and of size ring_size.
+    """
+    def __init__(self, start, end, ring_min, ring_size, depth):
+        self.start = start
+        self.end = end
+        self.ring_min = ring_min
+        self.ring_size = ring_size
+        self.width = (end - start) % ring_size or ring_size
+        self.leaves = [ 0 ] * (1 << depth)
+        self.levels = None
+
+    def add(self, token, digest):
+        offset = (token - self.start - 1) % self.ring_size
+        self.leaves[offset * len(self.leaves) // self.width] ^= digest
+
+    def leaf_range(self, i):
+        n = len(self.leaves)
+        first = self.start + self.width * i // n
+        last = self.start + self.width * (i + 1) // n
+        wrap = lambda t: (t - self.ring_min) % self.ring_size + self.ring_min
+        return (wrap(first), wrap(last))
+
+    def build(self):
+        level = [ hashlib.md5(str(leaf)).digest() for leaf in self.leaves ]
+        self.levels = [ level ]
+        while len(level) > 1:
+            level = [ hashlib.md5(level[i] + level[i + 1]).digest() for i in xrange(0, len(level), 2) ]
+            self.levels.insert(0, level)
+        return self
+
+def differences(trees):
+    """
+    Returns the indexes of the leaves on which the provided (built) trees
+    differ, only descending into the sub-trees whose hashes differ.
+    """
+    diffs = []
+    to_check = [ (0, 0) ]
+    depth = len(trees[0].levels) - 1
+    while to_check:
+        level, i = to_check.pop()
+        if len(set(t.levels[level][i] for t in trees)) == 1:
+            continue
+        if level == depth:
+            diffs.append(i)
+        else:
+            to_check += [ (level + 1, 2 * i + 1), (level + 1, 2 * i) ]
+    return sorted(diffs)
+
+def check(cluster, keyspace, column_families=None, replication_factor=None, depth=10, flush=True, max_workers=None):
+    """
+    Compares the data of the replicas of every token range of cluster for the
+    tables of keyspace (only column_families if provided). Replicas are
+    computed from the nodes initial tokens as SimpleStrategy would place
+    them, with the provided replication factor (default to min(3, number of nodes)).
+    Returns a list of (table, range start, range end, nodes) tuples for the
+    divergent sub-ranges, where nodes are the names of the replicas of the range.
+    """
+    nodes = cluster.nodelist()
+    for node in nodes:
+        if node.initial_token is None or ',' in str(node.initial_token):
+            raise common.ArgumentError("%s has no single initial token (vnodes are not supported)" % node.name)
+    partitioner = cluster.partitioner or tokens.default_partitioner(cluster.version())
+    ring_min, ring_size = tokens.ring(partitioner)
+    token_of = tokens.token_function(partitioner)
+    ring = sorted((int(node.initial_token), node) for node in nodes)
+    ring_tokens = [ t for t, _ in ring ]
+    rf = min(replication_factor or 3, len(nodes))
+
+    if flush:
+        for node in nodes:
+            if node.is_running():
+                node.flush()
+
+    # One partition map per (table, node)
+    partitions = {}
+    jobs = []
+    for node in nodes:
+        cdir = node.get_cassandra_dir()
+        env = common.make_cassandra_env(cdir, node.get_path())
+        for cf in (column_families or [ "" ]):
+            for datafile in node.get_sstables(keyspace, cf):
+                table = sstable.parse_descriptor(datafile)['table']
+                node_partitions = partitions.setdefault(table, {}).setdefault(node.name, ({}, threading.Lock()))
+                jobs.append((cdir, env, datafile, node_partitions))
+
+    def export_job(job):
+        cdir, env, datafile, (node_partitions, lock) = job
+        for key, row in export_partitions(cdir, env, datafile):
+            with lock:
+                node_partitions.setdefault(key, _Partition()).merge(row)
+
+    common.parallel_map(export_job, jobs, max_workers=max_workers)
+
+    divergent = []
+    for table in sorted(partitions.keys()):
+        # trees[(range index, node name)]
+        trees = {}
+        for i, (token, node) in enumerate(ring):
+            start = ring_tokens[i - 1]
+            for j in xrange(0, rf):
+                replica = ring[(i + j) % len(ring)][1]
+                trees[(i, replica.name)] = MerkleTree(start, token, ring_min, ring_size, depth)
+
+        for node_name, (node_partitions, _) in partitions[table].iteritems():
+            for key, partition in node_partitions.iteritems():
+                raw_key = key.decode('hex')
+                token = token_of(raw_key)
+                i = bisect.bisect_left(ring_tokens, token) % len(ring)
+                tree = trees.get((i, node_name))
+                if tree is not None:
+                    tree.add(token, partition.digest(raw_key))
+
+        for i in xrange(0, len(ring)):
+            replicas = [ ring[(i + j) % len(ring)][1].name for j in xrange(0, rf) ]
+            range_trees = [ trees[(i, name)].build() for name in replicas ]
+            for leaf in differences(range_trees):
+                first, last = range_trees[0].leaf_range(leaf)
+                divergent.append((table, first, last, replicas))
+    return divergent
@@ -1,8 +1,8 @@
 # ccm node
 from __future__ import with_statement
 
-import common, yaml, os, errno, signal, time, subprocess, shutil, sys, glob, re, stat
-import repository
+import common, yaml, os, errno, signal, time, subprocess, shutil, sys, glob, re, stat, hashlib, multiprocessing
+import repository, sstable, pagecache, profiles
 from cli_session import CliSession
 
 class Status():
@@ -20,6 +20,15 @@ class TimeoutError(Exception):
     def __init__(self, data):
         Exception.__init__(self, str(data))
 
+# The node directories that can be moved out of the node directory (see Node.set_storage)
+STORAGE_DIRS = [ 'data', 'commitlogs', 'saved_caches' ]
+
+# The smallest heap (in MB) given to a node by Node.heap_budget
+MIN_HEAP_SIZE = 256
+
+# The period (in microseconds) of the cpu.max limit of the nodes cgroups
+CGROUP_CPU_PERIOD = 100000
+
 # Groups: 1 = cf, 2 = tmp or none, 3 = suffix (Compacted or Data.db)
 _sstable_regexp = re.compile('(?P<cf>[\S]+)+-(?P<tmp>tmp-)?[\S]+-(?P<suffix>[a-zA-Z.]+)')
 
@@ -52,6 +61,12 @@ class Node():
         self.initial_token = initial_token
         self.pid = None
         self.data_center = None
+        self.storage_dir = None
+        self.storage_size = None
+        self.data_mounts = None
+        self.commitlog_mount = None
+        self.heap_size = None
+        self.cgroup_limits = None
         self.__config_options = {}
         self.__cassandra_dir = None
         self.__global_log_level = None
@@ -91,6 +106,15 @@ class Node():
                 node.__config_options = data['config_options']
             if 'data_center' in data:
                 node.data_center = data['data_center']
+            if 'storage' in data:
+                node.storage_dir = data['storage']['path']
+                node.storage_size = data['storage'].get('size')
+            if 'data_mounts' in data:
+                node.data_mounts = data['data_mounts']
+            if 'commitlog_mount' in data:
+                node.commitlog_mount = data['commitlog_mount']
+            if 'cgroup' in data:
+                node.cgroup_limits = data['cgroup']
             return node
         except KeyError as k:
             raise common.LoadError("Error Loading " + filename + ", missing property: " + str(k))
@@ -138,7 +162,7 @@ class Node():
             if cassandra_dir is not None:
                 common.validate_cassandra_dir(cassandra_dir)
         else:
-            dir, v = repository.setup(cassandra_version, verbose=verbose)
+            dir, v = repository.setup(cassandra_version, verbose=verbose, config_dir=os.path.dirname(self.cluster.get_path()))
             self.__cassandra_dir = dir
         self.import_config_files()
         return self
@@ -169,6 +193,167 @@ class Node():
 
         self.import_config_files()
 
+    def set_storage(self, storage='disk', size=None):
+        """
+        Set where the data, commitlogs and saved_caches directories of this
+        node are stored:
+          - 'disk': in the node directory (the default).
+          - 'tmpfs': in a RAM backed directory (the 'tmpfs_dir' of
+            ~/.ccm/config, /dev/shm by default). The node directories are then
+            symlinks to it. If size (in MB) is provided, starting the node
+            fails if there is not that much space available for the node there.
+            This is only checked at start: nothing stops the node from
+            growing past size afterwards (a size-limited tmpfs mount per node
+            would require root).
+        Existing data is moved over. The node must not be running.
+        """
+        if storage not in ('disk', 'tmpfs'):
+            raise common.ArgumentError("Unknown storage %s (use one of disk, tmpfs)" % storage)
+        if self.is_running():
+            raise NodeError("Cannot change the storage of %s while it is running" % self.name)
+        if storage != 'disk' and (self.data_mounts or self.commitlog_mount):
+            raise common.ArgumentError("%s uses explicit data or commitlog directories, it cannot be moved to %s" % (self.name, storage))
+
+        old_dir = self.storage_dir
+        new_dir = None if storage == 'disk' else self.__get_tmpfs_storage_dir()
+        if new_dir is not None and not os.path.exists(new_dir):
+            os.makedirs(new_dir)
+        for d in STORAGE_DIRS:
+            link = os.path.join(self.get_path(), d)
+            current = os.path.realpath(link)
+            target = link if new_dir is None else os.path.join(new_dir, d)
+            if current == target:
+                continue
+            if os.path.islink(link):
+                os.remove(link)
+            if os.path.exists(current):
+                shutil.move(current, target)
+            else:
+                os.mkdir(target)
+            if new_dir is not None:
+                os.symlink(target, link)
+        if old_dir is not None and old_dir != new_dir and os.path.exists(old_dir):
+            shutil.rmtree(old_dir)
+
+        self.storage_dir = new_dir
+        self.storage_size = size if new_dir is not None else None
+        self.__update_config()
+        return self
+
+    def set_data_directories(self, data_mounts=None, commitlog_mount=None):
+        """
+        Spread the sstables of this node across several directories (JBOD):
+        each of data_mounts (typically the mount points of different disks)
+        gets a <cluster>-<id>/<node>/data directory (the id telling apart
+        clusters of the same name in different config dirs) used as one of
+        the node data_file_directories. Similarly, the commitlog goes to
+        commitlog_mount/<cluster>-<id>/<node>/commitlogs if commitlog_mount
+        is provided. None reverts to the directories inside the node directory.
+        Existing data is not moved. The node must not be running.
+        """
+        if self.is_running():
+            raise NodeError("Cannot change the directories of %s while it is running" % self.name)
+        if self.storage_dir is not None and (data_mounts or commitlog_mount):
+            raise common.ArgumentError("%s is stored on tmpfs, it cannot use explicit data or commitlog directories" % self.name)
+        for mount in (data_mounts or []) + ([ commitlog_mount ] if commitlog_mount else []):
+            if not os.path.isdir(mount):
+                raise common.ArgumentError("%s is not a directory" % mount)
+
+        self.data_mounts = [ os.path.abspath(m) for m in data_mounts ] if data_mounts else None
+        self.commitlog_mount = os.path.abspath(commitlog_mount) if commitlog_mount else None
+        for d in self.get_data_directories() + [ self.get_commitlog_directory() ]:
+            if not os.path.exists(d):
+                os.makedirs(d)
+        self.__update_config()
+        self.__update_yaml()
+        return self
+
+    def get_data_directories(self):
+        """
+        Returns the list of the data_file_directories of this node.
+        """
+        if not self.data_mounts:
+            return [ os.path.join(self.get_path(), 'data') ]
+        return [ self.__mounted_directory(m, 'data') for m in self.data_mounts ]
+
+    def get_commitlog_directory(self):
+        if not self.commitlog_mount:
+            return os.path.join(self.get_path(), 'commitlogs')
+        return self.__mounted_directory(self.commitlog_mount, 'commitlogs')
+
+    def release_storage(self):
+        """
+        Delete the data of this node stored outside of its directory (see
+        set_storage and set_data_directories).
+        """
+        external = [ self.storage_dir ]
+        for mount in (self.data_mounts or []) + ([ self.commitlog_mount ] if self.commitlog_mount else []):
+            external.append(os.path.join(mount, self.__cluster_id(), self.name))
+        for d in external:
+            if d is not None and os.path.exists(d):
+                shutil.rmtree(d)
+                try:
+                    # the cluster directory, once its last node is gone
+                    os.rmdir(os.path.dirname(d))
+                except OSError:
+                    pass
+
+    def set_cgroup_limits(self, cpus=None, cpuset=None, memory=None, io=None):
+        """
+        Start this node in a cgroup (v2) of its own, limited to:
+          - cpus: a number of CPUs worth of CPU time (cpu.max), e.g. 1.5.
+          - cpuset: the CPUs it can run on (cpuset.cpus), e.g. '0-3,8'.
+          - memory: an amount of memory (memory.max), e.g. '4G'.
+          - io: the bandwidth and iops of the disks holding its data and
+            commitlog directories (io.max), e.g. 'rbps=50M wbps=50M wiops=500'.
+        Limits left to None are not set, and the node is not put in a cgroup
+        when none is. The cgroup is created under 'cgroup_root' in
+        ~/.ccm/config, that must be a cgroup v2 directory delegated to the
+        user. Takes effect at the next start.
+        """
+        limits = {}
+        if cpus is not None:
+            try:
+                limits['cpus'] = float(cpus)
+            except ValueError:
+                limits['cpus'] = 0
+            if limits['cpus'] <= 0:
+                raise common.ArgumentError("Invalid CPU limit %s, expecting a positive number of CPUs" % cpus)
+        if cpuset is not None:
+            if not re.match(r'^\d+(-\d+)?(,\d+(-\d+)?)*$', str(cpuset)):
+                raise common.ArgumentError("Invalid cpuset %s, expecting a list of CPUs like 0-3,8" % cpuset)
+            limits['cpuset'] = str(cpuset)
+        if memory is not None:
+            limits['memory'] = self.__parse_cgroup_size(memory, 'memory limit')
+        if io is not None:
+            io_limits = []
+            for limit in str(io).split():
+                key, _, value = limit.partition('=')
+                if key not in ('rbps', 'wbps', 'riops', 'wiops') or not value:
+                    raise common.ArgumentError("Invalid I/O limit %s, expecting rbps, wbps, riops or wiops=<value>" % limit)
+                io_limits.append("%s=%s" % (key, value if value == 'max' else self.__parse_cgroup_size(value, 'I/O limit')))
+            limits['io'] = ' '.join(io_limits)
+        self.cgroup_limits = limits or None
+        self.__update_config()
+        return self
+
+    def release_cgroup(self):
+        """
+        Delete the cgroup of this node (see set_cgroup_limits), if any.
+        """
+        if not self.cgroup_limits:
+            return
+        try:
+            cgroup = self.__get_cgroup()
+        except NodeError:
+            return
+        for d in (cgroup, os.path.dirname(cgroup)):
+            try:
+                # the cluster cgroup, once its last node is gone
+                os.rmdir(d)
+            except OSError:
+                pass
+
     def show(self, only_status=False, show_cluster=True):
         """
         Print infos on this node configuration.
@@ -187,6 +372,14 @@ class Node():
             print "%s%s=%s" % (indent, 'jmx_port', self.jmx_port)
             print "%s%s=%s" % (indent, 'remote_debug_port', self.remote_debug_port)
             print "%s%s=%s" % (indent, 'initial_token', self.initial_token)
+            if self.storage_dir is not None:
+                print "%s%s=%s" % (indent, 'storage', self.storage_dir)
+            if self.data_mounts:
+                print "%s%s=%s" % (indent, 'data_directories', ','.join(self.get_data_directories()))
+            if self.commitlog_mount:
+                print "%s%s=%s" % (indent, 'commitlog_directory', self.get_commitlog_directory())
+            if self.cgroup_limits:
+                print "%s%s=%s" % (indent, 'cgroup', ' '.join("%s=%s" % (k, v) for k, v in sorted(self.cgroup_limits.items())))
             if self.pid:
                 print "%s%s=%s" % (indent, 'pid', self.pid)
 
@@ -337,7 +530,10 @@ class Node():
               replace_address=None,
               jvm_args=[],
               wait_for_binary_proto=False,
-              profile_options=None):
+              profile_options=None,
+              check_sockets=True,
+              check_memory=True,
+              fast_boot=None):
         """
         Start the node. Options includes:
           - join_ring: if false, start the node with -Dcassandra.join_ring=False
@@ -347,13 +543,29 @@ class Node():
             have marked this node UP.
           - replace_token: start the node with the -Dcassandra.replace_token option.
           - replace_address: start the node with the -Dcassandra.replace_address option.
+          - check_sockets: if False, don't check that the listening_interfaces
+            are available (the caller did).
+          - check_memory: if False, don't check that the heap of the node
+            (see heap_budget) fits in the memory of the host (the caller did).
+            Otherwise, the start waits up to 'heap_admission_timeout' seconds
+            (in ~/.ccm/config, 0 by default) for other nodes to stop if it
+            doesn't, and fails if they don't.
+          - fast_boot: if True, start the node with the system properties of
+            Cluster.fast_boot_jvm_args, that skip most of the waiting of the
+            startup. If None, the cluster setting applies (see
+            Cluster.set_fast_boot).
         """
         if self.is_running():
             raise NodeError("%s is already running" % self.name)
 
-        for itf in self.network_interfaces.values():
-            if itf is not None:
-                common.check_socket_available(itf)
+        if check_sockets:
+            common.check_sockets_available(self.listening_interfaces())
+
+        self.heap_size = self.heap_budget()
+        if self.heap_size is not None:
+            self.__update_envfile()
+
+        self.__check_storage_space()
 
         if wait_other_notice:
             marks = [ (node, node.mark_log()) for node in self.cluster.nodes.values() if node.is_running() ]
@@ -379,16 +591,28 @@ class Node():
 
         os.chmod(cass_bin, os.stat(cass_bin).st_mode | stat.S_IEXEC)
 
-        env = common.make_cassandra_env(cdir, self.get_path())
+        env = common.make_cassandra_env(cdir, self.get_path(), node_jvm=True)
         pidfile = os.path.join(self.get_path(), 'cassandra.pid')
         args = [ cass_bin, '-p', pidfile, '-Dcassandra.join_ring=%s' % str(join_ring) ]
         if replace_token is not None:
             args.append('-Dcassandra.replace_token=%s' % str(replace_token))
         if replace_address is not None:
             args.append('-Dcassandra.replace_address=%s' % str(replace_address))
+        if fast_boot or (fast_boot is None and self.cluster.fast_boot):
+            args = args + self.cluster.fast_boot_jvm_args()
         args = args + jvm_args
 
-        process = subprocess.Popen(args, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        preexec_fn = None
+        if self.cgroup_limits:
+            procs = os.path.join(self.__setup_cgroup(), 'cgroup.procs')
+            def preexec_fn():
+                # moves the child to the cgroup before it execs, so that the JVM starts in it
+                with open(procs, 'w') as f:
+                    f.write(str(os.getpid()))
+
+        required = self.heap_size[0] * 1024 * 1024 if self.heap_size is not None and check_memory else 0
+        with common.heap_admission(required):
+            process = subprocess.Popen(args, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=preexec_fn)
 
         if update_pid:
             if no_wait:
@@ -415,6 +639,52 @@ class Node():
 
         return process
 
+    def heap_budget(self):
+        """
+        Returns the (MAX_HEAP_SIZE, HEAP_NEWSIZE), in MB, this node is started
+        with, or None if 'auto_heap' is false in ~/.ccm/config (in which case
+        cassandra-env.sh sizes the heap as if the node was alone on the host).
+        The nodes of the cluster share what the nodes of other clusters
+        running on the host leave of the heap budget (see common.heap_budget),
+        and the cores of the host for the young generation. The cluster
+        configuration profile (see Cluster.set_config_profile) may cap it,
+        and so does the memory limit of the node cgroup (see
+        set_cgroup_limits), of which it gets the same fraction as the nodes
+        of the host memory.
+        """
+        if not common.get_config().get('auto_heap', True):
+            return None
+        memory = common.host_memory()
+        own_pids = set(node.pid for node in self.cluster.nodes.values() if node.pid is not None)
+        others = sum(heap for pid, heap, pidfile in common.running_cassandra_heaps()
+                     if pid not in own_pids and not (pidfile or '').startswith(self.cluster.get_path() + os.sep))
+        nodes = max(1, len(self.cluster.nodes))
+        share = max(0, common.heap_budget() - others) // nodes // (1024 * 1024)
+        # what cassandra-env.sh gives a node alone on the host
+        mb = memory // (1024 * 1024)
+        alone = max(min(mb // 2, 1024), min(mb // 4, 8192))
+        heap = max(MIN_HEAP_SIZE, min(alone, share))
+        if self.cluster.config_profile is not None:
+            heap = min(heap, profiles.max_heap_size(self.cluster.config_profile) or heap)
+        if self.cgroup_limits and 'memory' in self.cgroup_limits:
+            # even below MIN_HEAP_SIZE, or the node gets killed
+            heap = min(heap, common.heap_budget(self.cgroup_limits['memory']) // (1024 * 1024))
+        # 100MB per core, like cassandra-env.sh
+        cores = max(1, multiprocessing.cpu_count() // nodes)
+        return (heap, min(100 * cores, heap // 4))
+
+    def listening_interfaces(self):
+        """
+        Returns the (address, port) pairs the node listens on once started:
+        its network interfaces, and JMX and remote debugging (on all
+        addresses).
+        """
+        itfs = [ itf for itf in self.network_interfaces.values() if itf is not None ]
+        for port in (self.jmx_port, self.remote_debug_port):
+            if port is not None and str(port) != '0':
+                itfs.append(('', int(port)))
+        return itfs
+
     def stop(self, wait=True, wait_other_notice=False, gently=True):
         """
         Stop the node.
@@ -469,10 +739,28 @@ class Node():
         p.wait()
 
     def scrub(self, options):
+        return self.run_offline_tool('sstablescrub', options)
+
+    def upgradesstables(self, options):
+        return self.run_offline_tool('sstableupgrade', options)
+
+    def run_offline_tool(self, tool, options=[], capture_output=False):
+        """
+        Run one of the Cassandra offline tools (sstablescrub, sstableupgrade,
+        ...) against the data of this node, which should not be running.
+        Returns the exit code of the tool, or a (exit code, output) pair if
+        capture_output is True (the output is printed otherwise).
+        """
         cdir = self.get_cassandra_dir()
-        scrub_bin = os.path.join(cdir, 'bin', 'sstablescrub')
+        tool_bin = os.path.join(cdir, 'bin', tool)
+        if not os.path.exists(tool_bin):
+            tool_bin = os.path.join(cdir, 'tools', 'bin', tool)
         env = common.make_cassandra_env(cdir, self.get_path())
-        os.execve(scrub_bin, [ 'sstablescrub' ] + options, env)
+        if not capture_output:
+            return subprocess.call([ tool_bin ] + options, env=env)
+        p = subprocess.Popen([ tool_bin ] + options, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+        return (p.returncode, output)
 
     def run_cli(self, cmds=None, show_output=False, cli_options=[]):
         cdir = self.get_cassandra_dir()
@@ -571,14 +859,15 @@ class Node():
         common.copy_file(new_logback_config, cassandra_conf_dir)
 
     def clear(self, clear_all = False, only_data = False):
-        data_dirs = [ 'data' ]
+        data_dirs = self.get_data_directories()
         if not only_data:
-            data_dirs = data_dirs + [ 'commitlogs']
+            data_dirs = data_dirs + [ self.get_commitlog_directory() ]
             if clear_all:
-                data_dirs = data_dirs + [ 'saved_caches', 'logs']
-        for d in data_dirs:
-            full_dir = os.path.join(self.get_path(), d)
+                data_dirs = data_dirs + [ os.path.join(self.get_path(), d) for d in [ 'saved_caches', 'logs' ] ]
+        for full_dir in data_dirs:
             if only_data:
+                if not os.path.isdir(full_dir):
+                    continue
                 for dir in os.listdir(full_dir):
                     keyspace_dir = os.path.join(full_dir, dir)
                     if os.path.isdir(keyspace_dir) and dir != "system":
@@ -587,8 +876,19 @@ class Node():
                             if os.path.isfile(full_path):
                                 os.remove(full_path)
             else:
-                shutil.rmtree(full_dir)
-                os.mkdir(full_dir)
+                # full_dir may be a symlink (see set_storage)
+                full_dir = os.path.realpath(full_dir)
+                if os.path.exists(full_dir):
+                    shutil.rmtree(full_dir)
+                    os.mkdir(full_dir)
+                else:
+                    os.makedirs(full_dir)
+        if self.storage_dir is not None:
+            # the tmpfs directories are gone after a reboot (see set_storage)
+            for d in STORAGE_DIRS:
+                target = os.path.join(self.storage_dir, d)
+                if not os.path.exists(target):
+                    os.makedirs(target)
 
     def run_sstable2json(self, keyspace=None, datafile=None, column_families=None, enumerate_keys=False):
         cdir = self.get_cassandra_dir()
@@ -604,39 +904,106 @@ class Node():
             subprocess.call(args, env=env)
             print ""
 
-    def run_sstablesplit(self, datafile=None,  size=None, keyspace=None, column_families=None):
+    def run_sstablesplit(self, datafile=None,  size=None, keyspace=None, column_families=None, max_workers=None, verbose=False):
+        """
+        Run sstablesplit on the sstables of this node. Up to max_workers splits
+        are run concurrently (default to half the number of cores), the
+        largest sstables first, and a split is only started if the data
+        directory has enough free space for its output on top of the splits
+        already running. Returns a list of (datafile, return code) pairs.
+        """
         cdir = self.get_cassandra_dir()
         sstablesplit = os.path.join(cdir, 'bin', 'sstablesplit')
         env = common.make_cassandra_env(cdir, self.get_path())
         datafiles = self.__gather_sstables(datafile, keyspace, column_families)
 
         def do_split(f):
-            print "-- {0}-----".format(os.path.basename(f))
-            if size is not None:
-                subprocess.call( [sstablesplit, '-s', str(size), f], env=env )
-            else:
-                subprocess.call( [sstablesplit, f], env=env )
+            args = [ sstablesplit, f ] if size is None else [ sstablesplit, '-s', str(size), f ]
+            p = subprocess.Popen(args, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = p.communicate()[0]
+            return (p.returncode, output)
+
+        def report(f, fsize, elapsed, result, done, total):
+            rc, output = result if result is not None else (None, "")
+            mb = float(fsize) / (1024 * 1024)
+            status = "done" if rc == 0 else "FAILED (exit code %s)" % rc
+            print "-- [%d/%d] %s: %s, %.1fMB in %.1fs (%.1fMB/s)" % (done, total, os.path.basename(f), status, mb, elapsed, mb / max(elapsed, 0.001))
+            if verbose or rc != 0:
+                for line in output.splitlines():
+                    print "   %s" % line
+
+        # splits write next to the sstable they split, so only count on the fullest directory
+        headroom = min(common.free_space(d) for d in self.get_data_directories())
+        results = common.run_largest_first(do_split, datafiles, max_workers=max_workers, headroom=headroom, progress=report)
+        return [ (f, r[0]) for f, r in results ]
+
+    def sstable_metadata(self, keyspace=None, column_families=None, datafile=None, max_workers=None):
+        """
+        Returns the metadata of the sstables of this node (all of them by
+        default), as a list of dictionaries (see sstable.read_metadata). The
+        metadata is read directly from the sstable components, without
+        starting a JVM, from up to max_workers threads (see
+        common.parallel_map for the default).
+        """
+        datafiles = self.__gather_sstables(datafile, keyspace, column_families)
+        return common.parallel_map(sstable.read_metadata, datafiles, max_workers=max_workers)
+
+    def warmup(self, keyspace=None, column_families=None, budget=None, max_workers=None):
+        """
+        Read the sstables of this node (all of them by default) so they are
+        in the OS page cache, up to budget bytes if provided. The small
+        components (index, summary, bloom filter...) are read first. Returns
+        the number of bytes read.
+        """
+        datafiles = self.__gather_sstables(None, keyspace, column_families)
+        return pagecache.warm(pagecache.sstable_files(datafiles), budget, max_workers)
 
-        for datafile in datafiles:
-            do_split(datafile)
+    def drop_page_cache(self, keyspace=None, column_families=None, max_workers=None):
+        """
+        Evict the sstables of this node (all of them by default) from the OS page cache.
+        """
+        datafiles = self.__gather_sstables(None, keyspace, column_families)
+        common.parallel_map(pagecache.drop, pagecache.sstable_files(datafiles), max_workers=max_workers)
+
+    def page_cache_residency(self, keyspace=None, column_families=None):
+        """
+        Returns a dictionary of table name ('ks.cf') to the (cached pages,
+        total pages) of the sstables of that table in the OS page cache.
+        """
+        report = {}
+        for datafile in self.__gather_sstables(None, keyspace, column_families):
+            descriptor = sstable.parse_descriptor(datafile)
+            table = "%s.%s" % (descriptor['keyspace'], descriptor['table'])
+            cached, total = report.get(table, (0, 0))
+            for f in pagecache.sstable_files([ datafile ]):
+                c, t = pagecache.residency(f)
+                cached, total = cached + c, total + t
+            report[table] = (cached, total)
+        return report
 
     def list_keyspaces(self):
-        keyspaces = os.listdir(os.path.join(self.get_path(), 'data'))
-        keyspaces.remove('system')
-        return keyspaces
+        keyspaces = set()
+        for data_dir in self.get_data_directories():
+            if os.path.exists(data_dir):
+                keyspaces.update(os.listdir(data_dir))
+        keyspaces.discard('system')
+        return sorted(keyspaces)
 
     def get_sstables(self, keyspace, column_family):
-        keyspace_dir = os.path.join(self.get_path(), 'data', keyspace)
-        if not os.path.exists(keyspace_dir):
+        keyspace_dirs = [ os.path.join(d, keyspace) for d in self.get_data_directories() ]
+        keyspace_dirs = [ d for d in keyspace_dirs if os.path.exists(d) ]
+        if not keyspace_dirs:
             raise common.ArgumentError("Unknown keyspace {0}".format(keyspace))
 
         version = self.cluster.version()
-        # data directory layout is changed from 1.1
-        if float(version[:version.index('.')+2]) < 1.1:
-            files = glob.glob(os.path.join(keyspace_dir, "{0}*-Data.db".format(column_family)))
-        else:
-            files = glob.glob(os.path.join(keyspace_dir, column_family or "*", "%s-%s*-Data.db" % (keyspace, column_family)))
-        for f in files:
+        files = []
+        for keyspace_dir in keyspace_dirs:
+            # data directory layout is changed from 1.1
+            if float(version[:version.index('.')+2]) < 1.1:
+                files += glob.glob(os.path.join(keyspace_dir, "{0}*-Data.db".format(column_family)))
+            else:
+                files += glob.glob(os.path.join(keyspace_dir, column_family or "*", "%s-%s*-Data.db" % (keyspace, column_family)))
+        for f in files[:]:
             if os.path.exists(f.replace('Data.db', 'Compacted')):
                 files.remove(f)
         return files
@@ -666,8 +1033,9 @@ class Node():
                 size += sum((os.path.getsize(path) for path in self.get_sstables(ks, "")))
         else:
             for ks in self.list_keyspaces():
-                for root, dirs, files in os.walk(os.path.join(self.get_path(), 'data', ks)):
-                    size += sum((os.path.getsize(os.path.join(root, f)) for f in files if os.path.isfile(os.path.join(root, f))))
+                for data_dir in self.get_data_directories():
+                    for root, dirs, files in os.walk(os.path.join(data_dir, ks)):
+                        size += sum((os.path.getsize(os.path.join(root, f)) for f in files if os.path.isfile(os.path.join(root, f))))
         return size
 
     def flush(self):
@@ -752,7 +1120,7 @@ class Node():
         }
         if self.pid:
             values['pid'] = self.pid
-        if self.initial_token:
+        if self.initial_token is not None:
             values['initial_token'] = self.initial_token
         if self.__cassandra_dir is not None:
             values['cassandra_dir'] = self.__cassandra_dir
@@ -760,6 +1128,14 @@ class Node():
             values['data_center'] = self.data_center
         if self.remote_debug_port:
             values['remote_debug_port'] = self.remote_debug_port
+        if self.storage_dir is not None:
+            values['storage'] = { 'path' : self.storage_dir, 'size' : self.storage_size }
+        if self.data_mounts:
+            values['data_mounts'] = self.data_mounts
+        if self.commitlog_mount:
+            values['commitlog_mount'] = self.commitlog_mount
+        if self.cgroup_limits:
+            values['cgroup'] = self.cgroup_limits
         with open(filename, 'w') as f:
             yaml.safe_dump(values, f)
 
@@ -782,8 +1158,8 @@ class Node():
         if self.network_interfaces['binary'] is not None and self.cluster.version() >= "1.2":
             _, data['native_transport_port'] = self.network_interfaces['binary']
 
-        data['data_file_directories'] = [ os.path.join(self.get_path(), 'data') ]
-        data['commitlog_directory'] = os.path.join(self.get_path(), 'commitlogs')
+        data['data_file_directories'] = self.get_data_directories()
+        data['commitlog_directory'] = self.get_commitlog_directory()
         data['saved_caches_directory'] = os.path.join(self.get_path(), 'saved_caches')
 
         if self.cluster.partitioner:
@@ -850,12 +1226,23 @@ class Node():
         remote_debug_port_pattern='address='
         conf_file = os.path.join(self.get_conf_dir(), common.CASSANDRA_ENV)
         common.replace_in_file(conf_file, jmx_port_pattern, jmx_port_pattern + self.jmx_port)
+        if self.heap_size is not None:
+            # only the top level settings, not the ones of calculate_heap_sizes
+            common.replaces_in_file(conf_file, [ ('^#?MAX_HEAP_SIZE=', 'MAX_HEAP_SIZE="%dM"' % self.heap_size[0]),
+                                                 ('^#?HEAP_NEWSIZE=', 'HEAP_NEWSIZE="%dM"' % self.heap_size[1]) ])
         if self.remote_debug_port != '0':
             common.replace_in_file(conf_file, remote_debug_port_pattern, 'JVM_OPTS="$JVM_OPTS -Xdebug -Xnoagent -Xrunjdwp:transport=dt_socket,server=y,suspend=n,address=' + str(self.remote_debug_port) + '"')
 
         if self.cluster.version() < '2.0.1':
             common.replace_in_file(conf_file, "-Xss", '    JVM_OPTS="$JVM_OPTS -Xss228k"')
 
+        profile_pattern = '^JVM_OPTS=.*# ccm config profile$'
+        if self.cluster.config_profile is not None:
+            jvm_options = ' '.join(profiles.jvm_options(self.cluster.config_profile))
+            common.replace_or_add_into_file_tail(conf_file, profile_pattern, 'JVM_OPTS="$JVM_OPTS %s" # ccm config profile' % jvm_options)
+        else:
+            common.replace_in_file(conf_file, profile_pattern, '')
+
     def __update_status(self):
         if self.pid is None:
             if self.status == Status.UP or self.status == Status.DECOMMISIONNED:
@@ -892,6 +1279,102 @@ class Node():
             dirs[i] = os.path.join(self.get_path(), i)
         return dirs
 
+    def __parse_cgroup_size(self, value, what):
+        # A number with an optional K, M or G suffix, as a number
+        m = re.match(r'^(\d+)([kKmMgG]?)$', str(value))
+        if m is None:
+            raise common.ArgumentError("Invalid %s %s, expecting a number with an optional K, M or G suffix" % (what, value))
+        return int(m.group(1)) * 1024 ** ' kmg'.index(m.group(2).lower() or ' ')
+
+    def __mounted_directory(self, mount, name):
+        return os.path.join(mount, self.__cluster_id(), self.name, name)
+
+    def __get_tmpfs_storage_dir(self):
+        root = common.get_config().get('tmpfs_dir', '/dev/shm')
+        if not os.path.isdir(root):
+            raise common.ArgumentError("tmpfs directory %s does not exist (set 'tmpfs_dir' in ~/.ccm/config)" % root)
+        # the cluster path is hashed in so that clusters in different config dirs don't collide
+        return os.path.join(root, 'ccm-%d' % os.getuid(), self.__cluster_id(), self.name)
+
+    def __cluster_id(self):
+        # the cluster path is hashed in so that clusters in different config dirs don't collide
+        return '%s-%s' % (self.cluster.name, hashlib.md5(self.cluster.get_path()).hexdigest()[:8])
+
+    def __get_cgroup(self):
+        root = common.get_config().get('cgroup_root')
+        if root is None or not os.path.exists(os.path.join(root, 'cgroup.subtree_control')):
+            raise NodeError("Cannot limit the resources of %s: set 'cgroup_root' in ~/.ccm/config to a cgroup v2 directory delegated to you "
+                            "(e.g. the cgroup of a 'systemd-run --user --scope -p Delegate=yes' unit, without processes)" % self.name)
+        return os.path.join(root, self.__cluster_id(), self.name)
+
+    def __setup_cgroup(self):
+        # (Re)creates the cgroup of the node with its limits, and returns its path
+        cgroup = self.__get_cgroup()
+        limits = self.cgroup_limits
+        try:
+            values = []
+            if 'cpus' in limits:
+                values.append(('cpu', 'cpu.max', "%d %d" % (int(limits['cpus'] * CGROUP_CPU_PERIOD), CGROUP_CPU_PERIOD)))
+            if 'cpuset' in limits:
+                values.append(('cpuset', 'cpuset.cpus', limits['cpuset']))
+            if 'memory' in limits:
+                values.append(('memory', 'memory.max', str(limits['memory'])))
+            if 'io' in limits:
+                for device in self.__block_devices():
+                    values.append(('io', 'io.max', "%s %s" % (device, limits['io'])))
+            controllers = set(v[0] for v in values)
+            if os.path.isdir(cgroup):
+                # a fresh cgroup drops the limits that were unset since
+                os.rmdir(cgroup)
+            cluster_cgroup = os.path.dirname(cgroup)
+            for parent, child in ((os.path.dirname(cluster_cgroup), cluster_cgroup), (cluster_cgroup, cgroup)):
+                with open(os.path.join(parent, 'cgroup.controllers')) as f:
+                    missing = controllers - set(f.read().split())
+                if missing:
+                    raise NodeError("Cannot limit the resources of %s: the %s controllers are not delegated to %s" % (self.name, ', '.join(sorted(missing)), parent))
+                with open(os.path.join(parent, 'cgroup.subtree_control'), 'w') as f:
+                    f.write(' '.join('+' + c for c in sorted(controllers)))
+                if not os.path.isdir(child):
+                    os.mkdir(child)
+            for controller, name, value in values:
+                # one write per line, as io.max takes one device at a time
+                with open(os.path.join(cgroup, name), 'w') as f:
+                    f.write(value)
+        except (IOError, OSError) as e:
+            raise NodeError("Cannot set up the cgroup %s of %s: %s" % (cgroup, self.name, e))
+        return cgroup
+
+    def __block_devices(self):
+        # The 'major:minor' of the disks holding the data and commitlog
+        # directories (io.max only applies to whole disks, not partitions)
+        devices = set()
+        for d in self.get_data_directories() + [ self.get_commitlog_directory() ]:
+            dev = os.stat(d).st_dev
+            if os.major(dev) == 0:
+                raise NodeError("Cannot limit the I/O of %s: %s is not on a block device" % (self.name, d))
+            device = "%d:%d" % (os.major(dev), os.minor(dev))
+            sys_dev = os.path.join('/sys/dev/block', device)
+            if os.path.exists(os.path.join(sys_dev, 'partition')):
+                with open(os.path.join(os.path.realpath(sys_dev), '..', 'dev')) as f:
+                    device = f.read().strip()
+            devices.add(device)
+        return sorted(devices)
+
+    def __check_storage_space(self):
+        if self.storage_dir is None:
+            return
+        if not os.path.isdir(self.storage_dir):
+            raise NodeError("Storage directory %s of %s is missing (it does not survive reboots): use clear to recreate it" % (self.storage_dir, self.name))
+        if not self.storage_size:
+            return
+        used = 0
+        for root, dirs, files in os.walk(self.storage_dir):
+            used += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        needed = self.storage_size * 1024 * 1024 - used
+        available = common.free_space(self.storage_dir)
+        if needed > available:
+            raise NodeError("Not enough space in %s to start %s: %dMB reserved, only %dMB available" % (self.storage_dir, self.name, needed / (1024 * 1024), available / (1024 * 1024)))
+
     def __get_status_string(self):
         if self.status == Status.UNINITIALIZED:
             return "%s (%s)" % (Status.DOWN, "Not initialized")
@@ -919,7 +1402,7 @@ class Node():
                 for cf in columnfamilies:
                     datafiles = datafiles + self.get_sstables(keyspace, cf)
         else:
-            keyspace_dir = os.path.join(self.get_path(), 'data', keyspace)
-            datafiles = [ os.path.join(keyspace_dir, datafile) ]
+            candidates = [ os.path.join(d, keyspace, datafile) for d in self.get_data_directories() ]
+            datafiles = [ f for f in candidates if os.path.exists(f) ][:1] or candidates[:1]
 
         return datafiles
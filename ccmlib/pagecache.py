@@ -0,0 +1,164 @@
+# OS page cache control
+#
+# Pre-faults, evicts and reports the page cache residency of files through
+# posix_fadvise and mincore, which don't require root (unlike writing to
+# /proc/sys/vm/drop_caches).
+from __future__ import with_statement
+
+import os, errno, ctypes, ctypes.util, mmap, threading
+import common
+
+POSIX_FADV_RANDOM = 1
+POSIX_FADV_DONTNEED = 4
+
+_PROT_READ = 0x1
+_MAP_SHARED = 0x01
+_MAP_FAILED = ctypes.c_void_p(-1).value
+
+_READ_BLOCK = 1024 * 1024
+
+_libc = None
+
+def __libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'posix_fadvise') or not hasattr(libc, 'mincore'):
+            raise common.CCMError("Page cache control is not supported on this platform")
+        libc.posix_fadvise.argtypes = [ ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int ]
+        libc.mmap.restype = ctypes.c_void_p
+        libc.mmap.argtypes = [ ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int64 ]
+        libc.munmap.argtypes = [ ctypes.c_void_p, ctypes.c_size_t ]
+        libc.mincore.argtypes = [ ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p ]
+        _libc = libc
+    return _libc
+
+def __fadvise(fd, advice):
+    err = __libc().posix_fadvise(fd, 0, 0, advice)
+    if err != 0:
+        raise OSError(err, os.strerror(err))
+
+def __open(path):
+    # A read-only descriptor on path, or None if it doesn't exist anymore
+    # (the sstables of a live node get compacted away at any time)
+    try:
+        return os.open(path, os.O_RDONLY)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+def sstable_files(datafiles):
+    """
+    Returns all the component files of the sstables whose Data.db components
+    are datafiles, the small components (index, summary, filter...) first.
+    """
+    small, data = [], []
+    for datafile in datafiles:
+        prefix = datafile[:-len('Data.db')]
+        directory = os.path.dirname(datafile)
+        try:
+            files = os.listdir(directory)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        for f in files:
+            path = os.path.join(directory, f)
+            if path.startswith(prefix):
+                (data if path == datafile else small).append(path)
+    return small + data
+
+def residency(path):
+    """
+    Returns a (cached pages, total pages) pair for the file at path, (0, 0)
+    if it doesn't exist anymore.
+    """
+    fd = __open(path)
+    if fd is None:
+        return (0, 0)
+    try:
+        size = os.fstat(fd).st_size
+        page = mmap.PAGESIZE
+        pages = (size + page - 1) // page
+        if pages == 0:
+            return (0, 0)
+        libc = __libc()
+        addr = libc.mmap(None, size, _PROT_READ, _MAP_SHARED, fd, 0)
+        if addr == _MAP_FAILED:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        try:
+            vec = ctypes.create_string_buffer(pages)
+            if libc.mincore(addr, size, vec) != 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            return (sum(ord(b) & 1 for b in vec.raw), pages)
+        finally:
+            libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+
+def drop(path):
+    """
+    Evicts the file at path (unless it doesn't exist anymore) from the page
+    cache. Dirty pages are written out first, as they can't be evicted
+    otherwise.
+    """
+    fd = __open(path)
+    if fd is None:
+        return
+    try:
+        os.fsync(fd)
+        __fadvise(fd, POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def warm(paths, budget=None, max_workers=None):
+    """
+    Reads the files at paths (in parallel, from up to max_workers threads) so
+    that they are in the page cache, stopping once budget bytes (if not None)
+    have been read. Files are started in order, so the budget goes to the
+    first ones. Files that don't exist anymore are skipped. Returns the
+    number of bytes read.
+    """
+    state = { 'remaining' : budget }
+    lock = threading.Lock()
+
+    def reserve(n):
+        with lock:
+            if state['remaining'] is None:
+                return n
+            n = min(n, state['remaining'])
+            state['remaining'] -= n
+            return n
+
+    def release(n):
+        with lock:
+            if state['remaining'] is not None:
+                state['remaining'] += n
+
+    def warm_file(path):
+        read = 0
+        fd = __open(path)
+        if fd is None:
+            return 0
+        try:
+            if budget is not None:
+                # disables readahead, that would cache more than the budget
+                __fadvise(fd, POSIX_FADV_RANDOM)
+            while True:
+                n = reserve(_READ_BLOCK)
+                if n == 0:
+                    break
+                data = os.read(fd, n)
+                read += len(data)
+                if len(data) < n:
+                    # end of file: give back what wasn't used
+                    release(n - len(data))
+                    break
+        finally:
+            os.close(fd)
+        return read
+
+    return sum(common.parallel_map(warm_file, paths, max_workers=max_workers))
@@ -0,0 +1,77 @@
+# configuration profiles
+#
+# Curated sets of cassandra.yaml options and JVM settings applied to all the
+# nodes of a cluster (see Cluster.set_config_profile). The stock settings size
+# thread pools, memtables and caches for a node alone on a server, which caps
+# the number of nodes a host can run far below what its memory allows.
+import common
+
+# The options of a profile are a list of (first version, last version
+# excluded, cassandra.yaml options) entries, an entry applying to the
+# cassandra versions in [first, last) (None for no bound). Later entries win.
+PROFILES = {
+    'dense' : {
+        'options' : [
+            (None, None, {
+                'concurrent_reads' : 4,
+                'concurrent_writes' : 4,
+                'concurrent_compactors' : 1,
+                'memtable_flush_writers' : 1,
+            }),
+            # memtable_total_space_in_mb was split in heap and offheap in 2.1
+            (None, '2.1', {
+                'memtable_total_space_in_mb' : 32,
+                'in_memory_compaction_limit_in_mb' : 8,
+            }),
+            ('1.1', None, {
+                'key_cache_size_in_mb' : 4,
+                'row_cache_size_in_mb' : 0,
+            }),
+            ('1.2', None, {
+                'native_transport_max_threads' : 16,
+            }),
+            ('2.1', None, {
+                'memtable_heap_space_in_mb' : 32,
+                'memtable_offheap_space_in_mb' : 32,
+                'concurrent_counter_writes' : 4,
+                'counter_cache_size_in_mb' : 2,
+                'index_summary_capacity_in_mb' : 4,
+                'file_cache_size_in_mb' : 32,
+            }),
+            ('3.0', None, {
+                'concurrent_materialized_view_writes' : 4,
+            }),
+        ],
+        # appended to JVM_OPTS in cassandra-env.sh: fewer GC and JIT threads,
+        # and a smaller JIT code cache
+        'jvm_options' : [ '-XX:ParallelGCThreads=2', '-XX:ConcGCThreads=1', '-XX:CICompilerCount=2', '-XX:ReservedCodeCacheSize=64m' ],
+        # upper bound (in MB) of the heap given to each node (see Node.heap_budget)
+        'max_heap_size' : 512,
+    },
+}
+
+def names():
+    return sorted(PROFILES.keys())
+
+def get(name):
+    if name not in PROFILES:
+        raise common.ArgumentError("Unknown configuration profile %s (known profiles: %s)" % (name, ', '.join(names())))
+    return PROFILES[name]
+
+def configuration_options(name, version):
+    """
+    Returns the cassandra.yaml options of profile name for that cassandra
+    version.
+    """
+    options = {}
+    version = common.parse_version(version)
+    for first, last, values in get(name)['options']:
+        if (first is None or version >= common.parse_version(first)) and (last is None or version < common.parse_version(last)):
+            options.update(values)
+    return options
+
+def jvm_options(name):
+    return get(name).get('jvm_options', [])
+
+def max_heap_size(name):
+    return get(name).get('max_heap_size')
@@ -1,163 +1,695 @@
 # downloaded sources handling
 from __future__ import with_statement
 
-import os, shutil, urllib2, tarfile, tempfile, subprocess, stat, time
+import os, re, shutil, urllib2, StringIO, tarfile, tempfile, subprocess, stat, time, hashlib, socket, sys, threading, fcntl, errno, contextlib, glob, yaml
 import common
 
 ARCHIVE="http://archive.apache.org/dist/cassandra"
 GIT_REPO="http://git-wip-us.apache.org/repos/asf/cassandra.git"
 
-def setup(version, verbose=False):
+# Number of connections used to download a file (in ranges) when the server allows it
+DOWNLOAD_CONNECTIONS = 4
+# Checksums published next to the archives, strongest first
+CHECKSUM_ALGORITHMS = [ 'sha512', 'sha256', 'sha1', 'md5' ]
+
+# Written (atomically) in a version directory once it is completely set up
+BUILD_COMPLETE_MARKER = '.ccm-build-complete'
+
+# What compile_version produces, relative to the source directory
+BUILD_OUTPUTS = [ 'build', os.path.join('tools', 'stress', 'build'), os.path.join('contrib', 'stress', 'build') ]
+# Changes to these paths (the build and its dependencies) require a clean build
+CLEAN_BUILD_TRIGGERS = [ 'build.xml', 'build.properties*', 'ivy.xml', 'lib/', 'tools/lib/' ]
+
+# Minimum java version with class data sharing of application classes
+# (AppCDS): a commercial feature of the Oracle JVMs from 8u40, part of
+# OpenJDK from 10 (behind -XX:+UseAppCDS) and always enabled from 11
+CDS_MIN_JAVA_VERSION = 8
+# A recorded class list is used once it hasn't changed for that long (in
+# seconds), i.e. once the node recording it is up
+CDS_SETTLE_TIME = 30
+
+# Default number of versions prefetch downloads, and compiles, at a time
+PREFETCH_DOWNLOADS = 4
+PREFETCH_BUILDS = 2
+
+_MIN_RANGE_SIZE = 4 * 1024 * 1024
+_READ_BLOCK = 64 * 1024
+_ATTEMPTS = 5
+
+def setup(version, verbose=False, logfile=None, config_dir=None, evict_unused=True):
+    # Only one process sets a given version up, the others wait for it and
+    # then use the result. Builds are logged to logfile (appended to) if
+    # given, or else to last.log (replaced). The clusters of config_dir (if
+    # given) are then looked at by evict, whatever the directory. Unless
+    # evict_unused is False, adding version to the repository evicts other
+    # versions beyond 'repository_max_size_mb' in ~/.ccm/config.
+    if config_dir is not None:
+        __register_config_dir(config_dir)
+    with __lock(version, "Waiting for another ccm process to set up %s ..." % version if verbose else None):
+        cdir, v, added = __setup(version, verbose, logfile)
+    __mark_used(cdir)
+    budget = common.get_config().get('repository_max_size_mb')
+    if added and budget is not None and evict_unused:
+        evict(int(budget) * 1024 * 1024, keep=[ cdir ], verbose=verbose)
+    return (cdir, v)
+
+def __setup(version, verbose=False, logfile=None):
+    # Returns the directory and version number of version, and whether
+    # anything was added to the repository. Must be called with the version
+    # lock held.
     if version.startswith('git:'):
-        clone_development(version, verbose=verbose)
-        return (version_directory(version), None)
+        built = clone_development(version, verbose=verbose, logfile=logfile)
+        return (__version_directory(version), None, built)
+    elif version.startswith('binary:'):
+        binary = version[len('binary:'):]
+        if os.path.isdir(binary):
+            # a local prebuilt tree, used in place
+            common.validate_cassandra_dir(binary)
+            return (os.path.abspath(binary), None, False)
+        cdir = __version_directory(version)
+        if cdir is None:
+            download_version(binary, verbose=verbose, binary=True, logfile=logfile)
+            return (__version_directory(version), binary, True)
+        return (cdir, binary, False)
     else:
-        cdir = version_directory(version)
+        cdir = __version_directory(version)
         if cdir is None:
-            download_version(version, verbose=verbose)
-            cdir = version_directory(version)
-        return (cdir, version)
+            download_version(version, verbose=verbose, logfile=logfile)
+            return (__version_directory(version), version, True)
+        return (cdir, version, False)
 
-def validate(path):
+def validate(path, config_dir=None):
     if path.startswith(__get_dir()):
         _, version = os.path.split(os.path.normpath(path))
-        setup(version)
+        setup(version, config_dir=config_dir)
+    elif config_dir is not None:
+        __register_config_dir(config_dir)
+
+def prefetch(versions, downloads=PREFETCH_DOWNLOADS, builds=PREFETCH_BUILDS, verbose=False):
+    """
+    Set up all of versions concurrently: up to downloads versions are
+    downloaded at a time, and up to builds are compiled at a time. Each
+    version is logged to its own file in the _logs directory of the
+    repository. If verbose, the progress of all versions is displayed. The
+    repository size limit is only enforced once all versions are set up, and
+    never evicts them.
+    Returns a dict of the versions that couldn't be set up to the error.
+    """
+    logs = __ensure_dir(os.path.join(__get_dir(), '_logs'))
+    progress = _PrefetchProgress(versions, verbose)
+    download_slots = threading.Semaphore(downloads)
+    build_slots = threading.Semaphore(builds)
+    failures = {}
+    directories = {}
+
+    def prefetch_version(version):
+        logfile = os.path.join(logs, version.replace(':', '_').replace('/', '_') + '.log')
+        try:
+            # truncated once here, then appended to by each step
+            open(logfile, 'w').close()
+            with download_slots:
+                progress.update(version, 'downloading')
+                __prefetch_download(version, logfile, progress.downloads[version])
+            progress.update(version, 'waiting to build')
+            with build_slots:
+                progress.update(version, 'building')
+                # evicting here could remove the versions prefetched so far
+                directories[version] = setup(version, logfile=logfile, evict_unused=False)[0]
+            progress.update(version, 'done')
+        except Exception as e:
+            failures[version] = "%s (see %s)" % (str(e), logfile)
+            progress.update(version, 'failed')
+
+    # the workers are in a background thread so the progress can be refreshed meanwhile
+    worker = threading.Thread(target=common.parallel_map, args=(prefetch_version, versions), kwargs={ 'max_workers' : len(versions) })
+    worker.daemon = True
+    worker.start()
+    while worker.is_alive():
+        progress.refresh()
+        worker.join(0.5)
+    progress.done()
+
+    budget = common.get_config().get('repository_max_size_mb')
+    if budget is not None:
+        evict(int(budget) * 1024 * 1024, keep=directories.values(), verbose=verbose)
+    return failures
+
+def __prefetch_download(version, logfile, progress):
+    # Downloads what's needed to set version up, unless it already is
+    if version.startswith('git:'):
+        with open(logfile, 'a') as lf:
+            __update_git_cache(os.path.join(__get_dir(), '_git_cache'), lf)
+        return
+    binary = version.startswith('binary:')
+    if binary:
+        version = version[len('binary:'):]
+        if os.path.isdir(version):
+            return
+    with __lock('binary:%s' % version if binary else version):
+        if __version_directory('binary:%s' % version if binary else version) is None:
+            try:
+                fetch(__archive_url(version, binary), progress=progress)
+            except urllib2.URLError as e:
+                raise common.ArgumentError("Invalid version %s (underlying error is: %s)" % (version, str(e)))
+
+class _PrefetchProgress():
+    """
+    The state of each version being prefetched, displayed as one status
+    line (rewritten in place) and one line per finished version.
+    """
+    def __init__(self, versions, show):
+        self.versions = list(versions)
+        self.show = show
+        self.states = dict((v, ('queued', time.time())) for v in self.versions)
+        self.downloads = dict((v, _DownloadProgress(None, False)) for v in self.versions)
+        self.lock = threading.Lock()
+        self.width = 0
+
+    def update(self, version, state):
+        with self.lock:
+            started = self.states[version][1]
+            self.states[version] = (state, time.time())
+            if self.show and state in ('done', 'failed'):
+                self.__write("%s: %s in %ds" % (version, state, time.time() - started), newline=True)
+        self.refresh()
 
-def clone_development(version, verbose=False):
+    def refresh(self):
+        if not self.show:
+            return
+        with self.lock:
+            finished = len([ v for v in self.versions if self.states[v][0] in ('done', 'failed') ])
+            running = []
+            for v in self.versions:
+                state, since = self.states[v]
+                if state == 'downloading':
+                    download = self.downloads[v]
+                    if download.file_size:
+                        state = "downloading %d%%" % (download.downloaded * 100 // download.file_size)
+                elif state == 'building':
+                    state = "building %ds" % (time.time() - since)
+                elif state in ('done', 'failed', 'queued'):
+                    continue
+                running.append("%s %s" % (v, state))
+            self.__write("[%d/%d] %s" % (finished, len(self.versions), ", ".join(running)))
+
+    def done(self):
+        if self.show:
+            print ""
+
+    def __write(self, line, newline=False):
+        # overwrites the previous status line
+        sys.stdout.write("\r" + line.ljust(self.width) + ("\n" if newline else ""))
+        sys.stdout.flush()
+        self.width = 0 if newline else len(line)
+
+def clone_development(version, verbose=False, logfile=None):
+    """
+    Check out and compile the git branch (or tag, or commit) of version (of
+    the form 'git:<branch>'), or update it if already checked out. Returns
+    whether anything was checked out or compiled.
+    """
     local_git_cache = os.path.join(__get_dir(), '_git_cache')
     target_dir = os.path.join(__get_dir(), version.replace(':', '_')) # handle git branches like 'git:trunk'.
     git_branch = version[4:] # the part of the version after the 'git:'
-    logfile = os.path.join(__get_dir(), "last.log")
-    with open(logfile, 'w') as lf:
+    with __open_log(logfile) as lf:
         try:
             #Checkout/fetch a local repository cache to reduce the number of
             #remote fetches we need to perform:
-            if not os.path.exists(local_git_cache):
-                if verbose:
-                    print "Cloning Cassandra..."
-                out = subprocess.call(
-                    ['git', 'clone', '--mirror', GIT_REPO, local_git_cache], 
-                    cwd=__get_dir(), stdout=lf, stderr=lf)
-                assert out == 0, "Could not do a git clone"
-            else: 
-                if verbose:
-                    print "Fetching Cassandra updates..."
-                out = subprocess.call(
-                    ['git', 'fetch', '-fup', 'origin', '+refs/*:refs/*'],
-                    cwd=local_git_cache, stdout=lf, stderr=lf)
+            __update_git_cache(local_git_cache, lf, verbose)
+            commit = subprocess.Popen(['git', '--git-dir', local_git_cache, 'rev-parse', '--verify', '%s^{commit}' % git_branch],
+                    stdout=subprocess.PIPE, stderr=lf).communicate()[0].strip()
+            if not commit:
+                raise common.CCMError("Could not check out git branch %s. Is this a valid branch name? (see %s for details)" % (git_branch, lf.name))
 
             #Checkout the version we want from the local cache:
             if not os.path.exists(target_dir):
                 # development branch doesn't exist. Check it out.
                 if verbose:
-                    print "Cloning Cassandra (from local cache)"
-                subprocess.call(['git', 'clone', local_git_cache, target_dir], cwd=__get_dir(), stdout=lf, stderr=lf)
-                # now check out the right version
-                if verbose:
-                    print "Checking out requested branch (%s)" % git_branch
-                out = subprocess.call(['git', 'checkout', git_branch], cwd=target_dir, stdout=lf, stderr=lf)
-                if int(out) != 0:
-                    raise common.CCMError("Could not check out git branch %s. Is this a valid branch name? (see last.log for details)" % git_branch)
+                    print "Checking out requested branch (%s) from local cache" % git_branch
+                with __lock('_git_cache'):
+                    __add_worktree(local_git_cache, target_dir, commit, lf)
                 # now compile
-                compile_version(git_branch, target_dir, verbose)
+                __cached_build(git_branch, target_dir, lf, verbose)
+                __mark_complete(target_dir)
+                return True
             else: # branch is already checked out. See if it is behind and recompile if needed.
-                out = subprocess.call(['git', 'fetch', 'origin'], cwd=target_dir, stdout=lf, stderr=lf)
-                assert out == 0, "Could not do a git fetch"
-                status = subprocess.Popen(['git', 'status', '-sb'], cwd=target_dir, stdout=subprocess.PIPE, stderr=lf).communicate()[0]
-                if status.find('[behind') > -1:
+                head = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=target_dir, stdout=subprocess.PIPE, stderr=lf).communicate()[0].strip()
+                if not os.path.exists(os.path.join(target_dir, BUILD_COMPLETE_MARKER)):
+                    # the last checkout or build was interrupted (e.g. killed)
+                    if verbose:
+                        print "Previous build did not complete, recompiling"
+                    if head != commit:
+                        __checkout(local_git_cache, target_dir, commit, lf)
+                    __cached_build(git_branch, target_dir, lf, verbose, clean=True)
+                    __mark_complete(target_dir)
+                    return True
+                elif head != commit:
                     if verbose:
                         print "Branch is behind, recompiling"
-                    out = subprocess.call(['git', 'pull'], cwd=target_dir, stdout=lf, stderr=lf)
-                    assert out == 0, "Could not do a git pull"
-                    out = subprocess.call(['ant', 'realclean'], cwd=target_dir, stdout=lf, stderr=lf)
-                    assert out == 0, "Could not run 'ant realclean'"
-                    
+                    __mark_incomplete(target_dir)
+                    __checkout(local_git_cache, target_dir, commit, lf)
+
                     # now compile
-                    compile_version(git_branch, target_dir, verbose)
+                    __cached_build(git_branch, target_dir, lf, verbose, previous=head)
+                    __mark_complete(target_dir)
+                    return True
+                return False
         except:
             # wipe out the directory if anything goes wrong. Otherwise we will assume it has been compiled the next time it runs.
-            try:
-                shutil.rmtree(target_dir)
-            except: pass
+            shutil.rmtree(target_dir, ignore_errors=True)
             raise
-                
 
-def download_version(version, url=None, verbose=False):
-    u = "%s/%s/apache-cassandra-%s-src.tar.gz" % (ARCHIVE, version.split('-')[0], version) if url is None else url
-    _, target = tempfile.mkstemp(suffix=".tar.gz", prefix="ccm-")
-    try:
-        __download(u, target, show_progress=verbose)
+# Whether the local git cache has been fetched by this process already
+_git_cache_updated = False
+
+def __update_git_cache(local_git_cache, lf, verbose=False):
+    global _git_cache_updated
+    with __lock('_git_cache'):
+        if not _git_cache_updated:
+            __fetch_git_cache(local_git_cache, lf, verbose)
+            _git_cache_updated = True
+
+def __fetch_git_cache(local_git_cache, lf, verbose=False):
+    if not os.path.exists(local_git_cache):
         if verbose:
-            print "Extracting %s as version %s ..." % (target, version)
-        tar = tarfile.open(target)
-        dir = tar.next().name.split("/")[0]
-        tar.extractall(path=__get_dir())
-        tar.close()
-        target_dir = os.path.join(__get_dir(), version)
-        if os.path.exists(target_dir):
-            shutil.rmtree(target_dir)
-        shutil.move(os.path.join(__get_dir(), dir), target_dir)
+            print "Cloning Cassandra..."
+        out = subprocess.call(
+            ['git', 'clone', '--mirror', GIT_REPO, local_git_cache],
+            cwd=__get_dir(), stdout=lf, stderr=lf)
+        assert out == 0, "Could not do a git clone"
+    else:
+        if verbose:
+            print "Fetching Cassandra updates..."
+        out = subprocess.call(
+            ['git', 'fetch', '-fup', 'origin', '+refs/*:refs/*'],
+            cwd=local_git_cache, stdout=lf, stderr=lf)
+
+def __add_worktree(local_git_cache, target_dir, commit, lf):
+    # Checks out commit in target_dir, sharing the objects of the local git
+    # cache rather than copying them
+    git = [ 'git', '--git-dir', local_git_cache ]
+    # forget the worktrees whose directory was deleted (e.g. by clearrepo)
+    subprocess.call(git + [ 'worktree', 'prune' ], stdout=lf, stderr=lf)
+    if subprocess.call(git + [ 'worktree', 'add', '--detach', target_dir, commit ], stdout=lf, stderr=lf) == 0:
+        return
+    # git older than 2.5 has no worktrees
+    if os.path.exists(target_dir):
+        shutil.rmtree(target_dir)
+    out = subprocess.call(['git', 'clone', '--shared', '--no-checkout', local_git_cache, target_dir], cwd=__get_dir(), stdout=lf, stderr=lf)
+    assert out == 0, "Could not do a git clone"
+    out = subprocess.call(['git', 'checkout', '--detach', commit], cwd=target_dir, stdout=lf, stderr=lf)
+    assert out == 0, "Could not check out %s" % commit
 
-        compile_version(version, target_dir, verbose=verbose)
+def __checkout(local_git_cache, target_dir, commit, lf):
+    # Checks out commit in the existing checkout target_dir
+    if subprocess.call(['git', 'cat-file', '-e', commit], cwd=target_dir, stdout=lf, stderr=lf) != 0:
+        # a full clone (made by older versions of ccm) that doesn't see the cache objects
+        out = subprocess.call(['git', 'fetch', local_git_cache], cwd=target_dir, stdout=lf, stderr=lf)
+        assert out == 0, "Could not do a git fetch"
+    out = subprocess.call(['git', 'checkout', '--detach', commit], cwd=target_dir, stdout=lf, stderr=lf)
+    assert out == 0, "Could not check out %s" % commit
 
+def download_version(version, url=None, verbose=False, binary=False, logfile=None):
+    """
+    Download, extract and compile the source distribution of version, or
+    if binary is True, download and extract its binary distribution (which
+    doesn't need compiling).
+    """
+    u = __archive_url(version, binary) if url is None else url
+    # everything is extracted and compiled in a staging directory that is only
+    # renamed to the version directory once complete
+    staging = tempfile.mkdtemp(prefix='.staging-', dir=__get_dir())
+    try:
+        cached = __get_cached(u, verbose)
+        if cached is None and u.startswith('file://'):
+            cached = fetch(u, verbose=verbose)
+        if cached is not None:
+            if verbose:
+                print "Extracting %s as version %s ..." % (cached, version)
+            with open(cached, 'rb') as f:
+                dir = __extract(f, staging)
+        else:
+            # extract while downloading
+            dir = __download_and_extract(u, staging, show_progress=verbose)
+
+        if binary:
+            __check_binary_layout(os.path.join(staging, dir))
+        else:
+            with __open_log(logfile) as lf:
+                compile_version(version, os.path.join(staging, dir), verbose, lf)
+        __mark_complete(os.path.join(staging, dir))
+
+        target_dir = os.path.join(__get_dir(), 'binary_%s' % version if binary else version)
+        if os.path.exists(target_dir):
+            shutil.rmtree(target_dir)
+        os.rename(os.path.join(staging, dir), target_dir)
     except urllib2.URLError as e:
         msg = "Invalid version %s" % version if url is None else "Invalid url %s" % url
         msg = msg + " (underlying error is: %s)" % str(e)
         raise common.ArgumentError(msg)
     except tarfile.ReadError as e:
         raise common.ArgumentError("Unable to uncompress downloaded file: %s" % str(e))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+def __archive_url(version, binary=False):
+    dist = 'bin' if binary else 'src'
+    return "%s/%s/apache-cassandra-%s-%s.tar.gz" % (__get_archive(), version.split('-')[0], version, dist)
+
+def __open_log(logfile=None):
+    # logfile is appended to, while the default log (last.log) only has the
+    # last build
+    if logfile is None:
+        return open(os.path.join(__get_dir(), "last.log"), 'w')
+    return open(logfile, 'a')
 
-def compile_version(version, target_dir, verbose=False):
-    # compiling cassandra and the stress tool
-    logfile = os.path.join(__get_dir(), "last.log")
+def __cached_build(version, target_dir, lf, verbose=False, previous=None, clean=False):
+    # Compiles the git checkout target_dir, unless the build cache has the
+    # outputs of a previous build of the same commit in the same build
+    # environment, in which case they are copied instead. If previous is the
+    # commit target_dir was built at before, the build is incremental unless
+    # the changes since then require a clean build. If clean, the build is
+    # always a clean one.
+    head = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=target_dir, stdout=subprocess.PIPE, stderr=lf).communicate()[0].strip()
+    cached = os.path.join(__get_build_cache_dir(), "%s-%s" % (head, __build_environment()))
+    if head and os.path.isdir(cached):
+        if verbose:
+            print "Using cached build of %s" % head
+        # the entry can't be evicted while it's being copied
+        with __lock(os.path.relpath(cached, __get_dir())):
+            __copy_build_outputs(cached, target_dir)
+        __mark_used(cached)
+        return
+
+    if clean:
+        lf.write("--- Clean build of %s (previous build did not complete)\n" % head)
+        lf.flush()
+    elif previous is not None:
+        clean, reason = __needs_clean_build(target_dir, previous, head, lf)
+        lf.write("--- %s build of %s (%s)\n" % ("Clean" if clean else "Incremental", head, reason))
+        lf.flush()
+        if verbose:
+            print "%s build: %s" % ("Clean" if clean else "Incremental", reason)
+    if clean:
+        out = subprocess.call(['ant', 'realclean'], cwd=target_dir, stdout=lf, stderr=lf)
+        assert out == 0, "Could not run 'ant realclean'"
+    start = time.time()
+    compile_version(version, target_dir, verbose, lf)
+    lf.write("\n\n--- Build took %.1fs\n" % (time.time() - start))
+    if head:
+        # copy to a temporary directory first, so the cache never has partial builds
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=__get_build_cache_dir())
+        try:
+            __copy_build_outputs(target_dir, staging)
+            if not os.path.exists(cached):
+                os.rename(staging, cached)
+                __mark_used(cached)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+def __needs_clean_build(target_dir, old, new, lf):
+    # Returns whether going from commit old to commit new requires a clean
+    # build, and why. ant only recompiles the sources that changed, so
+    # removed sources (whose classes would stay around) and changes to the
+    # build itself or its dependencies require one.
+    p = subprocess.Popen(['git', 'diff', '--name-status', old, new], cwd=target_dir, stdout=subprocess.PIPE, stderr=lf)
+    out = p.communicate()[0]
+    if p.returncode != 0:
+        return True, "could not diff %s and %s" % (old, new)
+    changes = [ line.split('\t') for line in out.splitlines() if line ]
+    for change in changes:
+        status, path = change[0], change[1]
+        if status[0] in 'DR':
+            return True, "%s was removed" % path
+        for trigger in CLEAN_BUILD_TRIGGERS:
+            if path == trigger or (trigger.endswith('/') and path.startswith(trigger)) \
+                    or (trigger.endswith('*') and path.startswith(trigger[:-1])):
+                return True, "%s changed" % path
+    return False, "%d files changed since %s" % (len(changes), old)
+
+def __copy_build_outputs(source_dir, target_dir):
+    for output in BUILD_OUTPUTS:
+        source = os.path.join(source_dir, output)
+        if os.path.isdir(source):
+            target = os.path.join(target_dir, output)
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            shutil.copytree(source, target, symlinks=True)
+
+_build_environment = None
+
+def __build_environment():
+    # A hash of the versions of the tools the builds depend on
+    global _build_environment
+    if _build_environment is None:
+        h = hashlib.md5(os.environ.get('JAVA_HOME', ''))
+        for command in [ [ 'java', '-version' ], [ 'ant', '-version' ] ]:
+            try:
+                h.update(subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0])
+            except OSError:
+                h.update('no %s' % command[0])
+        _build_environment = h.hexdigest()[:12]
+    return _build_environment
+
+def __check_binary_layout(target_dir):
+    # Binary distributions have bin/, conf/ and the jars in lib/, which is
+    # what ccm needs. Only make sure the scripts are executable.
+    common.validate_cassandra_dir(target_dir)
+    for bin_dir in [ os.path.join(target_dir, 'bin'), os.path.join(target_dir, 'tools', 'bin') ]:
+        if os.path.isdir(bin_dir):
+            for f in os.listdir(bin_dir):
+                full_path = os.path.join(bin_dir, f)
+                if os.path.isfile(full_path) and not f.endswith('.bat'):
+                    os.chmod(full_path, os.stat(full_path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+def compile_version(version, target_dir, verbose=False, lf=None):
+    # compiling cassandra and the stress tool, logging to lf if given (or
+    # else to last.log)
+    if lf is None:
+        with __open_log() as lf:
+            return compile_version(version, target_dir, verbose, lf)
+    logfile = lf.name
     if verbose:
         print "Compiling Cassandra %s ..." % version
-    with open(logfile, 'w') as lf:
-        lf.write("--- Cassandra build -------------------\n")
+    lf.write("--- Cassandra build -------------------\n")
+    lf.flush()
+    try:
+        # Patch for pending Cassandra issue: https://issues.apache.org/jira/browse/CASSANDRA-5543
+        # Similar patch seen with buildbot
+        attempt = 0
+        ret_val = 1
+        while attempt < 3 and ret_val is not 0:
+            if attempt > 0:
+                lf.write("\n\n`ant jar` failed. Retry #%s...\n\n" % attempt)
+            ret_val = subprocess.call(['ant', 'jar'], cwd=target_dir, stdout=lf, stderr=lf)
+            attempt += 1
+        if ret_val is not 0:
+            raise common.CCMError("Error compiling Cassandra. See %s for details" % logfile)
+    except OSError, e:
+        raise common.CCMError("Error compiling Cassandra. Is ant installed? See %s for details" % logfile)
+    
+    lf.write("\n\n--- cassandra/stress build ------------\n")
+    stress_dir = os.path.join(target_dir, "tools", "stress") if (
+            version >= "0.8.0") else \
+            os.path.join(target_dir, "contrib", "stress")
+
+    build_xml = os.path.join(stress_dir, 'build.xml')
+    if os.path.exists(build_xml): # building stress separately is only necessary pre-1.1
         try:
-            # Patch for pending Cassandra issue: https://issues.apache.org/jira/browse/CASSANDRA-5543
-            # Similar patch seen with buildbot
-            attempt = 0
-            ret_val = 1
-            while attempt < 3 and ret_val is not 0:
-                if attempt > 0:
-                    lf.write("\n\n`ant jar` failed. Retry #%s...\n\n" % attempt)
-                ret_val = subprocess.call(['ant', 'jar'], cwd=target_dir, stdout=lf, stderr=lf)
-                attempt += 1
-            if ret_val is not 0:
-                raise common.CCMError("Error compiling Cassandra. See %s for details" % logfile)
-        except OSError, e:
-            raise common.CCMError("Error compiling Cassandra. Is ant installed? See %s for details" % logfile)
-        
-        lf.write("\n\n--- cassandra/stress build ------------\n")
-        stress_dir = os.path.join(target_dir, "tools", "stress") if (
-                version >= "0.8.0") else \
-                os.path.join(target_dir, "contrib", "stress")
-
-        build_xml = os.path.join(stress_dir, 'build.xml')
-        if os.path.exists(build_xml): # building stress separately is only necessary pre-1.1
-            try:
-                # set permissions correctly, seems to not always be the case
-                stress_bin_dir = os.path.join(stress_dir, 'bin')
-                for f in os.listdir(stress_bin_dir):
-                    full_path = os.path.join(stress_bin_dir, f)
-                    os.chmod(full_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
-
-                if subprocess.call(['ant', 'build'], cwd=stress_dir, stdout=lf, stderr=lf) is not 0:
-                    if subprocess.call(['ant', 'stress-build'], cwd=target_dir, stdout=lf, stderr=lf) is not 0:
-                        raise common.CCMError("Error compiling Cassandra stress tool.  "
-                                "See %s for details (you will still be able to use ccm "
-                                "but not the stress related commands)" % logfile)
-            except IOError as e:
-                raise common.CCMError("Error compiling Cassandra stress tool: %s (you will "
-                "still be able to use ccm but not the stress related commands)" % str(e))
+            # set permissions correctly, seems to not always be the case
+            stress_bin_dir = os.path.join(stress_dir, 'bin')
+            for f in os.listdir(stress_bin_dir):
+                full_path = os.path.join(stress_bin_dir, f)
+                os.chmod(full_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+
+            if subprocess.call(['ant', 'build'], cwd=stress_dir, stdout=lf, stderr=lf) is not 0:
+                if subprocess.call(['ant', 'stress-build'], cwd=target_dir, stdout=lf, stderr=lf) is not 0:
+                    raise common.CCMError("Error compiling Cassandra stress tool.  "
+                            "See %s for details (you will still be able to use ccm "
+                            "but not the stress related commands)" % logfile)
+        except IOError as e:
+            raise common.CCMError("Error compiling Cassandra stress tool: %s (you will "
+            "still be able to use ccm but not the stress related commands)" % str(e))
+
+def class_data_sharing(cassandra_dir, record=False):
+    """
+    Returns the (JVM options, classpath prefix) making a JVM running the
+    classes of cassandra_dir use the class data sharing archive of that
+    version, generating the archive first if needed. The archive is dumped
+    from the classes loaded by a node of that version: if they haven't been
+    recorded yet and record is True, the options record them instead.
+    Returns None if there's nothing to use (or record), if the JVM doesn't
+    support AppCDS, or if 'class_data_sharing' is false in ~/.ccm/config.
+    """
+    if not common.get_config().get('class_data_sharing', True):
+        return None
+    java = __java_version()
+    if java is None or java[0] < CDS_MIN_JAVA_VERSION:
+        return None
+    unlock = __cds_unlock_options(java[0])
+    if unlock is None:
+        return None
+    classpath = __cds_classpath(cassandra_dir)
+    if not classpath:
+        return None
+
+    # the JVM ignores archives of another JVM or of modified jars
+    h = hashlib.md5(java[1])
+    for path in classpath:
+        st = os.stat(path)
+        h.update("%s %d %d\n" % (path, st.st_size, st.st_mtime))
+    cds_dir = __ensure_dir(__cds_dir(cassandra_dir))
+    archive = os.path.join(cds_dir, h.hexdigest()[:12] + '.jsa')
+    options = unlock + [ '-XX:SharedArchiveFile=%s' % archive, '-Xshare:auto' ]
+    if os.path.exists(archive):
+        return (options, classpath)
+    if os.path.exists(archive + '.failed'):
+        return None
+
+    # JVMs don't wait for another process dumping the archive, they just run without it
+    with __lock(os.path.relpath(cds_dir, __get_dir()), blocking=False) as locked:
+        if not locked:
+            return None
+        if os.path.exists(archive):
+            return (options, classpath)
+        classlist = os.path.join(cds_dir, 'classlist')
+        if not os.path.exists(classlist):
+            recordings = glob.glob(os.path.join(cds_dir, 'classlist-*'))
+            settled = [ r for r in recordings if time.time() - os.path.getmtime(r) > CDS_SETTLE_TIME ]
+            for r in settled:
+                if os.path.getsize(r) == 0:
+                    # the recording JVM didn't start
+                    os.remove(r)
+                    recordings.remove(r)
+            settled = [ r for r in settled if r in recordings ]
+            if not recordings:
+                if not record:
+                    return None
+                # created here so that other nodes don't record too
+                recording = os.path.join(cds_dir, 'classlist-%d-%d' % (os.getpid(), time.time() * 1000))
+                open(recording, 'w').close()
+                return (unlock + [ '-XX:DumpLoadedClassList=%s' % recording ], [])
+            if not settled:
+                return None
+            __save_classlist(max(settled, key=os.path.getsize), classlist)
+            for r in recordings:
+                os.remove(r)
+        if not __dump_cds_archive(unlock, classpath, classlist, archive):
+            return None
+        return (options, classpath)
+
+def __save_classlist(recording, classlist):
+    # the recording may still be written to: only keep complete lines
+    with open(recording) as f:
+        lines = [ l for l in f if l.endswith('\n') ]
+    with open(classlist + '.tmp', 'w') as f:
+        f.writelines(lines)
+    os.rename(classlist + '.tmp', classlist)
+
+def __dump_cds_archive(unlock, classpath, classlist, archive):
+    # Returns whether the archive could be dumped
+    for old in glob.glob(os.path.join(os.path.dirname(archive), '*.jsa')):
+        os.remove(old)
+    with open(os.path.join(os.path.dirname(archive), 'dump.log'), 'w') as lf:
+        args = [ java_executable() ] + unlock + [ '-Xshare:dump', '-XX:SharedClassListFile=%s' % classlist,
+                 '-XX:SharedArchiveFile=%s' % (archive + '.tmp'), '-cp', ':'.join(classpath) ]
+        lf.write(" ".join(args) + "\n")
+        lf.flush()
+        if subprocess.call(args, stdout=lf, stderr=lf) != 0 or not os.path.exists(archive + '.tmp'):
+            # not retried, see dump.log
+            open(archive + '.failed', 'w').close()
+            return False
+    os.rename(archive + '.tmp', archive)
+    return True
+
+def __cds_classpath(cassandra_dir):
+    # The jars of cassandra_dir, in the order of its cassandra.in.sh. Only
+    # jars can be archived.
+    jars = [ j for j in sorted(glob.glob(os.path.join(cassandra_dir, 'build', 'apache-cassandra-*.jar')))
+             if not j.endswith(('-tests.jar', '-sources.jar', '-javadoc.jar')) ]
+    jars += sorted(glob.glob(os.path.join(cassandra_dir, 'lib', '*.jar')))
+    jars += sorted(glob.glob(os.path.join(cassandra_dir, 'build', 'lib', 'jars', '*.jar')))
+    return [ os.path.abspath(j) for j in jars ]
+
+def cds_java_home():
+    """
+    Returns a JAVA_HOME the bin/java of which runs the JVM of $CCM_JAVA with
+    the options of $CCM_CDS_TOOL_OPTS. The tool scripts pick their JVM from
+    JAVA_HOME and don't pass JVM_OPTS on, and JAVA_TOOL_OPTIONS would be
+    echoed by the JVM on stderr, mixing with the output of the tools.
+    """
+    home = os.path.join(__get_dir(), '_cds', 'java')
+    java = os.path.join(home, 'bin', 'java')
+    if not os.path.exists(java):
+        __ensure_dir(os.path.dirname(java))
+        tmp = '%s.%d' % (java, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write('#!/bin/sh\nexec "$CCM_JAVA" $CCM_CDS_TOOL_OPTS "$@"\n')
+        os.chmod(tmp, 0755)
+        os.rename(tmp, java)
+    return home
+
+def __cds_dir(cassandra_dir):
+    return os.path.join(__get_dir(), '_cds', hashlib.md5(os.path.realpath(cassandra_dir)).hexdigest()[:12])
+
+def java_executable():
+    """
+    Returns the JVM the cassandra scripts use.
+    """
+    java_home = os.environ.get('JAVA_HOME')
+    return os.path.join(java_home, 'bin', 'java') if java_home else 'java'
+
+_java_version = None
+_cds_unlock_options = {}
+
+def __cds_unlock_options(major):
+    # The options enabling AppCDS on a JVM of that major version, or None if
+    # it doesn't support it (e.g. OpenJDK 8, or Oracle 8 before 8u40)
+    if major >= 11:
+        return []
+    if major not in _cds_unlock_options:
+        options = [ '-XX:+UseAppCDS' ] if major >= 10 else [ '-XX:+UnlockCommercialFeatures', '-XX:+UseAppCDS' ]
+        with open(os.devnull, 'w') as devnull:
+            supported = subprocess.call([ java_executable() ] + options + [ '-version' ], stdout=devnull, stderr=devnull) == 0
+        _cds_unlock_options[major] = options if supported else None
+    return _cds_unlock_options[major]
+
+def __java_version():
+    # The (major version, 'java -version' output) of the JVM, or None if
+    # there isn't one
+    global _java_version
+    if _java_version is None:
+        try:
+            output = subprocess.Popen([ java_executable(), '-version' ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
+        except OSError:
+            output = ''
+        # either 1.<major>.x (up to java 8) or <major>.x
+        m = re.search(r'version "(?:1\.)?(\d+)', output)
+        _java_version = (int(m.group(1)), output) if m else ()
+    return _java_version or None
 
 def version_directory(version):
+    with __lock(version):
+        return __version_directory(version)
+
+def __version_directory(version):
+    # must be called with the version lock held
     version = version.replace(':', '_') # handle git branches like 'git:trunk'.
     dir = os.path.join(__get_dir(), version)
     if os.path.exists(dir):
+        if os.path.exists(os.path.join(dir, BUILD_COMPLETE_MARKER)):
+            return dir
+        if version.startswith('git_'):
+            # a checkout whose build didn't finish: clone_development builds
+            # it again
+            return None
         try:
+            # set up by a version of ccm that didn't write the marker, which
+            # for a source distribution must have been compiled
             common.validate_cassandra_dir(dir)
+            if not version.startswith('binary_') and not glob.glob(os.path.join(dir, 'build', '*.jar')):
+                raise common.ArgumentError("%s was not compiled" % dir)
+            __mark_complete(dir)
             return dir
         except common.ArgumentError as e:
             shutil.rmtree(dir)
@@ -165,46 +697,500 @@ def version_directory(version):
     else:
         return None
 
+def __mark_complete(dir):
+    marker = os.path.join(dir, BUILD_COMPLETE_MARKER)
+    with open(marker + '.tmp', 'w') as f:
+        f.write("%s\n" % time.ctime())
+    os.rename(marker + '.tmp', marker)
+
+def __mark_incomplete(dir):
+    marker = os.path.join(dir, BUILD_COMPLETE_MARKER)
+    if os.path.exists(marker):
+        os.remove(marker)
+
+@contextlib.contextmanager
+def __lock(name, waiting_message=None, blocking=True):
+    # An exclusive lock on name shared by all ccm processes (and threads)
+    # using this repository. Yields whether the lock was acquired, which is
+    # always the case if blocking. The lock files are kept out of the
+    # repository, which clean_all removes while they may be held.
+    locks = __ensure_dir(os.path.join(common.get_default_path(), '.repository-locks'))
+    with open(os.path.join(locks, name.replace(':', '_').replace('/', '_') + '.lock'), 'a') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            if not blocking:
+                yield False
+                return
+            if waiting_message is not None:
+                print waiting_message
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
 def clean_all():
     shutil.rmtree(__get_dir())
 
-def __download(url, target, show_progress=False):
-    u = urllib2.urlopen(url)
-    f = open(target, 'wb')
+def entries(config_dirs=None):
+    """
+    Returns the versions and cached builds of the repository as a list of
+    dictionaries with their 'name', 'path', 'size' (in bytes), 'last_used'
+    time and whether they are 'in_use' by a cluster of config_dirs (the
+    default ccm directory if not provided) or of a directory the clusters of
+    which used the repository (see setup), least recently used first.
+    """
+    in_use = __used_directories(set(config_dirs or [ common.get_default_path() ]) | set(__config_dirs()))
+    paths = [ os.path.join(__get_dir(), d) for d in os.listdir(__get_dir()) if not d.startswith(('.', '_')) ]
+    paths += [ os.path.join(__get_build_cache_dir(), d) for d in os.listdir(__get_build_cache_dir()) if not d.startswith('.') ]
+    result = []
+    for path in paths:
+        if not os.path.isdir(path):
+            continue
+        result.append({
+            'name' : os.path.relpath(path, __get_dir()),
+            'path' : path,
+            'size' : __disk_usage(path),
+            'last_used' : __last_used(path),
+            'in_use' : os.path.realpath(path) in in_use,
+        })
+    return sorted(result, key=lambda e: e['last_used'])
+
+def evict(budget, config_dirs=None, keep=[], verbose=False):
+    """
+    Removes the least recently used versions and cached builds until the
+    repository (including the git cache) uses at most budget bytes. Entries
+    used by a cluster (see entries), being set up by another process, or in keep are never removed.
+    Returns the list of removed entries (see entries).
+    """
+    all_entries = entries(config_dirs)
+    git_cache = os.path.join(__get_dir(), '_git_cache')
+    total = sum(e['size'] for e in all_entries) + (__disk_usage(git_cache) if os.path.exists(git_cache) else 0)
+    keep = [ os.path.realpath(k) for k in keep if k is not None ]
+    removed = []
+    for entry in all_entries:
+        if total <= budget:
+            break
+        if entry['in_use'] or os.path.realpath(entry['path']) in keep:
+            continue
+        with __lock(entry['name'], blocking=False) as locked:
+            if not locked:
+                continue
+            if verbose:
+                print "Removing %s from the repository (%.1fMB, last used %s)" % (entry['name'], float(entry['size']) / (1024 * 1024), time.ctime(entry['last_used']))
+            shutil.rmtree(entry['path'])
+            shutil.rmtree(__cds_dir(entry['path']), ignore_errors=True)
+        used = os.path.join(__get_dir(), '.last-used', entry['name'].replace(os.sep, '_'))
+        if os.path.exists(used):
+            os.remove(used)
+        total -= entry['size']
+        removed.append(entry)
+    return removed
+
+def __mark_used(path):
+    if path is None or not path.startswith(__get_dir()):
+        return
+    name = os.path.relpath(path, __get_dir()).replace(os.sep, '_')
+    used = os.path.join(__ensure_dir(os.path.join(__get_dir(), '.last-used')), name)
+    with open(used, 'a'):
+        os.utime(used, None)
+
+def __last_used(path):
+    used = os.path.join(__get_dir(), '.last-used', os.path.relpath(path, __get_dir()).replace(os.sep, '_'))
+    # entries never marked (set up by an older ccm) default to their creation
+    return os.path.getmtime(used if os.path.exists(used) else path)
+
+def __disk_usage(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files + dirs:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_blocks * 512
+            except OSError:
+                pass
+    return size
+
+def __config_dirs():
+    # The existing config directories registered by __register_config_dir
+    path = os.path.join(__get_dir(), '.config-dirs')
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [ d for d in f.read().splitlines() if d and os.path.isdir(d) ]
+
+def __register_config_dir(config_dir):
+    # Records that clusters of config_dir (e.g. a test temporary directory)
+    # use the repository, dropping the directories that are gone
+    config_dir = os.path.abspath(config_dir)
+    with __lock('_config_dirs'):
+        dirs = __config_dirs()
+        if config_dir in dirs:
+            return
+        path = os.path.join(__get_dir(), '.config-dirs')
+        with open(path + '.tmp', 'w') as f:
+            f.write(''.join(d + '\n' for d in dirs + [ config_dir ]))
+        os.rename(path + '.tmp', path)
+
+def __used_directories(config_dirs):
+    # The (real) cassandra directories of all the clusters and nodes of config_dirs
+    used = set()
+    for config_dir in config_dirs:
+        if not os.path.isdir(config_dir):
+            continue
+        for name in os.listdir(config_dir):
+            cluster_conf = os.path.join(config_dir, name, 'cluster.conf')
+            if not os.path.exists(cluster_conf):
+                continue
+            confs = [ cluster_conf ] + glob.glob(os.path.join(config_dir, name, '*', 'node.conf'))
+            for conf in confs:
+                try:
+                    with open(conf) as f:
+                        data = yaml.safe_load(f) or {}
+                except (IOError, yaml.YAMLError):
+                    continue
+                if data.get('cassandra_dir'):
+                    used.add(os.path.realpath(data['cassandra_dir']))
+    return used
+
+def fetch(url, verbose=False, progress=None):
+    """
+    Returns the path of a local copy of url in the download cache
+    (~/.ccm/downloads, or 'download_cache_dir' in ~/.ccm/config), downloading
+    it first unless the cache already has a copy matching its checksum.
+    Downloads are checked against the checksum published next to url if any,
+    and resume where they stopped if interrupted. If progress is given, it
+    is a _DownloadProgress updated as the download goes.
+    """
+    cached = __get_cached(url, verbose)
+    if cached is not None:
+        return cached
+
+    target = os.path.join(__get_download_dir(), os.path.basename(url))
+    algorithm, expected = __get_published_checksum(url)
+    partial = target + '.part'
+    __download(url, partial, show_progress=verbose, progress=progress)
+    return __add_to_cache(url, partial, target, algorithm, expected, __file_digest(partial, algorithm))
+
+def __get_cached(url, verbose=False):
+    # Returns the path of the cached copy of url, if there is a valid one
+    target = os.path.join(__get_download_dir(), os.path.basename(url))
+    if os.path.exists(target):
+        if __verify_cached(target):
+            if verbose:
+                print "Using cached %s" % target
+            return target
+        if verbose:
+            print "Cached %s is corrupted, downloading it again" % target
+        os.remove(target)
+    return None
+
+def __add_to_cache(url, partial, target, algorithm, expected, actual):
+    if expected is not None and actual != expected:
+        os.remove(partial)
+        raise common.CCMError("Checksum mismatch for %s: expected %s %s, got %s" % (url, algorithm, expected, actual))
+    with open(target + '.checksum', 'w') as f:
+        f.write("%s %s\n" % (algorithm, actual))
+    os.rename(partial, target)
+    return target
+
+def __extract(fileobj, target_dir):
+    # Extracts the gzipped tarball read (sequentially) from fileobj in
+    # target_dir and returns the name of its top level directory
+    tar = tarfile.open(fileobj=fileobj, mode='r|gz')
+    try:
+        dir = None
+        for member in tar:
+            dir = dir or member.name.split("/")[0]
+            tar.extract(member, path=target_dir)
+    finally:
+        tar.close()
+    if dir is None:
+        raise tarfile.ReadError("empty archive")
+    return dir
+
+def __download_and_extract(url, target_dir, show_progress=False):
+    # Extracts url in target_dir while downloading it to the download cache
+    target = os.path.join(__get_download_dir(), os.path.basename(url))
+    algorithm, expected = __get_published_checksum(url)
+    partial = target + '.part'
+    if show_progress:
+        print "Downloading and extracting %s" % url
+    download = _CachingDownload(url, partial, algorithm, _DownloadProgress(None, show_progress))
+    try:
+        dir = __extract(download, target_dir)
+        # the end of the archive (tar padding) is not necessarily read by the extraction
+        while download.read():
+            pass
+    finally:
+        download.close()
+    download.progress.done()
+    __add_to_cache(url, partial, target, algorithm, expected, download.digest.hexdigest())
+    return dir
+
+class _CachingDownload():
+    """
+    A file-like object reading url sequentially while appending what it reads
+    to partial. If partial already holds the beginning of url, it is read
+    first and the download resumes after it. Transient errors are retried
+    from the current position.
+    """
+    def __init__(self, url, partial, algorithm, progress):
+        self.url = url
+        self.digest = hashlib.new(algorithm)
+        self.progress = progress
+        self.position = 0
+        self.attempts = 0
+        self.length = None
+        if os.path.exists(partial):
+            self.length = _remote_length(url)
+            if self.length is not None and os.path.getsize(partial) > self.length:
+                # not the beginning of url (e.g. it was republished since)
+                os.remove(partial)
+        self.cached = open(partial, 'rb') if os.path.exists(partial) else None
+        self.out = open(partial, 'ab')
+        self.remote = None
+
+    def read(self, n=_READ_BLOCK):
+        data = ''
+        if self.cached is not None:
+            data = self.cached.read(n)
+            if not data:
+                self.cached.close()
+                self.cached = None
+        if not data:
+            data = self.__read_remote(n)
+            self.out.write(data)
+        self.position += len(data)
+        self.digest.update(data)
+        self.progress.add(len(data))
+        return data
+
+    def close(self):
+        if self.cached is not None:
+            self.cached.close()
+        if self.remote is not None:
+            self.remote.close()
+        self.out.close()
+
+    def __read_remote(self, n):
+        if self.length is not None and self.position >= self.length:
+            # the partial file was complete
+            return ''
+        while True:
+            try:
+                if self.remote is None:
+                    self.__open_remote()
+                return self.remote.read(n)
+            except (socket.error, urllib2.URLError) as e:
+                if isinstance(e, urllib2.HTTPError) or self.attempts >= _ATTEMPTS:
+                    raise
+                self.attempts = self.attempts + 1
+                self.remote = None
+                time.sleep(0.5 * self.attempts)
+
+    def __open_remote(self):
+        request = urllib2.Request(self.url)
+        if self.position > 0:
+            request.add_header('Range', 'bytes=%d-' % self.position)
+        try:
+            self.remote = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            if e.code != 416 or self.position == 0:
+                raise
+            # nothing after position: the partial file was complete
+            self.length = self.position
+            self.remote = StringIO.StringIO()
+            return
+        length = self.remote.info().getheaders("Content-Length")
+        if self.position > 0 and self.remote.getcode() != 206:
+            # the server doesn't resume: skip what we already have
+            skipped = 0
+            while skipped < self.position:
+                data = self.remote.read(min(_READ_BLOCK, self.position - skipped))
+                if not data:
+                    raise common.CCMError("Error downloading %s: the file is shorter than what was already downloaded" % self.url)
+                skipped += len(data)
+        if length:
+            self.progress.file_size = (self.position if self.remote.getcode() == 206 else 0) + int(length[0])
+
+class _HeadRequest(urllib2.Request):
+    def get_method(self):
+        return 'HEAD'
+
+def _remote_length(url):
+    # The size of url, or None if the server doesn't tell
+    try:
+        u = urllib2.urlopen(_HeadRequest(url))
+    except (socket.error, urllib2.URLError):
+        return None
+    length = u.info().getheaders("Content-Length")
+    u.close()
+    return int(length[0]) if length else None
+
+def __download(url, target, show_progress=False, progress=None):
+    if url.startswith('file://'):
+        # a local mirror: nothing to resume or parallelize
+        if show_progress:
+            print "Copying %s to %s" % (url, target)
+        shutil.copyfile(urllib2.url2pathname(url[len('file://'):]), target)
+        return
+
+    u = urllib2.urlopen(_HeadRequest(url))
     meta = u.info()
-    file_size = int(meta.getheaders("Content-Length")[0])
+    u.close()
+    file_size = int(meta.getheaders("Content-Length")[0]) if meta.getheaders("Content-Length") else None
+    ranges = 'bytes' in meta.getheaders("Accept-Ranges")
+    connections = int(common.get_config().get('download_connections', DOWNLOAD_CONNECTIONS))
+    if not ranges or file_size is None or file_size < _MIN_RANGE_SIZE:
+        connections = 1
     if show_progress:
-        print "Downloading %s to %s (%.3fMB)" % (url, target, float(file_size) / (1024 * 1024))
+        size = "%.3fMB" % (float(file_size) / (1024 * 1024)) if file_size is not None else "unknown size"
+        print "Downloading %s to %s (%s, %d connection%s)" % (url, target, size, connections, 's' if connections > 1 else '')
+
+    if progress is None:
+        progress = _DownloadProgress(file_size, show_progress)
+    progress.file_size = file_size
+    if connections == 1:
+        __download_range(url, target, 0, file_size - 1 if file_size is not None else None, ranges, progress)
+    else:
+        # one part file per range, named after the number of ranges so an
+        # interrupted download is only resumed with the same split
+        bounds = [ (i * file_size // connections, (i + 1) * file_size // connections - 1) for i in xrange(0, connections) ]
+        parts = [ "%s.%dof%d" % (target, i + 1, connections) for i in xrange(0, connections) ]
+        common.parallel_map(lambda (part, (start, end)): __download_range(url, part, start, end, ranges, progress), zip(parts, bounds), max_workers=connections)
+        with open(target, 'wb') as f:
+            for part in parts:
+                with open(part, 'rb') as p:
+                    shutil.copyfileobj(p, f)
+        for part in parts:
+            os.remove(part)
+    progress.done()
 
-    file_size_dl = 0
-    block_sz = 8192
-    status = None
+def __download_range(url, target, start, end, ranges, progress):
+    # Downloads bytes start to end (inclusive, None meaning the end of the
+    # file) of url into target, resuming from what target already holds.
     attempts = 0
-    while file_size_dl < file_size:
-        buffer = u.read(block_sz)
-        if not buffer:
+    counted = 0 # bytes of target already accounted for in progress
+    while True:
+        offset = os.path.getsize(target) if os.path.exists(target) and ranges else 0
+        if end is not None and start + offset > end + 1:
+            # more than the range: left by another version of the file
+            os.remove(target)
+            offset = 0
+        progress.add(offset - counted)
+        counted = offset
+        if end is not None and start + offset > end:
+            return
+        request = urllib2.Request(url)
+        if start + offset > 0 or end is not None:
+            request.add_header('Range', 'bytes=%d-%s' % (start + offset, end if end is not None else ''))
+        try:
+            try:
+                u = urllib2.urlopen(request)
+            except urllib2.HTTPError as e:
+                # nothing after offset (the size of the file was unknown)
+                if e.code == 416 and offset > 0 and end is None:
+                    return
+                raise
+            if start + offset > 0 and u.getcode() != 206:
+                if start > 0:
+                    raise common.CCMError("Error downloading %s: the server ignored the requested range" % url)
+                # the server doesn't resume, start over
+                progress.add(-counted)
+                counted = offset = 0
+            with open(target, 'ab' if offset > 0 else 'wb') as f:
+                while True:
+                    buffer = u.read(_READ_BLOCK)
+                    if not buffer:
+                        break
+                    f.write(buffer)
+                    progress.add(len(buffer))
+                    counted += len(buffer)
+            u.close()
+            return
+        except (socket.error, urllib2.URLError) as e:
+            if isinstance(e, urllib2.HTTPError) or attempts >= _ATTEMPTS:
+                raise
             attempts = attempts + 1
-            if attempts >= 5:
-                raise common.CCMError("Error downloading file (nothing read after %i attemps, downloded only %i of %i bytes)" % (attempts, file_size_dl, file_size))
+            # the next attempt resumes from what was written
             time.sleep(0.5 * attempts)
-            continue;
+
+class _DownloadProgress():
+    def __init__(self, file_size, show):
+        self.file_size = file_size
+        self.show = show
+        self.downloaded = 0
+        self.lock = threading.Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.downloaded += n
+            if self.show and self.file_size:
+                status = r"%10d  [%3.2f%%]" % (self.downloaded, self.downloaded * 100. / self.file_size)
+                sys.stdout.write(chr(8)*(len(status)+1) + status)
+                sys.stdout.flush()
+
+    def done(self):
+        if self.show:
+            print ""
+
+def __get_published_checksum(url):
+    # Returns the (algorithm, checksum) published next to url, or
+    # (algorithm, None) if there is none.
+    for algorithm in CHECKSUM_ALGORITHMS:
+        try:
+            u = urllib2.urlopen("%s.%s" % (url, algorithm))
+            content = u.read()
+            u.close()
+        except (urllib2.URLError, IOError):
+            continue
+        # either "<checksum> [file name]" or gpg --print-md's "<file name>: <checksum in groups>"
+        if ':' in content:
+            checksum = "".join(content.split(':', 1)[1].split()).lower()
         else:
-            attemps = 0
+            checksum = content.split()[0].lower() if content.split() else ""
+        if len(checksum) == hashlib.new(algorithm).digest_size * 2:
+            return (algorithm, checksum)
+    return (CHECKSUM_ALGORITHMS[0], None)
 
-        file_size_dl += len(buffer)
-        f.write(buffer)
-        if show_progress:
-            status = r"%10d  [%3.2f%%]" % (file_size_dl, file_size_dl * 100. / file_size)
-            status = chr(8)*(len(status)+1) + status
-            print status,
+def __file_digest(path, algorithm):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_READ_BLOCK), ''):
+            h.update(block)
+    return h.hexdigest()
 
-    if show_progress:
-        print ""
-    f.close()
-    u.close()
+def __verify_cached(path):
+    try:
+        with open(path + '.checksum', 'r') as f:
+            algorithm, checksum = f.read().split()
+    except (IOError, ValueError):
+        return False
+    return __file_digest(path, algorithm) == checksum
+
+def __get_archive():
+    # the base url to download releases from, e.g. a mirror or a file:// directory shared between hosts
+    return common.get_config().get('archive_mirror', ARCHIVE).rstrip('/')
+
+def __get_download_dir():
+    # outside of the repository so that clearrepo keeps the downloads
+    downloads = common.get_config().get('download_cache_dir', os.path.join(common.get_default_path(), 'downloads'))
+    return __ensure_dir(downloads)
+
+def __get_build_cache_dir():
+    return __ensure_dir(os.path.join(__get_dir(), '_build_cache'))
 
 def __get_dir():
-    repo = os.path.join(common.get_default_path(), 'repository')
-    if not os.path.exists(repo):
-        os.mkdir(repo)
-    return repo
+    return __ensure_dir(os.path.join(common.get_default_path(), 'repository'))
+
+def __ensure_dir(path):
+    # several ccm processes may be creating the same directory
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return path
@@ -0,0 +1,232 @@
+# sstable metadata handling
+#
+# Reads the Statistics.db, CompressionInfo.db and Summary.db components of an
+# sstable without starting a JVM. Supported formats are the ones written by
+# Cassandra 1.0 ('hb') to 2.1 ('ka').
+from __future__ import with_statement
+
+import os, struct
+import common
+
+OLDEST_SUPPORTED_VERSION = 'hb'
+NEWEST_SUPPORTED_VERSION = 'ka'
+
+# Statistics.db component types (MetadataType ordinals) from 2.1 onwards
+_VALIDATION = 0
+_COMPACTION = 1
+_STATS = 2
+
+class _DataInput():
+    """
+    Minimal equivalent of java.io.DataInput on top of a file object.
+    """
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, n):
+        data = self.f.read(n)
+        if len(data) != n:
+            raise EOFError("Unexpected end of file reading %s" % self.f.name)
+        return data
+
+    def at_eof(self):
+        pos = self.f.tell()
+        eof = self.f.read(1) == ''
+        self.f.seek(pos)
+        return eof
+
+    def seek(self, offset):
+        self.f.seek(offset)
+
+    def skip(self, n):
+        self.f.seek(n, os.SEEK_CUR)
+
+    def read_boolean(self):
+        return struct.unpack('>?', self.read(1))[0]
+
+    def read_short(self):
+        return struct.unpack('>H', self.read(2))[0]
+
+    def read_int(self):
+        return struct.unpack('>i', self.read(4))[0]
+
+    def read_long(self):
+        return struct.unpack('>q', self.read(8))[0]
+
+    def read_double(self):
+        return struct.unpack('>d', self.read(8))[0]
+
+    def read_utf(self):
+        return self.read(self.read_short()).decode('utf-8')
+
+    def read_with_short_length(self):
+        return self.read(self.read_short())
+
+    def read_with_length(self):
+        return self.read(self.read_int())
+
+    def read_estimated_histogram(self):
+        # list of (bucket offset, count)
+        return [ (self.read_long(), self.read_long()) for i in xrange(0, self.read_int()) ]
+
+    def read_streaming_histogram(self):
+        self.read_int() # max bin size
+        return [ (self.read_double(), self.read_long()) for i in xrange(0, self.read_int()) ]
+
+def parse_descriptor(path):
+    """
+    Returns a dictionary with the keyspace, table, format version, generation
+    and component of the sstable file at path.
+    """
+    dirname, filename = os.path.split(os.path.abspath(path))
+    parts = filename.split('-')
+    if len(parts) < 4:
+        raise common.ArgumentError("%s does not appear to be an sstable file" % path)
+    if parts[-4] == 'tmp':
+        del parts[-4]
+    if len(parts) >= 5:
+        keyspace, table = parts[0], parts[1]
+    else:
+        # pre-1.1 sstables are not prefixed by the keyspace name, but live in its directory
+        keyspace, table = os.path.basename(dirname), parts[0]
+    return {
+        'keyspace' : keyspace,
+        'table' : table,
+        'version' : parts[-3],
+        'generation' : int(parts[-2]),
+        'component' : parts[-1],
+    }
+
+def component_path(datafile, component):
+    return datafile[:-len('Data.db')] + component
+
+def read_metadata(datafile):
+    """
+    Returns a dictionary describing the sstable whose Data.db component is
+    datafile, as read from its Statistics.db, CompressionInfo.db and
+    Summary.db components (the latter two only if they exist).
+    """
+    metadata = parse_descriptor(datafile)
+    version = metadata['version']
+    if version < OLDEST_SUPPORTED_VERSION or version > NEWEST_SUPPORTED_VERSION:
+        raise common.ArgumentError("Unsupported sstable format '%s' for %s" % (version, datafile))
+
+    metadata['file'] = datafile
+    metadata['data_size'] = os.path.getsize(datafile)
+    with open(component_path(datafile, 'Statistics.db'), 'rb') as f:
+        if version >= 'ka':
+            metadata.update(__read_statistics(_DataInput(f)))
+        else:
+            metadata.update(__read_legacy_statistics(_DataInput(f), version))
+
+    compression_info = component_path(datafile, 'CompressionInfo.db')
+    if os.path.exists(compression_info):
+        with open(compression_info, 'rb') as f:
+            metadata.update(__read_compression_info(_DataInput(f)))
+        if metadata['uncompressed_size'] > 0:
+            metadata['compression_ratio'] = float(metadata['data_size']) / metadata['uncompressed_size']
+
+    summary = component_path(datafile, 'Summary.db')
+    if os.path.exists(summary) and version >= 'ia':
+        with open(summary, 'rb') as f:
+            metadata.update(__read_summary(_DataInput(f), version))
+
+    return metadata
+
+def __histogram_count(histogram):
+    return sum(count for _, count in histogram)
+
+def __stats(rows, replay_position, min_timestamp, max_timestamp, max_local_deletion_time, compression_ratio, tombstones, level):
+    return {
+        'estimated_partitions' : __histogram_count(rows),
+        'replay_position' : replay_position,
+        'min_timestamp' : min_timestamp,
+        'max_timestamp' : max_timestamp,
+        'max_local_deletion_time' : max_local_deletion_time,
+        'compression_ratio' : compression_ratio,
+        'tombstone_drop_times' : __histogram_count(tombstones),
+        'sstable_level' : level,
+    }
+
+def __read_statistics(din):
+    offsets = {}
+    for i in xrange(0, din.read_int()):
+        kind = din.read_int()
+        offsets[kind] = din.read_int()
+
+    metadata = {}
+    if _VALIDATION in offsets:
+        din.seek(offsets[_VALIDATION])
+        metadata['partitioner'] = din.read_utf()
+        metadata['bloom_filter_fp_chance'] = din.read_double()
+    if _COMPACTION in offsets:
+        din.seek(offsets[_COMPACTION])
+        metadata['ancestors'] = [ din.read_int() for i in xrange(0, din.read_int()) ]
+    if _STATS in offsets:
+        din.seek(offsets[_STATS])
+        rows = din.read_estimated_histogram()
+        din.read_estimated_histogram() # cell counts
+        replay_position = (din.read_long(), din.read_int())
+        min_timestamp = din.read_long()
+        max_timestamp = din.read_long()
+        max_local_deletion_time = din.read_int()
+        compression_ratio = din.read_double()
+        tombstones = din.read_streaming_histogram()
+        level = din.read_int()
+        metadata.update(__stats(rows, replay_position, min_timestamp, max_timestamp, max_local_deletion_time, compression_ratio, tombstones, level))
+        metadata['repaired_at'] = din.read_long()
+    return metadata
+
+def __read_legacy_statistics(din, version):
+    # Pre-2.1 sstables have a single, version dependent, metadata structure
+    rows = din.read_estimated_histogram()
+    din.read_estimated_histogram() # cell counts
+    replay_position = (din.read_long(), din.read_int())
+    min_timestamp = din.read_long() if version >= 'ib' else None
+    max_timestamp = din.read_long() if version >= 'hd' else None
+    max_local_deletion_time = din.read_int() if version >= 'ja' else None
+    metadata = {}
+    if version >= 'ja':
+        metadata['bloom_filter_fp_chance'] = din.read_double()
+    compression_ratio = din.read_double()
+    if version >= 'hc':
+        metadata['partitioner'] = din.read_utf()
+    if version >= 'he':
+        metadata['ancestors'] = [ din.read_int() for i in xrange(0, din.read_int()) ]
+    tombstones = din.read_streaming_histogram() if version >= 'ia' else []
+    level = din.read_int() if version >= 'ia' and not din.at_eof() else 0
+    metadata.update(__stats(rows, replay_position, min_timestamp, max_timestamp, max_local_deletion_time, compression_ratio, tombstones, level))
+    return metadata
+
+def __read_compression_info(din):
+    compressor = din.read_utf()
+    options = {}
+    for i in xrange(0, din.read_int()):
+        k = din.read_utf()
+        options[k] = din.read_utf()
+    return {
+        'compressor' : compressor,
+        'compression_options' : options,
+        'chunk_length' : din.read_int(),
+        'uncompressed_size' : din.read_long(),
+        'chunk_count' : din.read_int(),
+    }
+
+def __read_summary(din, version):
+    index_interval = din.read_int()
+    entries = din.read_int()
+    metadata = { 'index_interval' : index_interval, 'summary_entries' : entries }
+    if version >= 'ja':
+        # 2.0+ summaries are a single block of off-heap memory
+        size = din.read_long()
+        if version >= 'ka':
+            metadata['sampling_level'] = din.read_int()
+            metadata['summary_entries_at_full_sampling'] = din.read_int()
+        din.skip(size)
+    else:
+        for i in xrange(0, entries):
+            din.read_long()
+            din.skip(din.read_int())
+    metadata['first_key'] = din.read_with_length().encode('hex')
+    metadata['last_key'] = din.read_with_length().encode('hex')
+    return metadata
@@ -0,0 +1,131 @@
+# partitioner tokens handling
+import hashlib, struct
+import common
+
+MURMUR3 = 'org.apache.cassandra.dht.Murmur3Partitioner'
+RANDOM = 'org.apache.cassandra.dht.RandomPartitioner'
+
+# The shift between the tokens of consecutive data centers (see balanced_tokens)
+DC_TOKEN_OFFSET = 100
+
+_MASK64 = (1 << 64) - 1
+_C1 = 0x87c37b91114253d5
+_C2 = 0x4cf5ad432745937f
+
+def _rotl64(v, n):
+    return ((v << n) | (v >> (64 - n))) & _MASK64
+
+def _fmix(k):
+    k ^= k >> 33
+    k = (k * 0xff51afd7ed558ccd) & _MASK64
+    k ^= k >> 33
+    k = (k * 0xc4ceb9fe1a85ec53) & _MASK64
+    k ^= k >> 33
+    return k
+
+def _signed64(v):
+    return v - (1 << 64) if v >= (1 << 63) else v
+
+def murmur3_token(key):
+    """
+    Returns the Murmur3Partitioner token of key (a byte string). This mimics
+    Cassandra's MurmurHash.hash3_x64_128, including its sign extension of the
+    trailing bytes.
+    """
+    length = len(key)
+    nblocks = length // 16
+    h1 = h2 = 0
+    for i in xrange(0, nblocks):
+        k1, k2 = struct.unpack_from('<QQ', key, i * 16)
+        k1 = (k1 * _C1) & _MASK64
+        k1 = _rotl64(k1, 31)
+        k1 = (k1 * _C2) & _MASK64
+        h1 ^= k1
+        h1 = _rotl64(h1, 27)
+        h1 = (h1 + h2) & _MASK64
+        h1 = (h1 * 5 + 0x52dce729) & _MASK64
+        k2 = (k2 * _C2) & _MASK64
+        k2 = _rotl64(k2, 33)
+        k2 = (k2 * _C1) & _MASK64
+        h2 ^= k2
+        h2 = _rotl64(h2, 31)
+        h2 = (h2 + h1) & _MASK64
+        h2 = (h2 * 5 + 0x38495ab5) & _MASK64
+
+    tail = [ struct.unpack('b', c)[0] for c in key[nblocks * 16:] ]
+    k1 = k2 = 0
+    for i in xrange(len(tail) - 1, 7, -1):
+        k2 ^= (tail[i] << ((i - 8) * 8)) & _MASK64
+    if len(tail) > 8:
+        k2 = (k2 * _C2) & _MASK64
+        k2 = _rotl64(k2, 33)
+        k2 = (k2 * _C1) & _MASK64
+        h2 ^= k2
+    for i in xrange(min(len(tail), 8) - 1, -1, -1):
+        k1 ^= (tail[i] << (i * 8)) & _MASK64
+    if len(tail) > 0:
+        k1 = (k1 * _C1) & _MASK64
+        k1 = _rotl64(k1, 31)
+        k1 = (k1 * _C2) & _MASK64
+        h1 ^= k1
+
+    h1 ^= length
+    h2 ^= length
+    h1 = (h1 + h2) & _MASK64
+    h2 = (h2 + h1) & _MASK64
+    h1 = _fmix(h1)
+    h2 = _fmix(h2)
+    h1 = (h1 + h2) & _MASK64
+    token = _signed64(h1)
+    # Murmur3Partitioner normalizes the minimum token away
+    return 2**63 - 1 if token == -2**63 else token
+
+def random_token(key):
+    """
+    Returns the RandomPartitioner token of key (a byte string).
+    """
+    digest = int(hashlib.md5(key).hexdigest(), 16)
+    if digest >= 2**127:
+        digest = digest - 2**128
+    return abs(digest)
+
+def default_partitioner(version):
+    return MURMUR3 if common.parse_version(version) >= (1, 2) else RANDOM
+
+def ring(partitioner):
+    """
+    Returns the (minimum token, ring size) pair for partitioner, or raises
+    ValueError if tokens of that partitioner can't be computed by ccm.
+    """
+    if partitioner.endswith('Murmur3Partitioner'):
+        return (-2**63, 2**64)
+    if partitioner.endswith('RandomPartitioner'):
+        return (0, 2**127 + 1)
+    raise ValueError("Unsupported partitioner %s" % partitioner)
+
+def token_function(partitioner):
+    if partitioner.endswith('Murmur3Partitioner'):
+        return murmur3_token
+    if partitioner.endswith('RandomPartitioner'):
+        return random_token
+    raise ValueError("Unsupported partitioner %s" % partitioner)
+
+def balanced_tokens(partitioner, node_counts, num_tokens=1):
+    """
+    Returns evenly spread tokens for the nodes of data centers of node_counts
+    nodes (in order), as a list of num_tokens tokens per node. Each data
+    center is balanced on its own, as replicas are placed per data center,
+    and is shifted by DC_TOKEN_OFFSET from the previous one since nodes
+    can't share tokens. The tokens of a node are interleaved with those of
+    the other nodes of its data center, so that vnodes own even ranges too.
+    """
+    ring_min, ring_size = ring(partitioner)
+    if partitioner.endswith('RandomPartitioner'):
+        # its tokens go up to 2**127 included, but ccm has always spread them over 2**127
+        ring_size = 2**127
+    tokens = []
+    for dc, count in enumerate(node_counts):
+        step = ring_size // max(1, count * num_tokens)
+        for node in xrange(0, count):
+            tokens.append([ ring_min + (j * count + node) * step + dc * DC_TOKEN_OFFSET for j in xrange(0, num_tokens) ])
+    return tokens